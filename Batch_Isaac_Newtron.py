@@ -0,0 +1,83 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from GUI_Isaac_Newtron import Plate, PLATE_FORMATS, LAYOUTS, read_parts
+
+#Headless version of Application.run_combinations: generates the plate map and OT-2 protocol for every parts .csv file given,
+#without the Tk window, file dialogs and message boxes.
+#Example: python Batch_Isaac_Newtron.py designs/ --output-dir protocols/
+
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Template_Protocol_Isaac_Newtron.py')
+
+
+def find_parts_files(inputs): #Expands directories (all .csv files inside) and glob patterns into a sorted list of parts files.
+    parts_files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            parts_files += glob.glob(os.path.join(item, '*.csv'))
+        else:
+            parts_files += glob.glob(item)
+    #Plate maps written by a previous run are not parts files.
+    return sorted({path for path in parts_files if not path.endswith('_platemap.csv')})
+
+
+def output_paths(parts_path, output_dir): #Plate map and protocol are named after the parts file: designs/lib.csv -> lib_platemap.csv, lib_protocol.py
+    name = os.path.splitext(os.path.basename(parts_path))[0]
+    output_dir = output_dir or os.path.dirname(parts_path)
+    return os.path.join(output_dir, name + '_platemap.csv'), os.path.join(output_dir, name + '_protocol.py')
+
+
+def generate(parts_path, output_dir, template_path, wells, layout): #Same steps as Application.run_combinations; runs in a worker process.
+    start = time.perf_counter()
+    platemap_path, protocol_path = output_paths(parts_path, output_dir)
+    plate = Plate(read_parts(parts_path), wells=wells, layout=layout)
+    prom_utr_tuple = plate.prom_utr_lengths()
+    plate.check_protocol(*prom_utr_tuple) #Before writing anything, so a mismatched platemap is never left behind.
+    plate.write_platemap(platemap_path, prom_utr_tuple[0], prom_utr_tuple[1])
+    plate.write_protocol(protocol_path, template_path, prom_utr=prom_utr_tuple, layout=plate.layout)
+    return prom_utr_tuple[0] * prom_utr_tuple[1], time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Isaac Newtron plate maps and OT-2 protocols for a batch of parts .csv files.')
+    parser.add_argument('inputs', nargs='+', help='parts .csv files, directories containing them, or glob patterns')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE, help='template .py file to generate the OT-2 protocols from')
+    parser.add_argument('--output-dir', help='where to save plate maps and protocols (default: next to each parts file)')
+    parser.add_argument('--wells', type=int, default=96, choices=sorted(PLATE_FORMATS), help='wells per plate used for the plate map; the OT-2 protocol needs 96')
+    parser.add_argument('--layout', default='single', choices=LAYOUTS,
+                        help="'multichannel' lays the parts out so the 8-channel pipette dispenses whole columns (default: single)")
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    parts_files = find_parts_files(args.inputs)
+    if not parts_files:
+        print('No parts .csv files found.', file=sys.stderr)
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = {pool.submit(generate, parts_path, args.output_dir, args.template, args.wells, args.layout): parts_path
+                for parts_path in parts_files}
+        for job in as_completed(jobs):
+            parts_path = jobs[job]
+            try:
+                n_combinations, seconds = job.result()
+            except Exception as error:
+                failed += 1
+                print(f'FAILED  {parts_path}: {type(error).__name__}: {error}', file=sys.stderr)
+            else:
+                print(f'{seconds:8.3f} s  {parts_path} ({n_combinations} combinations)')
+    print(f'{len(parts_files) - failed}/{len(parts_files)} files done in {time.perf_counter() - start:.3f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,19 @@
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
-import pandas as pd
-import itertools
-from itertools import cycle
-from tkinter.ttk import Entry, Button, Label
+import csv
+import hashlib
+import importlib
+import threading
+from collections import namedtuple
+from tkinter.ttk import Entry, Button, Label, Checkbutton
+
+from Protocol_Liquid_Handling_IR import Step, Transfer, optimize, protocol_source, travel
+from Protocol_Run_Time_Estimator import deck_position
+
+#Heavy modules are imported where they are used rather than here, so the window opens straight away.
+#main() starts loading them in the background once the window is up (see preload_modules).
+DEFERRED_MODULES = ('numpy',)
 
 #Application class contains all functions needed to run GUI and dialogs.
 class Application:
@@ -53,6 +62,10 @@ class Application:
         self.final_script = Label(master, text="Protocol:")
         self.final_script_entry = Entry(master, textvariable=self.final_script_save_path)
         self.final_script_path_button = Button(master, text="Browse...", command=self.browse_final_script_file)
+        #Layout of the parts; see README_Isaac_Newtron.md for how to load the parts plate in each layout.
+        self.multichannel_layout = tk.BooleanVar()
+        self.multichannel_layout_check = Checkbutton(master, variable=self.multichannel_layout,
+                                                     text="Multichannel layout (parts dispensed a whole column at a time)")
         self.generate_platemap_button = Button(master, text="Generate plate map and OT-2 protocol", command=self.run_combinations)
 
         #Layout.
@@ -79,29 +92,27 @@ class Application:
         self.final_script_entry.grid(row=8, column=1, sticky="EW")
         self.final_script_path_button.grid(row=8, column=2)
 
-        self.generate_platemap_button.grid(row=9, column=1, pady=(10,10))
-
+        self.multichannel_layout_check.grid(row=9, column=0, pady=(10, 0), columnspan=3)
+        self.generate_platemap_button.grid(row=10, column=1, pady=(10,10))
 
 
 
-    def file_save(self, write_data, f): #Argument passed = data to be written to .csv file.
-            write_data.to_csv(f, index=False)
-
 
     def run_combinations(self):
         filename = self.input_parts_path.get()  #Open dialog box to search for path of input .csv file.
-        #Store in df = combs (short for combinations).
-        combs = pd.read_csv(filename)
-        plate = Plate(combs)  #Run functions in class Plate using contents of input .csv file as argument.
+        #Store in combs (short for combinations): promoters and UTRs streamed from the .csv file.
+        combs = read_parts(filename)
+        layout = 'multichannel' if self.multichannel_layout.get() else 'single'
+        plate = Plate(combs, layout=layout)  #Run functions in class Plate using contents of input .csv file as argument.
         prom_utr_tuple = plate.prom_utr_lengths() #prom_utr_lengths = function to define lengths of .csv promoter and UTR columns.
-        platemap_df = plate.platemap(prom_utr_tuple[0], prom_utr_tuple[1]) #The tuple contains: (number of promoters, number of UTRs).
-        #Used to define dataframe containing all combinations of parts in platemap to be outputted to new .csv file.
+        plate.check_protocol(*prom_utr_tuple) #Nothing is written for a library the protocol cannot make.
 
         tk.messagebox.showinfo("Plate map complete",
                                "Plate map completed. Saving to specified path.") #Tells the user that it's done.
-        self.file_save(platemap_df, self.platemap_save_path.get()) #Saves the file in the location specified.
+        #Writes all combinations of parts in the platemap to the .csv file in the location specified. The tuple contains: (number of promoters, number of UTRs).
+        plate.write_platemap(self.platemap_save_path.get(), prom_utr_tuple[0], prom_utr_tuple[1])
 
-        plate.write_protocol(self.final_script_save_path.get(), self.template_path.get(), prom_utr=prom_utr_tuple)
+        plate.write_protocol(self.final_script_save_path.get(), self.template_path.get(), prom_utr=prom_utr_tuple, layout=plate.layout)
         tk.messagebox.showinfo("Protocol complete",
                                "OT-2 protocol completed. Saving to specified path.")
 
@@ -126,15 +137,154 @@ class Application:
         self.final_script_save_path.set(filename)
 
 
+#Plate formats supported by the platemap engine: wells per plate -> (number of rows, number of columns).
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24)}
+#Layouts of the parts on the plates: 'single' = combinations fill the wells one after the other, for the single-channel pipette;
+#'multichannel' = promoters run down the rows and every 3'UTR has its own column(s), so the 8-channel pipette can dispense whole columns.
+LAYOUTS = ('single', 'multichannel')
+
+
+#Columns of the parts .csv file, and of the platemap .csv file written from it.
+PARTS_COLUMNS = ('Promoters', '3UTRs')
+PLATEMAP_COLUMNS = ('Plate', 'Platemap Coordinates', 'Promoters', "3'UTRs")
+
+
+def iter_parts(parts_path):
+    """Streams the parts .csv file row by row, yielding (column, part) for every filled Promoters or 3UTRs cell.
+    Columns may have different lengths; empty cells (and missing cells of short rows) are skipped.
+    """
+    with open(parts_path, newline='', encoding='utf-8-sig') as rf: #utf-8-sig drops the byte order mark Excel writes before the first header.
+        reader = csv.reader(rf)
+        header = [name.strip() for name in next(reader, [])]
+        missing = [column for column in PARTS_COLUMNS if column not in header]
+        if missing:
+            raise KeyError(f"{parts_path} has no {', '.join(missing)} column")
+        positions = [(column, header.index(column)) for column in PARTS_COLUMNS]
+        for row in reader:
+            for column, position in positions:
+                if position < len(row) and row[position].strip():
+                    yield column, row[position]
+
+
+def read_parts(parts_path): #Collects the streamed parts into {column: [parts]}, which Plate takes in place of a dataframe.
+    combs = {column: [] for column in PARTS_COLUMNS}
+    for column, part in iter_parts(parts_path):
+        combs[column].append(part)
+    return combs
+
+
+#Template split at its first function: head = everything above it, body = the function onwards (global variables are written in between).
+CompiledTemplate = namedtuple('CompiledTemplate', ['head', 'body'])
+compiled_templates = {} #Compiled templates, cached by the hash of their contents so each template is only parsed once.
+
+
+def compile_template(template_path):
+    """Returns the CompiledTemplate of the template file, parsing it only if its contents have not been seen before."""
+    with open(template_path, 'rb') as rf:
+        content = rf.read()
+    key = hashlib.sha1(content).hexdigest()
+    if key not in compiled_templates:
+        lines = content.decode('utf-8').splitlines(keepends=True)
+        function_start = next((index for index, line in enumerate(lines) if line[:3] == 'def'), None) #Finds function start.
+        if function_start is None:
+            raise ValueError(f'No function definition found in template {template_path}')
+        compiled_templates[key] = CompiledTemplate(''.join(lines[:function_start]), ''.join(lines[function_start:]))
+    return compiled_templates[key]
+
+
+#Deck slots of the template's part plates, for the gantry travel of the part plan (the thermocycler sits on slot 7).
+PART_SLOTS = {'reservoir_var': 5, 'PCR_plate': 7}
+PART_VOLUME = 2 #uL of every promoter and 3'UTR in each combination.
+FREE_DISPENSE_HEIGHT = 6 #mm above the well bottom; the 16 uL of constant reagents + 2 uL of promoter sit below this.
+P20 = {'p20': (1, 20)} #(minimum, maximum) uL of the P20 the template dispenses the parts with.
+
+
+def part_location(location): #(x, y) on the deck of a (plate, well) location of the part plan.
+    return deck_position(PART_SLOTS[location[0]], location[1])
+
+
+def part_operations(n_promoters, n_utr, layout='single'):
+    """The combinatorial transfers of the template, as operations of Protocol_Liquid_Handling_IR.py: every promoter and
+    3'UTR of reservoir_var goes to all of its destinations in PCR_plate with one tip.
+    In the 'single' layout parts and destinations are wells counted down the columns (A1, B1 ... H1, A2 ...); promoter i
+    goes to n_promoters * e + i for every 3'UTR e, and 3'UTR i (after the promoters) to n_promoters * i + e, as in the
+    platemap. In the 'multichannel' layout they are the top wells of whole columns: every block of 8 promoters fills a
+    column, then every 3'UTR fills a column of its own, and destination column block * n_utr + utr gets both.
+    Promoters go in first, while every destination still holds the same constant reagents, so the tip can touch the
+    liquid. The destinations of a 3'UTR already hold different promoters, so 3'UTRs are dispensed above the liquid, with
+    a touch tip so the 2 uL drop leaves the tip.
+    """
+    if layout == 'multichannel':
+        n_blocks = -(-n_promoters // 8) #Rounds up.
+        def well(index):
+            return f'A{index + 1}'
+        promoters = [(b, [b * n_utr + e for e in range(n_utr)]) for b in range(n_blocks)]
+        utrs = [(n_blocks + i, [b * n_utr + i for b in range(n_blocks)]) for i in range(n_utr)]
+    else:
+        def well(index):
+            return 'ABCDEFGH'[index % 8] + str(index // 8 + 1)
+        promoters = [(i, [n_promoters * e + i for e in range(n_utr)]) for i in range(n_promoters)]
+        utrs = [(n_promoters + i, [n_promoters * i + e for e in range(n_promoters)]) for i in range(n_utr)]
+    operations = [Step('comment', 'Adding the promoters')]
+    operations += [Transfer(('reservoir_var', well(source)), ('PCR_plate', well(d)), PART_VOLUME, tip=('promoter', source))
+                   for source, dests in promoters for d in dests]
+    operations.append(Step('comment', "Adding the 3'UTRs")) #Nothing is reordered across a step.
+    operations += [Transfer(('reservoir_var', well(source)), ('PCR_plate', well(d), FREE_DISPENSE_HEIGHT), PART_VOLUME,
+                            tip=('utr', source), options={'touch_tip': True}) for source, dests in utrs for d in dests]
+    return operations
+
+
+def part_plan(prom_utr, layout='single'):
+    """Lowered plan of the part combinations for the template (multi-dispensed, destinations in the order with the least
+    gantry travel, one tip per part), led by a note of the travel the reordering saves."""
+    operations = part_operations(prom_utr[0], prom_utr[1], layout)
+    plan = optimize(operations, P20, part_location)
+    loop_order = travel(optimize(operations, P20), part_location)
+    return [('comment', f'Note: gantry travel between part wells: {loop_order:.0f} mm in loop order, '
+                        f'{travel(plan, part_location):.0f} mm reordered.')] + plan
+
+
+def protocol_globals(kwargs):
+    """What is written between the head and the body of the template: kwargs as global variables and, for the part
+    combinations (prom_utr and layout), the plan and the executor of Protocol_Liquid_Handling_IR.py."""
+    global_vars = ''.join(key + ' = ' + repr(value) + '\n' for key, value in kwargs.items()) #repr so strings are written with their quotes.
+    if 'prom_utr' in kwargs:
+        global_vars += '\n' + protocol_source(part_plan(kwargs['prom_utr'], kwargs.get('layout', 'single')))
+    return global_vars
+
+
+def render_protocols(template_path, jobs):
+    """Batch version of Plate.write_protocol: jobs is an iterable of (ot2_script_path, kwargs) pairs.
+    The template is compiled once and every parameter set is written straight to its own output file.
+    """
+    template = compile_template(template_path)
+    for ot2_script_path, kwargs in jobs:
+        with open(ot2_script_path, 'w', encoding='utf-8') as wf:
+            wf.write(template.head + protocol_globals(kwargs) + '\n' + template.body)
+
+
+def parts_list(parts): #combs can be the output of read_parts or a dataframe.
+    if hasattr(parts, 'dropna'):
+        #If the number of promoters =/= number of utr, then pandas reads as NaN cells. These are deleted and the columns of the dataframe are converted into lists for easy manipulation.
+        return parts.dropna().tolist()
+    return list(parts)
+
+
 #Plate class contains all functions needed to calculate desired output depending on user inputs from Application class GUI.
 class Plate:
-    def __init__(self, combs):
-        self.rows = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-        self.columns = list(range(1, 13))  # 1 ... 12
-        # determines 96-well plate coordinates
-        self.promoters = combs['Promoters'].dropna().tolist()
-        self.utr = combs['3UTRs'].dropna().tolist()
-        #If the number of promoters =/= number of utr, then Python reads as NaN cells. These are deleted and the columns of the dataframe are converted into lists for easy manipulation.
+    def __init__(self, combs, wells=96, layout='single'):
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown layout {layout!r}; choose one of {LAYOUTS}')
+        if layout == 'multichannel' and PLATE_FORMATS[wells][0] != 8:
+            raise ValueError('The multichannel layout needs plates with 8 rows (96-well plates)')
+        self.wells = wells
+        self.layout = layout
+        self.n_rows, self.n_columns = PLATE_FORMATS[wells]
+        self.rows = [chr(ord('A') + i) for i in range(self.n_rows)]  # A ... H (A ... P for 384-well plates)
+        self.columns = list(range(1, self.n_columns + 1))  # 1 ... 12 (1 ... 24 for 384-well plates)
+        # determines plate coordinates
+        self.promoters = parts_list(combs['Promoters'])
+        self.utr = parts_list(combs['3UTRs'])
 
     def prom_utr_lengths(self): #To get the number of promoters and utrs, stored in tuple.
         n_promoters = len(self.promoters)
@@ -143,54 +293,100 @@ class Plate:
 
 
 
+    def check_protocol(self, n_promoters, n_utr):
+        """Raises ValueError if the OT-2 protocol cannot make this library: it pipettes one 96-well PCR plate from one
+        96-well source plate, so the platemap would not match the protocol. Same limits as the protocol template.
+        """
+        if self.wells != 96:
+            raise ValueError(f'The OT-2 protocol pipettes a 96-well PCR plate; a {self.wells}-well platemap would not match it')
+        if self.layout == 'multichannel':
+            n_blocks = -(-n_promoters // 8) #Rounds up.
+            if n_blocks * n_utr > 12 or n_blocks + n_utr > 12:
+                raise ValueError("Too many parts for the multichannel layout: it needs (promoters / 8, rounded up) x 3'UTRs <= 12 columns "
+                                 "in the PCR plate and (promoters / 8, rounded up) + 3'UTRs <= 12 columns in reservoir_var.")
+        elif n_promoters * n_utr > 96 or n_promoters + n_utr > 96:
+            raise ValueError(f"Too many parts for one plate: {n_promoters} promoters x {n_utr} 3'UTRs = {n_promoters * n_utr} "
+                             "combinations; the protocol makes at most 96, from at most 96 parts in reservoir_var.")
+
     def write_protocol(self, ot2_script_path, template_path, **kwargs):
         """Generates an ot2 script where kwargs are
         written as global variables at the top of the script. The remainder of template file is subsequently written below.
         """
-        with open(ot2_script_path, 'w') as wf: #Open file to write to.
-            with open(template_path, 'r') as rf: #Open .py containing template code (all of M5 except global var).
-                for index, line in enumerate(rf):
-                    if line[:3] == 'def':  #Finds function start.
-                        function_start = index
-                        break
-                    else:
-                        wf.write(line)  #Writes contents of template .py to new protocol file.
-
-
-                for key, value in kwargs.items():
-                    wf.write(key + ' = ' + str(value))
-                    wf.write('\n')
-                wf.write('\n')
-            with open(template_path, 'r') as rf:
-                for index, line in enumerate(rf):
-                    if index >= function_start - 1:
-                        wf.write(line)
+        render_protocols(template_path, [(ot2_script_path, kwargs)])
+
 
+    def well_names(self): #Well names of one plate in pipetting order; A1-H1, A2-H2 etc., same as Opentrons pipette.
+        return [f'{row}{column}' for column in self.columns for row in self.rows]
+
+    def platemap_indices(self, n_promoters, n_utr):
+        """Integer layout of the library: returns (plate, well, promoter, utr) index arrays, one entry per combination.
+        Combinations fill the wells column by column and continue on a new plate once a plate is full.
+        """
+        import numpy as np
+        if self.layout == 'multichannel':
+            return self.multichannel_indices(n_promoters, n_utr)
+        combination = np.arange(n_promoters * n_utr) #Total number of combinations possible, numbered in pipetting order.
+        plate, well = np.divmod(combination, self.wells) #Spreads the library over as many plates as needed.
+        #Each promoter is pipetted in a new cell vertically downwards and every UTR is repeated for all promoters; same as the protocol template.
+        utr, promoter = np.divmod(combination, max(n_promoters, 1))
+        return plate, well, promoter, utr
+
+    def multichannel_indices(self, n_promoters, n_utr):
+        """platemap_indices for the multichannel layout, same as the protocol template: promoter p sits in row p % 8 and
+        every block of 8 promoters gets one column per 3'UTR (column = block * n_utr + utr). Rows left over by the last,
+        incomplete block of promoters stay out of the platemap.
+        """
+        import numpy as np
+        n_blocks = -(-n_promoters // self.n_rows) #Rounds up.
+        column, row = np.divmod(np.arange(n_blocks * n_utr * self.n_rows), self.n_rows)
+        block, utr = np.divmod(column, max(n_utr, 1))
+        promoter = block * self.n_rows + row
+        used = promoter < n_promoters
+        plate, plate_column = np.divmod(column[used], self.n_columns)
+        return plate, plate_column * self.n_rows + row[used], promoter[used], utr[used]
+
+    def write_platemap(self, platemap_path, n_promoters, n_utr): #Writes the platemap .csv file directly, without building a dataframe.
+        plate, well, promoter, utr = self.platemap_indices(n_promoters, n_utr)
+        well_names = self.well_names()
+        with open(platemap_path, 'w', newline='', encoding='utf-8') as wf:
+            writer = csv.writer(wf, lineterminator='\n')
+            writer.writerow(PLATEMAP_COLUMNS)
+            writer.writerows(zip((plate + 1).tolist(),
+                                 map(well_names.__getitem__, well.tolist()),
+                                 map(self.promoters.__getitem__, promoter.tolist()),
+                                 map(self.utr.__getitem__, utr.tolist())))
 
     def platemap(self, n_promoters, n_utr): #Function to output platemap of resulting construct combinations.
-        platemap_df = pd.DataFrame()
-        total = n_promoters * n_utr #Total number of combinations possible.
-
-        #First need to identify which part of the 96-well plate is actually going to be filled if total < 96.
-        map_coords = itertools.product(self.rows, self.columns) #Gets coordinates A1, A2 ... H12 as tuples by iterating through rows and columns lists.
-        coords = [''.join(map(str, x)) for x in map_coords] #Converts tuples to strings. len(coord) = 96.
-        coords.sort(key=lambda x: int(x[1:])) #Sort by column, same as Opentrons pipette; A1-H1, A2-H2 etc.
-        platemap_df['Platemap Coordinates'] = coords[:total] #Slice to only include the number of cells containing promoter+UTR mix in final library.
-
-        seq = cycle(self.promoters) #In our pattern of pipetting, each promoter is pipetted in a new cell vertically downwards.
-        #So generate cycle of promoters to iterate through and populate df eg. 7 promoters, A1 -> A1, H1, G2 etc.
-        platemap_df['Promoters'] = [x for x, _ in zip(seq, platemap_df['Platemap Coordinates'])] # iteration
-        platemap_df["3'UTRs"] = list(
-            itertools.chain.from_iterable(itertools.repeat(x, len(self.promoters)) for x in self.utr)) #Repeats every element in list of UTRs vertically downwards eg. 3 UTRs, A1 -> A1, B1, C1, D1, E1, F1, G1 ; B2 -> H1, A2 etc.
+        import numpy as np
+        import pandas as pd #Only needed when the platemap is wanted as a dataframe.
+        plate, well, promoter, utr = self.platemap_indices(n_promoters, n_utr)
+        #Well names and parts are only looked up from the index arrays here, so no per-well strings are built before output.
+        platemap_df = pd.DataFrame({
+            'Plate': plate + 1,
+            'Platemap Coordinates': np.array(self.well_names(), dtype=object)[well],
+            'Promoters': pd.Series(self.promoters).to_numpy()[promoter],
+            "3'UTRs": pd.Series(self.utr).to_numpy()[utr],
+        })
         return platemap_df
 
 
-def main():
+def preload_modules(): #Imports the deferred modules in a background thread while the user fills in the paths.
+    for name in DEFERRED_MODULES:
+        threading.Thread(target=importlib.import_module, args=(name,), daemon=True).start()
+
+
+def create_window(): #Builds the main window; used by main() and Startup_Benchmark_Isaac_Newtron.py.
     root = tk.Tk()
     app = Application(root)
     root.columnconfigure(0, weight=1)
     root.columnconfigure(1, weight=3)
     root.columnconfigure(2, weight=1)
+    return root
+
+
+def main():
+    root = create_window()
+    root.after_idle(preload_modules) #Only once the window has been drawn.
     root.mainloop()
 
 
@@ -7,6 +7,7 @@
 ## Golden Gate Assembly for a promoter and CDS library for Yarrowia Toolkit 
 
 from opentrons import protocol_api
+import math
 
 metadata = {
     'protocolName':'Protocol',
@@ -14,6 +15,319 @@ metadata = {
     'description':'Ally,Tom,Cathal,Will,Alex - Opentrons adventure',
     'apiLevel': '2.8'}
 
+#The liquid-handling IR of Protocol_Liquid_Handling_IR.py, copied here so that the protocol runs on its own on the robot
+#--- Protocol_Liquid_Handling_IR.py (copied into robot-ready protocols by python Protocol_Liquid_Handling_IR.py --embed) ---
+import heapq
+import math
+from collections import namedtuple
+
+Transfer = namedtuple('Transfer', ['source', 'destination', 'volume', 'tip', 'mix', 'options'], defaults=(None, None, None))
+Mix = namedtuple('Mix', ['well', 'repetitions', 'volume', 'tip'], defaults=(None,))
+Step = namedtuple('Step', ['action', 'argument'])
+Distribute = namedtuple('Distribute', ['source', 'destinations', 'volumes', 'tip', 'options'])
+
+STEP_ACTIONS = ('comment', 'pause', 'delay')
+
+
+def pipette_for(volume, pipettes):
+    """Smallest pipette (name) that can take the volume; pipettes maps names to (minimum, maximum) uL.
+    Volumes above the largest pipette go to it; the executor splits them over several aspirations."""
+    fitting = [(maximum, name) for name, (minimum, maximum) in pipettes.items() if minimum <= volume <= maximum]
+    if fitting:
+        return min(fitting)[1]
+    return max((maximum, name) for name, (_, maximum) in pipettes.items())[1]
+
+
+def wells_used(operation): #(well, kind) pairs: 'r' reads, 'w' adds to, 'm' mixes. Adding commutes, and so does reading.
+    if isinstance(operation, Transfer):
+        destination = operation.destination[:2] #The same well, whatever the height it is dispensed from.
+        used = [(operation.source[:2], 'r'), (destination, 'w')]
+        return used + [(destination, 'm')] if operation.mix else used
+    return [(operation.well[:2], 'm')]
+
+
+def dependencies(operations): #For each operation, the earlier operations it has to stay after.
+    #Per well, the history is a series of groups: several reads, several additions, or one mix. An operation joins the
+    #last group if it commutes with it, and otherwise depends on every operation of that group.
+    groups = {} #well: (kind, members, members of the group before)
+    depends = []
+    for index, operation in enumerate(operations):
+        after = set()
+        for well, kind in wells_used(operation):
+            last_kind, members, before = groups.get(well, (None, [], []))
+            if kind == last_kind and kind != 'm':
+                after.update(before)
+                members.append(index)
+            else:
+                after.update(members)
+                groups[well] = (kind, [index], members)
+        after.discard(index)
+        depends.append(after)
+    return depends
+
+
+def reorder(operations, pipettes):
+    """Reorders the operations between steps so that those sharing a pipette, tip and source follow each other.
+    An operation never moves before one it depends on, so the result is the same liquid in every well."""
+    result, segment = [], []
+    for operation in list(operations) + [None]:
+        if operation is not None and not isinstance(operation, Step):
+            segment.append(operation)
+            continue
+        depends = dependencies(segment)
+        waiting = [len(after) for after in depends]
+        followers = [[] for _ in segment]
+        for index, after in enumerate(depends):
+            for earlier in after:
+                followers[earlier].append(index)
+        ready = [index for index, count in enumerate(waiting) if count == 0]
+        heapq.heapify(ready)
+        last = None
+        while ready:
+            #Keep on with the same pipette, tip and source if possible, else take the earliest operation.
+            choice = None
+            if last is not None and last.tip is not None:
+                choice = min((index for index in ready if same_run(last, segment[index], pipettes)), default=None)
+            if choice is None:
+                choice = heapq.heappop(ready)
+            else:
+                ready.remove(choice)
+                heapq.heapify(ready)
+            last = segment[choice]
+            result.append(last)
+            for follower in followers[choice]:
+                waiting[follower] -= 1
+                if waiting[follower] == 0:
+                    heapq.heappush(ready, follower)
+        segment = []
+        if operation is not None:
+            result.append(operation)
+    return result
+
+
+def same_run(first, second, pipettes): #Can the two operations share a tip and an aspiration run?
+    return (isinstance(first, Transfer) and isinstance(second, Transfer) and first.tip is not None
+            and first.tip == second.tip and first.source == second.source and not first.mix and not second.mix
+            and first.options == second.options and pipette_for(first.volume, pipettes) == pipette_for(second.volume, pipettes))
+
+
+def merge_same_source(operations, pipettes): #Runs of transfers that share a source and a tip become one Distribute.
+    result = []
+    for operation in operations:
+        previous = result[-1] if result else None
+        if isinstance(previous, Distribute) and same_run(Transfer(previous.source, None, previous.volumes[0], previous.tip,
+                                                                  options=previous.options), operation, pipettes):
+            previous.destinations.append(operation.destination)
+            previous.volumes.append(operation.volume)
+        elif isinstance(operation, Transfer) and operation.tip is not None and not operation.mix:
+            result.append(Distribute(operation.source, [operation.destination], [operation.volume], operation.tip,
+                                     operation.options))
+        else:
+            result.append(operation)
+    return result
+
+
+def travel_order(points):
+    """Order (a list of indexes) in which to visit (x, y) points with the least travel, starting at the first one:
+    nearest neighbour, then 2-opt (reversing any stretch of the route that makes it shorter) until nothing improves."""
+    if len(points) < 3:
+        return list(range(len(points)))
+    def distance(a, b):
+        return math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+    route, left = [0], list(range(1, len(points)))
+    while left:
+        nearest = min(left, key=lambda point: distance(route[-1], point)) #Ties go to the earlier point.
+        left.remove(nearest)
+        route.append(nearest)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route) - 1):
+            for k in range(i + 1, len(route)):
+                after = route[k + 1] if k + 1 < len(route) else None
+                change = distance(route[i - 1], route[k]) - distance(route[i - 1], route[i])
+                if after is not None:
+                    change += distance(route[i], after) - distance(route[k], after)
+                if change < -1e-9:
+                    route[i:k + 1] = reversed(route[i:k + 1])
+                    improved = True
+    return route
+
+
+def order_by_travel(operations, locate):
+    """Reorders the destinations of every Distribute for the least travel from the source. They all get the same liquid
+    from the same tip, so any order gives the same result. locate maps a location to its (x, y) on the deck in mm."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Distribute) and len(operation.destinations) > 2:
+            route = travel_order([locate(operation.source)] + [locate(destination) for destination in operation.destinations])
+            order = [index - 1 for index in route[1:]]
+            operation = operation._replace(destinations=[operation.destinations[i] for i in order],
+                                           volumes=[operation.volumes[i] for i in order])
+        result.append(operation)
+    return result
+
+
+def pack_multi_dispense(operations, pipettes):
+    """Splits every Distribute into chunks that fit in one aspiration (with the pipette's minimum volume as disposal
+    volume, unless its options set disposal_volume). A chunk with a single destination is a plain Transfer again.
+    A fresh-tip Transfer too big for one aspiration is split into even ones, each with its own tip, as
+    new_tip='always' does, so a tip that has been in the destination never goes back to the source."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Transfer) and operation.tip is None:
+            maximum = pipettes[pipette_for(operation.volume, pipettes)][1]
+            strokes = math.ceil(operation.volume / maximum)
+            result += [operation._replace(volume=operation.volume / strokes)] * strokes if strokes > 1 else [operation]
+            continue
+        if not isinstance(operation, Distribute):
+            result.append(operation)
+            continue
+        minimum, maximum = pipettes[pipette_for(operation.volumes[0], pipettes)]
+        minimum = (operation.options or {}).get('disposal_volume', minimum)
+        chunk, total = [], minimum
+        for destination, volume in zip(operation.destinations, operation.volumes):
+            if chunk and total + volume > maximum:
+                result.append(chunk_operation(operation, chunk))
+                chunk, total = [], minimum
+            chunk.append((destination, volume))
+            total += volume
+        result.append(chunk_operation(operation, chunk))
+    return result
+
+
+def chunk_operation(operation, chunk):
+    if len(chunk) == 1:
+        return Transfer(operation.source, chunk[0][0], chunk[0][1], operation.tip, options=operation.options)
+    return Distribute(operation.source, [destination for destination, _ in chunk], [volume for _, volume in chunk],
+                      operation.tip, operation.options)
+
+
+def assign_tips(operations, pipettes):
+    """Lowers the operations to the executor's tuples, with a new tip only where the tip key of a pipette changes:
+        ('transfer', pipette, new_tip, source, destination, volume, mix, options)
+        ('distribute', pipette, new_tip, source, destinations, volumes, options)
+        ('mix', pipette, new_tip, well, repetitions, volume)
+        (action, argument) for steps"""
+    lowered, held = [], {}
+    for operation in operations:
+        if isinstance(operation, Step):
+            lowered.append((operation.action, operation.argument))
+            continue
+        volume = operation.volumes[0] if isinstance(operation, Distribute) else operation.volume
+        pipette = pipette_for(volume, pipettes)
+        new_tip = operation.tip is None or held.get(pipette) != operation.tip
+        held[pipette] = operation.tip
+        if isinstance(operation, Transfer):
+            lowered.append(('transfer', pipette, new_tip, operation.source, operation.destination, operation.volume,
+                            operation.mix, operation.options))
+        elif isinstance(operation, Distribute):
+            lowered.append(('distribute', pipette, new_tip, operation.source, operation.destinations, operation.volumes,
+                            operation.options))
+        else:
+            lowered.append(('mix', pipette, new_tip, operation.well, operation.repetitions, operation.volume))
+    return lowered
+
+
+def optimize(operations, pipettes, locate=None):
+    """Runs all the passes (order_by_travel only if locate is given); returns the lowered plan for execute()."""
+    operations = reorder(operations, pipettes)
+    operations = merge_same_source(operations, pipettes)
+    if locate is not None:
+        operations = order_by_travel(operations, locate)
+    operations = pack_multi_dispense(operations, pipettes)
+    return assign_tips(operations, pipettes)
+
+
+def count_tips(lowered): #Tips picked up by each pipette to run a lowered plan.
+    tips = {}
+    for action, *arguments in lowered:
+        if action not in STEP_ACTIONS:
+            tips[arguments[0]] = tips.get(arguments[0], 0) + arguments[1]
+    return tips
+
+
+def travel(lowered, locate):
+    """Gantry travel (mm) between the wells a lowered plan visits, using locate as in order_by_travel. Tip pick-ups and
+    drops are left out: they take the same travel whatever the order of the wells."""
+    total, last = 0.0, None
+    for action, *arguments in lowered:
+        if action in STEP_ACTIONS:
+            continue
+        if arguments[1]:
+            last = None
+        if action == 'mix':
+            path = [arguments[2]]
+        elif action == 'transfer':
+            path = arguments[2:4]
+        else:
+            source, destinations = arguments[2:4]
+            #A packed distribute is one aspiration: the source, then every destination in turn.
+            path = [source] + list(destinations)
+        for location in path:
+            point = locate(location)
+            if last is not None:
+                total += math.hypot(point[0] - last[0], point[1] - last[1])
+            last = point
+    return total
+
+
+def execute_step(protocol, labware, pipettes, step):
+    """Runs one step of a lowered plan; labware and pipettes map the names in the plan to the loaded objects.
+    Generated protocols carry the executor as it is (see protocol_source), so it only uses the protocol API."""
+    def well(location):
+        if len(location) < 3:
+            return labware[location[0]][location[1]]
+        if location[2] == 'top':
+            return labware[location[0]][location[1]].top()
+        return labware[location[0]][location[1]].bottom(location[2]) #Dispensed into from above the liquid.
+
+    action, *arguments = step
+    if action == 'comment':
+        protocol.comment(arguments[0])
+        return
+    if action == 'pause':
+        protocol.pause(arguments[0])
+        return
+    if action == 'delay':
+        protocol.delay(minutes=arguments[0])
+        return
+    pipette = pipettes[arguments[0]]
+    if arguments[1]:
+        if pipette.has_tip:
+            pipette.drop_tip()
+        pipette.pick_up_tip()
+    if action == 'transfer':
+        source, destination, volume, mix, options = arguments[2:]
+        settings = dict(mix_after=mix, blow_out=True, blowout_location='destination well')
+        settings.update(options or {})
+        pipette.transfer(volume, well(source), well(destination), new_tip='never', **settings)
+    elif action == 'distribute':
+        #The disposal volume is blown out into the trash: the source is a stock the tip must not bring anything back to.
+        source, destinations, volumes, options = arguments[2:]
+        settings = dict(disposal_volume=pipette.min_volume, blow_out=True, blowout_location='trash')
+        settings.update(options or {})
+        pipette.distribute(volumes, well(source), [well(destination) for destination in destinations], new_tip='never',
+                           **settings)
+    else:
+        location, repetitions, volume = arguments[2:]
+        pipette.mix(repetitions, volume, well(location))
+
+
+def drop_tips(pipettes): #At the end of a plan, the pipettes still hold the tips of its last steps.
+    for pipette in pipettes.values():
+        if pipette.has_tip:
+            pipette.drop_tip()
+
+
+def execute(protocol, labware, pipettes, plan): #Runs a whole lowered plan (see execute_step).
+    for step in plan:
+        execute_step(protocol, labware, pipettes, step)
+    drop_tips(pipettes)
+#--- end of Protocol_Liquid_Handling_IR.py ---
+
+
 def run(protocol: protocol_api.ProtocolContext):
 
     #Labware (keep aluminium block tuberack in freezer until setup)
@@ -37,129 +351,204 @@ def run(protocol: protocol_api.ProtocolContext):
     promoters = 3
     genes = 3
 
+    #tip saving: one tip per CDS, vector and reagent tube instead of one per well (the promoters still
+    #get a fresh tip for every well); cells and SOC are dispensed from the top of the wells
+    tip_saving = False
+
+    #uL of competent cells or SOC each tube of the tuberack gives (1.5 mL snapcaps)
+    tube_volume = 1400
+
+    ##well addressing - computed from the part numbers, so the library can take more than one plate
+
+    #source plate (plate1 on the heatblock): the promoters from column 1, then the CDS, then the vectors,
+    #each set down a column and on into the next one if there are more than 8
+    promoter_column = 0
+    cds_column = promoter_column + math.ceil(promoters/8)
+    vector_column = cds_column + math.ceil(genes/8)
+
+    #destination plates (in the thermocycler): every gene takes a column (more than one for more than
+    #8 promoters) with one promoter per row; genes that do not fit go on the next plates
+    columns_per_gene = math.ceil(promoters/8)
+    genes_per_plate = 12 // columns_per_gene
+    plates = math.ceil(genes/genes_per_plate)
+
+    def well_name(index):
+        #well name of a well index counted down the columns (0 = A1, 8 = A2)
+        return 'ABCDEFGH'[index % 8] + str(index // 8 + 1)
+
+    def part_well(column, n):
+        return well_name(column*8 + n)
+
+    def construct_well(promoter, gene):
+        #plate number and well of the construct of a promoter and a gene
+        plate_number, position = divmod(gene, genes_per_plate)
+        return plate_number, well_name(position*columns_per_gene*8 + promoter)
+
+    def reagent_tube(column, n, volume):
+        #the n-th well of a plate takes its reagent from the tubes down a column of the tuberack, tube_volume each
+        return ('tuberack', tuberack.columns()[column][n*volume // tube_volume].well_name)
+
+    def plate_genes_of(plate_number):
+        return range(plate_number*genes_per_plate, min(genes, (plate_number + 1)*genes_per_plate))
+
+    def check_tips(pipette):
+        #pause for new tip racks when the pipette has used them all
+        if all(rack.next_tip() is None for rack in pipette.tip_racks):
+            protocol.pause('Replace the empty tip racks of the ' + pipette.name + '.')
+            pipette.reset_tipracks()
+
+    if vector_column + math.ceil(genes/8) > 12:
+        protocol.pause('Too many parts! The promoters, CDS and vectors do not fit in the source plate.')
+
+    ##transfers - planned with Protocol_Liquid_Handling_IR.py, which gives each pipette a new tip only where it has to
+    ##and visits the wells of every multi-dispense in the order with the least gantry travel
+
+    labware = {'plate1': plate1, 'plate2': plate2, 'tuberack': tuberack}
+    pipettes = {'p20': p20, 'p300': p300}
+
+    #a fresh tip for every well, with an air gap, blown out into the trash
+    one_tip = {'air_gap': 2, 'blowout_location': 'trash'}
+
+    def locate(location):
+        #(x, y) of a well on the deck
+        point = labware[location[0]][location[1]].center().point
+        return point.x, point.y
+
+    def plan_for(operations, name, reordered=True):
+        #optimised plan of the operations with the named pipette (reordered=False keeps the wells in loop order)
+        return optimize(operations, {name: (pipettes[name].min_volume, pipettes[name].max_volume)},
+                        locate if reordered else None)
+
+    def plate_plans(plate_number, saving, reordered=True):
+        #plans of the assembly, the competent cells and the SOC of a plate
+        plate_genes = plate_genes_of(plate_number)
+
+        #define all destination wells
+        TC_all = [construct_well(i, j)[1] for j in plate_genes for i in range(promoters)]
+
+        #MasterMix into all wells
+        master_mix = [Transfer(('tuberack', 'A1'), ('plate2', well), 14, tip='master mix') for well in TC_all]
+
+        promoter_parts = [Transfer(('plate1', part_well(promoter_column, i)), ('plate2', construct_well(i, j)[1]), 2,
+                                   options=one_tip) for i in range(promoters) for j in plate_genes]
+        if not saving:
+            #promoters, then CDS, then vectors - vectors go into the same wells as CDS
+            parts = promoter_parts + [Transfer(('plate1', part_well(column, j)), ('plate2', construct_well(i, j)[1]), 2,
+                                               options=one_tip)
+                                      for column in (cds_column, vector_column) for j in plate_genes for i in range(promoters)]
+        else:
+            #CDS and vector of each gene with one tip each: the wells of a gene hold nothing but master mix
+            #and that gene's parts so far. The promoters differ from well to well, so they go in last.
+            parts = [Transfer(('plate1', part_well(column, j)), ('plate2', construct_well(i, j)[1]), 2, tip=(part, j))
+                     for j in plate_genes for column, part in ((cds_column, 'cds'), (vector_column, 'vector'))
+                     for i in range(promoters)] + promoter_parts
+
+        def reagent(column, volume):
+            #reagent from the tubes down a column of the tuberack into every well
+            if not saving:
+                return [Transfer(reagent_tube(column, n, volume), ('plate2', well), volume, options=one_tip)
+                        for n, well in enumerate(TC_all)]
+            #one tip per tube; from the top of the wells the tip never touches the constructs, and with no disposal
+            #volume or blow out each tube gives exactly volume per well
+            return [Transfer(reagent_tube(column, n, volume), ('plate2', well, 'top'), volume, tip=reagent_tube(column, n, volume),
+                             options={'disposal_volume': 0, 'blow_out': False}) for n, well in enumerate(TC_all)]
+
+        return (plan_for(master_mix, 'p300', reordered) + plan_for(parts, 'p20', reordered),
+                plan_for(reagent(1, 50), 'p300', reordered), plan_for(reagent(2, 50), 'p300', reordered))
+
+    def steps_of(plans):
+        #the steps of the plans of all the plates, in the order they are run
+        return [step for plate in plans for plan in plate for step in plan]
+
+    def run_plan(plan):
+        #does the steps of a plan, with new tip racks whenever a pipette has used them all
+        for step in plan:
+            if step[0] not in STEP_ACTIONS and step[2]:
+                check_tips(pipettes[step[1]])
+            execute_step(protocol, labware, pipettes, step)
+        drop_tips(pipettes)
+
     ##commands
 
+    plans = [plate_plans(plate_number, tip_saving) for plate_number in range(plates)]
+
+    #tip budget
+    tips = count_tips(steps_of(plans))
+    p20_tips, p300_tips = tips.get('p20', 0), tips.get('p300', 0)
+    budget = ('Note: tip budget of ' + str(p20_tips) + ' tips of 20 uL (' + str(math.ceil(p20_tips/96)) + ' rack(s)) and '
+              + str(p300_tips) + ' tips of 300 uL (' + str(math.ceil(p300_tips/96)) + ' rack(s))')
+    if tip_saving:
+        without = count_tips(steps_of([plate_plans(plate_number, False) for plate_number in range(plates)]))
+        budget += ', ' + str(sum(without.values()) - p20_tips - p300_tips) + ' fewer than without tip saving'
+    protocol.comment(budget)
+
+    #gantry travel between the wells
+    loop_order = [plate_plans(plate_number, tip_saving, reordered=False) for plate_number in range(plates)]
+    protocol.comment('Note: gantry travel between wells: ' + str(round(travel(steps_of(loop_order), locate)))
+                     + ' mm in loop order, ' + str(round(travel(steps_of(plans), locate))) + ' mm reordered')
+
     #set block to 4 degrees
     heatblock.set_temperature(4)
 
     # set the initial temperature of the thermocycler to 4
     thermocycler.set_block_temperature(4)
 
-    ##pipette into plate in thermocycler
-
-    columns = [['A1', 'B1', 'C1', 'D1', 'E1', 'F1', 'G1', 'H1'], ['A2', 'B2', 'C2', 'D2', 'E2', 'F2', 'G2', 'H2'], ['A3', 'B3', 'C3', 'D3', 'E3', 'F3', 'G3', 'H3'], ['A4', 'B4', 'C4', 'D4', 'E4', 'F4', 'G4', 'H4'], ['A5', 'B5', 'C5', 'D5', 'E5', 'F5', 'G5', 'H5'], ['A6', 'B6', 'C6', 'D6', 'E6', 'F6', 'G6', 'H6'], ['A7', 'B7', 'C7', 'D7', 'E7', 'F7', 'G7', 'H7'], ['A8', 'B8', 'C8', 'D8', 'E8', 'F8', 'G8', 'H8'], ['A9', 'B9', 'C9', 'D9', 'E9', 'F9', 'G9', 'H9'], ['A10', 'B10', 'C10', 'D10', 'E10', 'F10', 'G10', 'H10'], ['A11', 'B11', 'C11', 'D11', 'E11', 'F11', 'G11', 'H11'], ['A12', 'B12', 'C12', 'D12', 'E12', 'F12', 'G12', 'H12']]
-
-    rows = [['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12'], ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12'], ['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12'], ['D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7', 'D8', 'D9', 'D10', 'D11', 'D12'], ['E1', 'E2', 'E3', 'E4', 'E5', 'E6', 'E7', 'E8', 'E9', 'E10', 'E11', 'E12'], ['F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12'], ['G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'G7', 'G8', 'G9', 'G10', 'G11', 'G12'], ['H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7', 'H8', 'H9', 'H10', 'H11', 'H12']]
-
-    #define all destination wells
-    TC_all = []
-    for i in range(genes):
-        TC_all += columns[i][:promoters]
-
-    #define CDS and vector destination wells
-    TC_columns = []
-    for i in range(genes):
-        TC_columns.append(columns[i][:promoters])
-
-    #define promoter destination wells
-    TC_rows = []
-    for i in range(promoters):
-        TC_rows.append(rows[i][:genes])
-
-    #pipette MasterMix into all wells
-    p300.distribute(
-        14,
-        tuberack['A1'],
-        [plate2.wells_by_name()[well_name] for well_name in TC_all],
-        air_gap = 0)
-
-    #pipette promoters 
-    for i in columns[0][:promoters]:
-        for j in TC_rows[columns[0].index(i)][:]:
-            p20.transfer(
-                2,
-                plate1.wells(i),
-                plate2.wells(j),
-                air_gap = 2,
-                blow_out = True)
-
-    #pipette CDS
-    for i in columns[1][:genes]:
-        for j in TC_columns[columns[1].index(i)][:]:
-                p20.transfer(
-                2,
-                plate1.wells(i),
-                plate2.wells(j),
-                air_gap = 2,
-                blow_out = True)
-
-    #pipette vectors - vectors go into the same wells as CDS
-    for i in columns[2][:genes]:
-        for j in TC_columns[columns[2].index(i)][:]:
-                p20.transfer(
-                2,
-                plate1.wells(i),
-                plate2.wells(j),
-                air_gap = 2,
-                blow_out = True)
-
-    #run the thermocycler for assembly
-    thermocycler.close_lid()
-    thermocycler.set_lid_temperature(100)
-
-    profile = [
-        {'temperature': 37, 'hold_time_seconds': 300},
-	{'temperature': 16, 'hold_time_seconds': 300},]
-
-    thermocycler.execute_profile(steps=profile, repetitions=35, block_max_volume=20)
-
-    #heatshock for killing enzymes 
-    profile = [{'temperature': 70, 'hold_time_minutes': 10}]
-
-    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=20)
+    #the whole assembly and transformation is done for one plate at a time
+    for plate_number in range(plates):
+        if plate_number > 0:
+            protocol.pause('Plate ' + str(plate_number + 1) + ' of ' + str(plates) + ': replace the plate in the thermocycler '
+                           'with an empty one and refill the master mix (A1), competent cells (column 2) and SOC (column 3) tubes.')
+            thermocycler.set_block_temperature(4)
 
-    thermocycler.set_block_temperature(4)
+        assembly, cells, soc = plans[plate_number]
+
+        ##pipette into plate in thermocycler: MasterMix into all wells, then the promoters, CDS and vectors
+        run_plan(assembly)
+
+        #run the thermocycler for assembly
+        thermocycler.close_lid()
+        thermocycler.set_lid_temperature(100)
+
+        profile = [
+            {'temperature': 37, 'hold_time_seconds': 300},
+    	{'temperature': 16, 'hold_time_seconds': 300},]
+
+        thermocycler.execute_profile(steps=profile, repetitions=35, block_max_volume=20)
+
+        #heatshock for killing enzymes 
+        profile = [{'temperature': 70, 'hold_time_minutes': 10}]
+
+        thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=20)
+
+        thermocycler.set_block_temperature(4)
+
+        thermocycler.open_lid()
+
+        #while the thermocycler is running, put the aluminium block in the freezer to keep the competent cells cold
+
+        #pipette 50 uL of competent cells into each construct
+        run_plan(cells)
+
+        #heat shock step
+        thermocycler.close_lid()
+        thermocycler.set_lid_temperature(37)
+
+        profile = [
+            {'temperature':42, 'hold_time_seconds':45},
+            {'temperature':4, 'hold_time_minutes':1}]
+        thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
+        thermocycler.open_lid()
+
+        #recovery - add SOC into each construct+cells 
+        run_plan(soc)
+
+        thermocycler.close_lid()
+        thermocycler.set_lid_temperature(37)
 
-    thermocycler.open_lid()
-
-    #while the thermocycler is running, put the aluminium block in the freezer to keep the competent cells cold
-
-    #pipette 50 uL of competent cells into each construct
-    for j in TC_all:
-        p300.transfer(
-        50,
-        tuberack['A2'],
-        plate2.wells(j),
-        air_gap = 2,
-        blow_out = True)
-
-    #heat shock step
-    thermocycler.close_lid()
-    thermocycler.set_lid_temperature(37)
-
-    profile = [
-        {'temperature':42, 'hold_time_seconds':45},
-        {'temperature':4, 'hold_time_minutes':1}]
-    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
-    thermocycler.open_lid()
-
-    #recovery - add SOC into each construct+cells 
-    for j in TC_all:
-        p300.transfer(
-        50,
-        tuberack['A3'],
-        plate2.wells(j),
-        air_gap = 2,
-        blow_out = True)
-
-    thermocycler.close_lid()
-    thermocycler.set_lid_temperature(37)
-
-    profile = [
-        {'temperature': 37, 'hold_time_minutes': 60},]
-    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
-    thermocycler.open_lid()
-
-    #plate cells out of opentrons onto agar plate
-    #put agar plate into incubator overnight
+        profile = [
+            {'temperature': 37, 'hold_time_minutes': 60},]
+        thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
+        thermocycler.open_lid()
 
+        #plate cells out of opentrons onto agar plate
+        #put agar plate into incubator overnight
@@ -8,6 +8,16 @@ from opentrons import simulate
 metadata = {'apiLevel': '2.8'}
 protocol = simulate.get_protocol_api('2.8')
 
+#Commands are printed as they are issued; set command_log to a .jsonl file name to stream them there as
+#records (step, pipette, labware, well, volume) instead, e.g. for Protocol_Command_Log.py to query
+command_log = None
+from Protocol_Command_Log import CommandLog
+command_sink = CommandLog(protocol, command_log)
+
+import math
+import sys
+from Protocol_Liquid_Handling_IR import STEP_ACTIONS, Transfer, count_tips, drop_tips, execute_step, optimize, travel
+
 
 #Labware (keep aluminium block tuberack in freezer until setup)
 tiprack1 = protocol.load_labware('opentrons_96_tiprack_20ul', 2) 
@@ -30,132 +40,211 @@ p300 = protocol.load_instrument('p300_single_gen2', 'left', tip_racks=[tiprack2,
 promoters = 3
 genes = 3
 
+#tip saving: one tip per CDS, vector and reagent tube instead of one per well (the promoters still
+#get a fresh tip for every well); cells and SOC are dispensed from the top of the wells
+tip_saving = False
+
+#uL of competent cells or SOC each tube of the tuberack gives (1.5 mL snapcaps)
+tube_volume = 1400
+
+##well addressing - computed from the part numbers, so the library can take more than one plate
+
+#source plate (plate1 on the heatblock): the promoters from column 1, then the CDS, then the vectors,
+#each set down a column and on into the next one if there are more than 8
+promoter_column = 0
+cds_column = promoter_column + math.ceil(promoters/8)
+vector_column = cds_column + math.ceil(genes/8)
+
+#destination plates (in the thermocycler): every gene takes a column (more than one for more than
+#8 promoters) with one promoter per row; genes that do not fit go on the next plates
+columns_per_gene = math.ceil(promoters/8)
+genes_per_plate = 12 // columns_per_gene
+plates = math.ceil(genes/genes_per_plate)
+
+def well_name(index):
+    #well name of a well index counted down the columns (0 = A1, 8 = A2)
+    return 'ABCDEFGH'[index % 8] + str(index // 8 + 1)
+
+def part_well(column, n):
+    return well_name(column*8 + n)
+
+def construct_well(promoter, gene):
+    #plate number and well of the construct of a promoter and a gene
+    plate_number, position = divmod(gene, genes_per_plate)
+    return plate_number, well_name(position*columns_per_gene*8 + promoter)
+
+def reagent_tube(column, n, volume):
+    #the n-th well of a plate takes its reagent from the tubes down a column of the tuberack, tube_volume each
+    return ('tuberack', tuberack.columns()[column][n*volume // tube_volume].well_name)
+
+def plate_genes_of(plate_number):
+    return range(plate_number*genes_per_plate, min(genes, (plate_number + 1)*genes_per_plate))
+
+def check_tips(pipette):
+    #pause for new tip racks when the pipette has used them all
+    if all(rack.next_tip() is None for rack in pipette.tip_racks):
+        protocol.pause('Replace the empty tip racks of the ' + pipette.name + '.')
+        pipette.reset_tipracks()
+
+if vector_column + math.ceil(genes/8) > 12:
+    #protocol.pause('Too many parts! The promoters, CDS and vectors do not fit in the source plate.')
+    print('Too many parts! The promoters, CDS and vectors do not fit in the source plate.')
+    sys.exit()
+    # 'print' and 'sys.exit()' commands for simlation only.
+    # Use 'protocol.pause()' for real runs instead.
+
+##transfers - planned with Protocol_Liquid_Handling_IR.py, which gives each pipette a new tip only where it has to
+##and visits the wells of every multi-dispense in the order with the least gantry travel
+
+labware = {'plate1': plate1, 'plate2': plate2, 'tuberack': tuberack}
+pipettes = {'p20': p20, 'p300': p300}
+
+#a fresh tip for every well, with an air gap, blown out into the trash
+one_tip = {'air_gap': 2, 'blowout_location': 'trash'}
+
+def locate(location):
+    #(x, y) of a well on the deck
+    point = labware[location[0]][location[1]].center().point
+    return point.x, point.y
+
+def plan_for(operations, name, reordered=True):
+    #optimised plan of the operations with the named pipette (reordered=False keeps the wells in loop order)
+    return optimize(operations, {name: (pipettes[name].min_volume, pipettes[name].max_volume)},
+                    locate if reordered else None)
+
+def plate_plans(plate_number, saving, reordered=True):
+    #plans of the assembly, the competent cells and the SOC of a plate
+    plate_genes = plate_genes_of(plate_number)
+
+    #define all destination wells
+    TC_all = [construct_well(i, j)[1] for j in plate_genes for i in range(promoters)]
+
+    #MasterMix into all wells
+    master_mix = [Transfer(('tuberack', 'A1'), ('plate2', well), 14, tip='master mix') for well in TC_all]
+
+    promoter_parts = [Transfer(('plate1', part_well(promoter_column, i)), ('plate2', construct_well(i, j)[1]), 2,
+                               options=one_tip) for i in range(promoters) for j in plate_genes]
+    if not saving:
+        #promoters, then CDS, then vectors - vectors go into the same wells as CDS
+        parts = promoter_parts + [Transfer(('plate1', part_well(column, j)), ('plate2', construct_well(i, j)[1]), 2,
+                                           options=one_tip)
+                                  for column in (cds_column, vector_column) for j in plate_genes for i in range(promoters)]
+    else:
+        #CDS and vector of each gene with one tip each: the wells of a gene hold nothing but master mix
+        #and that gene's parts so far. The promoters differ from well to well, so they go in last.
+        parts = [Transfer(('plate1', part_well(column, j)), ('plate2', construct_well(i, j)[1]), 2, tip=(part, j))
+                 for j in plate_genes for column, part in ((cds_column, 'cds'), (vector_column, 'vector'))
+                 for i in range(promoters)] + promoter_parts
+
+    def reagent(column, volume):
+        #reagent from the tubes down a column of the tuberack into every well
+        if not saving:
+            return [Transfer(reagent_tube(column, n, volume), ('plate2', well), volume, options=one_tip)
+                    for n, well in enumerate(TC_all)]
+        #one tip per tube; from the top of the wells the tip never touches the constructs, and with no disposal
+        #volume or blow out each tube gives exactly volume per well
+        return [Transfer(reagent_tube(column, n, volume), ('plate2', well, 'top'), volume, tip=reagent_tube(column, n, volume),
+                         options={'disposal_volume': 0, 'blow_out': False}) for n, well in enumerate(TC_all)]
+
+    return (plan_for(master_mix, 'p300', reordered) + plan_for(parts, 'p20', reordered),
+            plan_for(reagent(1, 50), 'p300', reordered), plan_for(reagent(2, 50), 'p300', reordered))
+
+def steps_of(plans):
+    #the steps of the plans of all the plates, in the order they are run
+    return [step for plate in plans for plan in plate for step in plan]
+
+def run_plan(plan):
+    #does the steps of a plan, with new tip racks whenever a pipette has used them all
+    for step in plan:
+        if step[0] not in STEP_ACTIONS and step[2]:
+            check_tips(pipettes[step[1]])
+        execute_step(protocol, labware, pipettes, step)
+    drop_tips(pipettes)
+
 ##commands
 
+plans = [plate_plans(plate_number, tip_saving) for plate_number in range(plates)]
+
+#tip budget
+tips = count_tips(steps_of(plans))
+p20_tips, p300_tips = tips.get('p20', 0), tips.get('p300', 0)
+budget = ('Note: tip budget of ' + str(p20_tips) + ' tips of 20 uL (' + str(math.ceil(p20_tips/96)) + ' rack(s)) and '
+          + str(p300_tips) + ' tips of 300 uL (' + str(math.ceil(p300_tips/96)) + ' rack(s))')
+if tip_saving:
+    without = count_tips(steps_of([plate_plans(plate_number, False) for plate_number in range(plates)]))
+    budget += ', ' + str(sum(without.values()) - p20_tips - p300_tips) + ' fewer than without tip saving'
+protocol.comment(budget)
+
+#gantry travel between the wells
+loop_order = [plate_plans(plate_number, tip_saving, reordered=False) for plate_number in range(plates)]
+protocol.comment('Note: gantry travel between wells: ' + str(round(travel(steps_of(loop_order), locate)))
+                 + ' mm in loop order, ' + str(round(travel(steps_of(plans), locate))) + ' mm reordered')
+
 #set block to 4 degrees
 heatblock.set_temperature(4)
 
 # set the initial temperature of the thermocycler to 4
 thermocycler.set_block_temperature(4)
 
-##pipette into plate in thermocycler
-
-columns = [['A1', 'B1', 'C1', 'D1', 'E1', 'F1', 'G1', 'H1'], ['A2', 'B2', 'C2', 'D2', 'E2', 'F2', 'G2', 'H2'], ['A3', 'B3', 'C3', 'D3', 'E3', 'F3', 'G3', 'H3'], ['A4', 'B4', 'C4', 'D4', 'E4', 'F4', 'G4', 'H4'], ['A5', 'B5', 'C5', 'D5', 'E5', 'F5', 'G5', 'H5'], ['A6', 'B6', 'C6', 'D6', 'E6', 'F6', 'G6', 'H6'], ['A7', 'B7', 'C7', 'D7', 'E7', 'F7', 'G7', 'H7'], ['A8', 'B8', 'C8', 'D8', 'E8', 'F8', 'G8', 'H8'], ['A9', 'B9', 'C9', 'D9', 'E9', 'F9', 'G9', 'H9'], ['A10', 'B10', 'C10', 'D10', 'E10', 'F10', 'G10', 'H10'], ['A11', 'B11', 'C11', 'D11', 'E11', 'F11', 'G11', 'H11'], ['A12', 'B12', 'C12', 'D12', 'E12', 'F12', 'G12', 'H12']]
-
-rows = [['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12'], ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12'], ['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12'], ['D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7', 'D8', 'D9', 'D10', 'D11', 'D12'], ['E1', 'E2', 'E3', 'E4', 'E5', 'E6', 'E7', 'E8', 'E9', 'E10', 'E11', 'E12'], ['F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12'], ['G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'G7', 'G8', 'G9', 'G10', 'G11', 'G12'], ['H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7', 'H8', 'H9', 'H10', 'H11', 'H12']]
-
-#define all destination wells
-TC_all = []
-for i in range(genes):
-    TC_all += columns[i][:promoters]
-
-#define CDS and vector destination wells
-TC_columns = []
-for i in range(genes):
-    TC_columns.append(columns[i][:promoters])
-
-#define promoter destination wells
-TC_rows = []
-for i in range(promoters):
-    TC_rows.append(rows[i][:genes])
-
-#pipette MasterMix into all wells
-p300.distribute(
-    14,
-    tuberack['A1'],
-    [plate2.wells_by_name()[well_name] for well_name in TC_all],
-    air_gap = 0)
-
-#pipette promoters 
-for i in columns[0][:promoters]:
-    for j in TC_rows[columns[0].index(i)][:]:
-        p20.transfer(
-            2,
-            plate1.wells(i),
-            plate2.wells(j),
-            air_gap = 2,
-            blow_out = True)
-
-#pipette CDS
-for i in columns[1][:genes]:
-    for j in TC_columns[columns[1].index(i)][:]:
-            p20.transfer(
-            2,
-            plate1.wells(i),
-            plate2.wells(j),
-            air_gap = 2,
-            blow_out = True)
-
-#pipette vectors - vectors go into the same wells as CDS
-for i in columns[2][:genes]:
-    for j in TC_columns[columns[2].index(i)][:]:
-            p20.transfer(
-            2,
-            plate1.wells(i),
-            plate2.wells(j),
-            air_gap = 2,
-            blow_out = True)
-
-#run the thermocycler for assembly
-thermocycler.close_lid()
-thermocycler.set_lid_temperature(100)
-
-profile = [
-    {'temperature': 37, 'hold_time_seconds': 300},
-{'temperature': 16, 'hold_time_seconds': 300},]
-
-thermocycler.execute_profile(steps=profile, repetitions=35, block_max_volume=20)
-
-#heatshock for killing enzymes 
-profile = [{'temperature': 70, 'hold_time_minutes': 10}]
-
-thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=20)
+#the whole assembly and transformation is done for one plate at a time
+for plate_number in range(plates):
+    if plate_number > 0:
+        protocol.pause('Plate ' + str(plate_number + 1) + ' of ' + str(plates) + ': replace the plate in the thermocycler '
+                       'with an empty one and refill the master mix (A1), competent cells (column 2) and SOC (column 3) tubes.')
+        thermocycler.set_block_temperature(4)
 
-thermocycler.set_block_temperature(4)
+    assembly, cells, soc = plans[plate_number]
+
+    ##pipette into plate in thermocycler: MasterMix into all wells, then the promoters, CDS and vectors
+    run_plan(assembly)
+
+    #run the thermocycler for assembly
+    thermocycler.close_lid()
+    thermocycler.set_lid_temperature(100)
+
+    profile = [
+        {'temperature': 37, 'hold_time_seconds': 300},
+    {'temperature': 16, 'hold_time_seconds': 300},]
+
+    thermocycler.execute_profile(steps=profile, repetitions=35, block_max_volume=20)
+
+    #heatshock for killing enzymes 
+    profile = [{'temperature': 70, 'hold_time_minutes': 10}]
+
+    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=20)
+
+    thermocycler.set_block_temperature(4)
+
+    thermocycler.open_lid()
+
+    #while the thermocycler is running, put the aluminium block in the freezer to keep the competent cells cold
+
+    #pipette 50 uL of competent cells into each construct
+    run_plan(cells)
+
+    #heat shock step
+    thermocycler.close_lid()
+    thermocycler.set_lid_temperature(37)
+
+    profile = [
+        {'temperature':42, 'hold_time_seconds':45},
+        {'temperature':4, 'hold_time_minutes':1}]
+    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
+    thermocycler.open_lid()
+
+    #recovery - add SOC into each construct+cells 
+    run_plan(soc)
+
+    thermocycler.close_lid()
+    thermocycler.set_lid_temperature(37)
+
+    profile = [
+        {'temperature': 37, 'hold_time_minutes': 60},]
+    thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
+    thermocycler.open_lid()
+
+    #plate cells out of opentrons onto agar plate
+    #put agar plate into incubator overnight
 
-thermocycler.open_lid()
-
-#while the thermocycler is running, put the aluminium block in the freezer to keep the competent cells cold
-
-#pipette 50 uL of competent cells into each construct
-for j in TC_all:
-    p300.transfer(
-    50,
-    tuberack['A2'],
-    plate2.wells(j),
-    air_gap = 2,
-    blow_out = True)
-
-#heat shock step
-thermocycler.close_lid()
-thermocycler.set_lid_temperature(37)
-
-profile = [
-    {'temperature':42, 'hold_time_seconds':45},
-    {'temperature':4, 'hold_time_minutes':1}]
-thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
-thermocycler.open_lid()
-
-#recovery - add SOC into each construct+cells 
-for j in TC_all:
-    p300.transfer(
-    50,
-    tuberack['A3'],
-    plate2.wells(j),
-    air_gap = 2,
-    blow_out = True)
-
-thermocycler.close_lid()
-thermocycler.set_lid_temperature(37)
-
-profile = [
-    {'temperature': 37, 'hold_time_minutes': 60},]
-thermocycler.execute_profile(steps=profile, repetitions=1, block_max_volume=60)
-thermocycler.open_lid()
-
-#plate cells out of opentrons onto agar plate
-#put agar plate into incubator overnight
-
-for line in protocol.commands(): 
-    print(line)
+command_sink.close()
 
@@ -10,12 +10,19 @@ oligos_resusp_concentration = 100
 # Desired concentrations in the salt gradient (mM)
 test_gradient = [0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22]
 
-# Number of replicates per gradient step
+# Number of replicates per gradient step (more than 8 take more than one column)
 replicates = 8
 
 # Concentration of salt Stock (mM)
 salt_conc = 40
 
+# Desired concentrations of a second salt (mM), to screen a grid of both salts
+# (e.g. Mg2+ x Na+). Leave empty for a single gradient. Stock in reservoir column 3.
+test_gradient_2 = []
+
+# Concentration of the second salt stock (mM)
+salt_conc_2 = 1000
+
 # Total volume in each well of the final assembled plate (ul)
 total_rxn_vol = 40
 
@@ -25,6 +32,15 @@ scaffold = True
 # Concentration of scaffold strand in the stock (nM)
 scaffold_conc = 100
 
+# Fill the plate a whole column (8 replicates) at a time with an 8-channel P20?
+# Needs the P20 8-channel on the right mount, 8 replicates and an empty 96-well
+# PCR plate in slot 2 for the oligo mix.
+multichannel = False
+
+# With several plates, prepare the next plate while the current one anneals.
+# Needs an empty 96-well PCR plate in slot 11 and a third 20 ul tip rack in slot 8.
+pipeline_plates = True
+
 
 #-------------------------------------------------------------------------------
 #-------------------------------------------------------------------------------
@@ -33,6 +49,7 @@ scaffold_conc = 100
 from opentrons import protocol_api
 import math
 import sys
+import time
 
 
 
@@ -44,11 +61,43 @@ n_oligos = len(oligos_nmol)
 # Volume that the oligos need to be resuspended in to reach the desired concentration
 volume_added_to_oligos = [round(x / oligos_resusp_concentration * 1000) for x in oligos_nmol]
 
+# Salt conditions: every combination of the two gradients
+conditions = [(i, j) for i in test_gradient for j in (test_gradient_2 or [0])]
+
+# Plate layout: each condition takes a column (more than one for more than 8
+# replicates). Conditions that do not fit in one plate go on the next plates,
+# which are prepared and annealed one after another on the temperature module.
+columns_per_condition = math.ceil(replicates/8)
+conditions_per_plate = 12//columns_per_condition
+plates = [conditions[k:k+conditions_per_plate] for k in range(0, len(conditions), conditions_per_plate)]
+
+# The next plate is prepared in slot 11 while the current one anneals, then
+# moved onto the temperature module
+pipelined = pipeline_plates and len(plates) > 1
+
 # Volume of oligo mix that needs to be added to each well in the final plate
 mix_vol_single = total_rxn_vol/4
 
-# Total volume of oligo mix that needs to be prepared to cover all wells
-mix_volume = mix_vol_single * len(test_gradient) * replicates
+# Oligo mix left over in each mix plate well (multichannel mode), so the P20
+# multi does not draw air on the last columns
+mixplate_dead_volume = 10
+
+# The oligo mix is prepared once for all plates, in as many final tubes as
+# needed (up to 1400 ul each); each plate takes its mix from one of them
+final_tube_of_plate = []
+final_tube_volumes = [0]
+for plate in plates:
+    plate_mix = mix_vol_single * len(plate) * replicates
+    if multichannel:
+        plate_mix += mixplate_dead_volume * 8
+    if final_tube_volumes[-1] + plate_mix > 1400 and final_tube_volumes[-1] > 0:
+        final_tube_volumes.append(0)
+    final_tube_volumes[-1] += plate_mix
+    final_tube_of_plate.append(len(final_tube_volumes) - 1)
+n_final_tubes = len(final_tube_volumes)
+
+# Total volume of oligo mix that needs to be prepared in each final tube
+mix_volume = max(final_tube_volumes)
 mix_volume_rounded = math.ceil(mix_volume/100)*100
 
 # Volume of scaffold that needs to be added to final mix (uL)
@@ -56,14 +105,17 @@ scaffold_in_mix = mix_volume_rounded/(scaffold_conc/(40))
 
 # Calculate volumes of salt and buffer to create the gradient
 salt_in = []
+salt2_in = []
 buffer_in = []
 
-for i in test_gradient:
+for i, j in conditions:
     mg = ((i * total_rxn_vol) / salt_conc)
     salt_in.append(mg)
+    na = ((j * total_rxn_vol) / salt_conc_2)
+    salt2_in.append(na)
 
     # Add buffer to make up to total rxn volume (+ oligo mix)
-    buff = (total_rxn_vol - mg - mix_vol_single)
+    buff = (total_rxn_vol - mg - na - mix_vol_single)
     buffer_in.append(buff)
 
 
@@ -75,15 +127,20 @@ if salt_conc < max(test_gradient):
     #print('The concentration of the salt stock provided is too low to cover the gradient.')
     #sys.exit()
 
-# Check if number of replicates and gradient size is within the limits
-if replicates > 8:
-    protocol.pause('Too many repliactes! We cannot fit more than 8 replicates in a plate.')
-    #print('Too many repliactes! We cannot fit more than 8 replicates in a plate.')
+if test_gradient_2 and salt_conc_2 < max(test_gradient_2):
+    protocol.pause('The concentration of the second salt stock provided is too low to cover its gradient.')
+    #print('The concentration of the second salt stock provided is too low to cover its gradient.')
     #sys.exit()
 
-if len(test_gradient) > 12:
-    protocol.pause('Too many salt conditions! We cannot fit a salt gradient with more than 12 steps in a single plate.')
-    #print('Too many salt conditions! We cannot fit a salt gradient with more than 12 steps in a single plate.')
+if multichannel and replicates != 8:
+    protocol.pause('Multichannel mode fills whole columns: set replicates to 8.')
+    #print('Multichannel mode fills whole columns: set replicates to 8.')
+    #sys.exit()
+
+# Check the number of plates
+if n_final_tubes > 4:
+    protocol.pause('Too many plates! The oligo mix cannot be prepared for more than 4 final tubes at once.')
+    #print('Too many plates! The oligo mix cannot be prepared for more than 4 final tubes at once.')
     #sys.exit()
 
 # Check oligo mix volumes
@@ -108,6 +165,320 @@ metadata = {
     'apiLevel': '2.11'
 }
 
+# The liquid-handling IR of Protocol_Liquid_Handling_IR.py, copied here so that
+# the protocol runs on its own on the robot
+#--- Protocol_Liquid_Handling_IR.py (copied into robot-ready protocols by python Protocol_Liquid_Handling_IR.py --embed) ---
+import heapq
+import math
+from collections import namedtuple
+
+Transfer = namedtuple('Transfer', ['source', 'destination', 'volume', 'tip', 'mix', 'options'], defaults=(None, None, None))
+Mix = namedtuple('Mix', ['well', 'repetitions', 'volume', 'tip'], defaults=(None,))
+Step = namedtuple('Step', ['action', 'argument'])
+Distribute = namedtuple('Distribute', ['source', 'destinations', 'volumes', 'tip', 'options'])
+
+STEP_ACTIONS = ('comment', 'pause', 'delay')
+
+
+def pipette_for(volume, pipettes):
+    """Smallest pipette (name) that can take the volume; pipettes maps names to (minimum, maximum) uL.
+    Volumes above the largest pipette go to it; the executor splits them over several aspirations."""
+    fitting = [(maximum, name) for name, (minimum, maximum) in pipettes.items() if minimum <= volume <= maximum]
+    if fitting:
+        return min(fitting)[1]
+    return max((maximum, name) for name, (_, maximum) in pipettes.items())[1]
+
+
+def wells_used(operation): #(well, kind) pairs: 'r' reads, 'w' adds to, 'm' mixes. Adding commutes, and so does reading.
+    if isinstance(operation, Transfer):
+        destination = operation.destination[:2] #The same well, whatever the height it is dispensed from.
+        used = [(operation.source[:2], 'r'), (destination, 'w')]
+        return used + [(destination, 'm')] if operation.mix else used
+    return [(operation.well[:2], 'm')]
+
+
+def dependencies(operations): #For each operation, the earlier operations it has to stay after.
+    #Per well, the history is a series of groups: several reads, several additions, or one mix. An operation joins the
+    #last group if it commutes with it, and otherwise depends on every operation of that group.
+    groups = {} #well: (kind, members, members of the group before)
+    depends = []
+    for index, operation in enumerate(operations):
+        after = set()
+        for well, kind in wells_used(operation):
+            last_kind, members, before = groups.get(well, (None, [], []))
+            if kind == last_kind and kind != 'm':
+                after.update(before)
+                members.append(index)
+            else:
+                after.update(members)
+                groups[well] = (kind, [index], members)
+        after.discard(index)
+        depends.append(after)
+    return depends
+
+
+def reorder(operations, pipettes):
+    """Reorders the operations between steps so that those sharing a pipette, tip and source follow each other.
+    An operation never moves before one it depends on, so the result is the same liquid in every well."""
+    result, segment = [], []
+    for operation in list(operations) + [None]:
+        if operation is not None and not isinstance(operation, Step):
+            segment.append(operation)
+            continue
+        depends = dependencies(segment)
+        waiting = [len(after) for after in depends]
+        followers = [[] for _ in segment]
+        for index, after in enumerate(depends):
+            for earlier in after:
+                followers[earlier].append(index)
+        ready = [index for index, count in enumerate(waiting) if count == 0]
+        heapq.heapify(ready)
+        last = None
+        while ready:
+            #Keep on with the same pipette, tip and source if possible, else take the earliest operation.
+            choice = None
+            if last is not None and last.tip is not None:
+                choice = min((index for index in ready if same_run(last, segment[index], pipettes)), default=None)
+            if choice is None:
+                choice = heapq.heappop(ready)
+            else:
+                ready.remove(choice)
+                heapq.heapify(ready)
+            last = segment[choice]
+            result.append(last)
+            for follower in followers[choice]:
+                waiting[follower] -= 1
+                if waiting[follower] == 0:
+                    heapq.heappush(ready, follower)
+        segment = []
+        if operation is not None:
+            result.append(operation)
+    return result
+
+
+def same_run(first, second, pipettes): #Can the two operations share a tip and an aspiration run?
+    return (isinstance(first, Transfer) and isinstance(second, Transfer) and first.tip is not None
+            and first.tip == second.tip and first.source == second.source and not first.mix and not second.mix
+            and first.options == second.options and pipette_for(first.volume, pipettes) == pipette_for(second.volume, pipettes))
+
+
+def merge_same_source(operations, pipettes): #Runs of transfers that share a source and a tip become one Distribute.
+    result = []
+    for operation in operations:
+        previous = result[-1] if result else None
+        if isinstance(previous, Distribute) and same_run(Transfer(previous.source, None, previous.volumes[0], previous.tip,
+                                                                  options=previous.options), operation, pipettes):
+            previous.destinations.append(operation.destination)
+            previous.volumes.append(operation.volume)
+        elif isinstance(operation, Transfer) and operation.tip is not None and not operation.mix:
+            result.append(Distribute(operation.source, [operation.destination], [operation.volume], operation.tip,
+                                     operation.options))
+        else:
+            result.append(operation)
+    return result
+
+
+def travel_order(points):
+    """Order (a list of indexes) in which to visit (x, y) points with the least travel, starting at the first one:
+    nearest neighbour, then 2-opt (reversing any stretch of the route that makes it shorter) until nothing improves."""
+    if len(points) < 3:
+        return list(range(len(points)))
+    def distance(a, b):
+        return math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+    route, left = [0], list(range(1, len(points)))
+    while left:
+        nearest = min(left, key=lambda point: distance(route[-1], point)) #Ties go to the earlier point.
+        left.remove(nearest)
+        route.append(nearest)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route) - 1):
+            for k in range(i + 1, len(route)):
+                after = route[k + 1] if k + 1 < len(route) else None
+                change = distance(route[i - 1], route[k]) - distance(route[i - 1], route[i])
+                if after is not None:
+                    change += distance(route[i], after) - distance(route[k], after)
+                if change < -1e-9:
+                    route[i:k + 1] = reversed(route[i:k + 1])
+                    improved = True
+    return route
+
+
+def order_by_travel(operations, locate):
+    """Reorders the destinations of every Distribute for the least travel from the source. They all get the same liquid
+    from the same tip, so any order gives the same result. locate maps a location to its (x, y) on the deck in mm."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Distribute) and len(operation.destinations) > 2:
+            route = travel_order([locate(operation.source)] + [locate(destination) for destination in operation.destinations])
+            order = [index - 1 for index in route[1:]]
+            operation = operation._replace(destinations=[operation.destinations[i] for i in order],
+                                           volumes=[operation.volumes[i] for i in order])
+        result.append(operation)
+    return result
+
+
+def pack_multi_dispense(operations, pipettes):
+    """Splits every Distribute into chunks that fit in one aspiration (with the pipette's minimum volume as disposal
+    volume, unless its options set disposal_volume). A chunk with a single destination is a plain Transfer again.
+    A fresh-tip Transfer too big for one aspiration is split into even ones, each with its own tip, as
+    new_tip='always' does, so a tip that has been in the destination never goes back to the source."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Transfer) and operation.tip is None:
+            maximum = pipettes[pipette_for(operation.volume, pipettes)][1]
+            strokes = math.ceil(operation.volume / maximum)
+            result += [operation._replace(volume=operation.volume / strokes)] * strokes if strokes > 1 else [operation]
+            continue
+        if not isinstance(operation, Distribute):
+            result.append(operation)
+            continue
+        minimum, maximum = pipettes[pipette_for(operation.volumes[0], pipettes)]
+        minimum = (operation.options or {}).get('disposal_volume', minimum)
+        chunk, total = [], minimum
+        for destination, volume in zip(operation.destinations, operation.volumes):
+            if chunk and total + volume > maximum:
+                result.append(chunk_operation(operation, chunk))
+                chunk, total = [], minimum
+            chunk.append((destination, volume))
+            total += volume
+        result.append(chunk_operation(operation, chunk))
+    return result
+
+
+def chunk_operation(operation, chunk):
+    if len(chunk) == 1:
+        return Transfer(operation.source, chunk[0][0], chunk[0][1], operation.tip, options=operation.options)
+    return Distribute(operation.source, [destination for destination, _ in chunk], [volume for _, volume in chunk],
+                      operation.tip, operation.options)
+
+
+def assign_tips(operations, pipettes):
+    """Lowers the operations to the executor's tuples, with a new tip only where the tip key of a pipette changes:
+        ('transfer', pipette, new_tip, source, destination, volume, mix, options)
+        ('distribute', pipette, new_tip, source, destinations, volumes, options)
+        ('mix', pipette, new_tip, well, repetitions, volume)
+        (action, argument) for steps"""
+    lowered, held = [], {}
+    for operation in operations:
+        if isinstance(operation, Step):
+            lowered.append((operation.action, operation.argument))
+            continue
+        volume = operation.volumes[0] if isinstance(operation, Distribute) else operation.volume
+        pipette = pipette_for(volume, pipettes)
+        new_tip = operation.tip is None or held.get(pipette) != operation.tip
+        held[pipette] = operation.tip
+        if isinstance(operation, Transfer):
+            lowered.append(('transfer', pipette, new_tip, operation.source, operation.destination, operation.volume,
+                            operation.mix, operation.options))
+        elif isinstance(operation, Distribute):
+            lowered.append(('distribute', pipette, new_tip, operation.source, operation.destinations, operation.volumes,
+                            operation.options))
+        else:
+            lowered.append(('mix', pipette, new_tip, operation.well, operation.repetitions, operation.volume))
+    return lowered
+
+
+def optimize(operations, pipettes, locate=None):
+    """Runs all the passes (order_by_travel only if locate is given); returns the lowered plan for execute()."""
+    operations = reorder(operations, pipettes)
+    operations = merge_same_source(operations, pipettes)
+    if locate is not None:
+        operations = order_by_travel(operations, locate)
+    operations = pack_multi_dispense(operations, pipettes)
+    return assign_tips(operations, pipettes)
+
+
+def count_tips(lowered): #Tips picked up by each pipette to run a lowered plan.
+    tips = {}
+    for action, *arguments in lowered:
+        if action not in STEP_ACTIONS:
+            tips[arguments[0]] = tips.get(arguments[0], 0) + arguments[1]
+    return tips
+
+
+def travel(lowered, locate):
+    """Gantry travel (mm) between the wells a lowered plan visits, using locate as in order_by_travel. Tip pick-ups and
+    drops are left out: they take the same travel whatever the order of the wells."""
+    total, last = 0.0, None
+    for action, *arguments in lowered:
+        if action in STEP_ACTIONS:
+            continue
+        if arguments[1]:
+            last = None
+        if action == 'mix':
+            path = [arguments[2]]
+        elif action == 'transfer':
+            path = arguments[2:4]
+        else:
+            source, destinations = arguments[2:4]
+            #A packed distribute is one aspiration: the source, then every destination in turn.
+            path = [source] + list(destinations)
+        for location in path:
+            point = locate(location)
+            if last is not None:
+                total += math.hypot(point[0] - last[0], point[1] - last[1])
+            last = point
+    return total
+
+
+def execute_step(protocol, labware, pipettes, step):
+    """Runs one step of a lowered plan; labware and pipettes map the names in the plan to the loaded objects.
+    Generated protocols carry the executor as it is (see protocol_source), so it only uses the protocol API."""
+    def well(location):
+        if len(location) < 3:
+            return labware[location[0]][location[1]]
+        if location[2] == 'top':
+            return labware[location[0]][location[1]].top()
+        return labware[location[0]][location[1]].bottom(location[2]) #Dispensed into from above the liquid.
+
+    action, *arguments = step
+    if action == 'comment':
+        protocol.comment(arguments[0])
+        return
+    if action == 'pause':
+        protocol.pause(arguments[0])
+        return
+    if action == 'delay':
+        protocol.delay(minutes=arguments[0])
+        return
+    pipette = pipettes[arguments[0]]
+    if arguments[1]:
+        if pipette.has_tip:
+            pipette.drop_tip()
+        pipette.pick_up_tip()
+    if action == 'transfer':
+        source, destination, volume, mix, options = arguments[2:]
+        settings = dict(mix_after=mix, blow_out=True, blowout_location='destination well')
+        settings.update(options or {})
+        pipette.transfer(volume, well(source), well(destination), new_tip='never', **settings)
+    elif action == 'distribute':
+        #The disposal volume is blown out into the trash: the source is a stock the tip must not bring anything back to.
+        source, destinations, volumes, options = arguments[2:]
+        settings = dict(disposal_volume=pipette.min_volume, blow_out=True, blowout_location='trash')
+        settings.update(options or {})
+        pipette.distribute(volumes, well(source), [well(destination) for destination in destinations], new_tip='never',
+                           **settings)
+    else:
+        location, repetitions, volume = arguments[2:]
+        pipette.mix(repetitions, volume, well(location))
+
+
+def drop_tips(pipettes): #At the end of a plan, the pipettes still hold the tips of its last steps.
+    for pipette in pipettes.values():
+        if pipette.has_tip:
+            pipette.drop_tip()
+
+
+def execute(protocol, labware, pipettes, plan): #Runs a whole lowered plan (see execute_step).
+    for step in plan:
+        execute_step(protocol, labware, pipettes, step)
+    drop_tips(pipettes)
+#--- end of Protocol_Liquid_Handling_IR.py ---
+
+
 def run(protocol: protocol_api.ProtocolContext):
 
     # Define labware
@@ -127,109 +498,152 @@ def run(protocol: protocol_api.ProtocolContext):
     tempdeck = protocol.load_module('tempdeck', 10)
     tempplate = tempdeck.load_labware('opentrons_96_aluminumblock_biorad_wellplate_200ul', label='Temperature-Controlled Tubes')
 
+    p20_tipracks = [tiprack_2, tiprack_3]
+    if pipelined:
+        # The next plate is pipetted before the tip racks are refilled
+        p20_tipracks.append(protocol.load_labware('opentrons_96_tiprack_20ul', 8))
+        stagingplate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 11)
+
     # Pipettes
     p300 = protocol.load_instrument('p300_single_gen2',  'left', tip_racks=[tiprack_1])
-    p20 = protocol.load_instrument('p20_single_gen2', 'right', tip_racks = [tiprack_2, tiprack_3])
+    if multichannel:
+        p20 = protocol.load_instrument('p20_multi_gen2', 'right', tip_racks = p20_tipracks)
+        # Oligo mix laid out in column 1, one well per plate row
+        mixplate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 2)
+    else:
+        p20 = protocol.load_instrument('p20_single_gen2', 'right', tip_racks = p20_tipracks)
+
+    # When a pipette runs out of tips, pause for fresh racks just before it picks
+    # up the next one (it never holds a tip then) instead of stopping the run
+    def pause_when_empty(pipette):
+        def checked(method, takes_tips):
+            def call(*args, **kwargs):
+                if takes_tips(args, kwargs) and all(rack.next_tip(pipette.channels) is None for rack in pipette.tip_racks):
+                    protocol.pause('Replace the empty tip racks of the ' + pipette.name + ' (slot(s) '
+                                   + ', '.join(str(rack.parent) for rack in pipette.tip_racks) + ') with full ones.')
+                    pipette.reset_tipracks()
+                return method(*args, **kwargs)
+            return call
+        # transfer() and co. look for a free tip before picking any up
+        pipette.pick_up_tip = checked(pipette.pick_up_tip, lambda args, kwargs: not args and not kwargs)
+        for name in ('transfer', 'distribute', 'consolidate'):
+            setattr(pipette, name, checked(getattr(pipette, name), lambda args, kwargs: kwargs.get('new_tip') != 'never'))
+
+    pause_when_empty(p300)
+    pause_when_empty(p20)
+
+    # The liquid handling is planned with Protocol_Liquid_Handling_IR.py: each step
+    # lists its transfers, which are optimised (multi-dispensed where they share a
+    # tip) and run from the names below
+    labware = {'reservoir': reservoir, 'tuberack': tuberack, 'tuberack2': tuberack2, 'tuberack3': tuberack3,
+               'tempplate': tempplate}
+    if pipelined:
+        labware['stagingplate'] = stagingplate
+    if multichannel:
+        labware['mixplate'] = mixplate
+    pipettes = {'p300': p300, 'p20': p20}
+
+    def at(name, index):
+        # Location of a well of a labware (index as in .wells(), down the columns)
+        return (name, labware[name].wells()[index].well_name)
+
+    def plan_for(operations, *names):
+        # Optimised plan of the operations with the named pipettes only
+        return optimize(operations, {name: (pipettes[name].min_volume, pipettes[name].max_volume) for name in names})
 
 
     #Step 1 - Resuspend oligos in standard buffer
     # to a uniform concentration to 100 uM
 
-    p300.transfer(volume_added_to_oligos,
-                  reservoir.columns()[0],
-                  tuberack.wells()[0:n_oligos],
-                  mix_after=(10, 100),
-                  touch_tip=True,
-                  blow_out= True,
-                  blowout_location= 'destination well',
-                  new_tip= 'always')
+    # A fresh tip for every tube; the tip touches the side of the tube after mixing
+    resuspension = [Transfer(('reservoir', 'A1'), at('tuberack', n), volume, mix=(10, 100), options={'touch_tip': True})
+                    for n, volume in enumerate(volume_added_to_oligos)]
+    execute(protocol, labware, pipettes, plan_for(resuspension, 'p300'))
 
     # Let the oligos dissolve while preparing the gradient in the plate
 
 
-    # Step 2 - Prepare 96-well plate with single gradient
-
-    # Step 2.1 - Buffer
-
-    # It only picks up the tips necessary to cover the volumes it's going
-    # to pipette
-    if min(buffer_in) > 20:
-        p300.pick_up_tip()
-    elif max(buffer_in) <= 20:
-        p20.pick_up_tip()
-    else:
-        p300.pick_up_tip()
-        p20.pick_up_tip()
-
-    # Transferring Tris accross 96-well plate
-    for n, x in enumerate(buffer_in):
-        if x > 20:
-            p300.distribute(x, reservoir.columns()[0],
-                            tempplate.columns()[n][0:replicates],
-                            touch_tip=False, blow_out=True,
-                            new_tip='never')
-
-        elif x <= 20:
-            p20.distribute(x, reservoir.columns()[0],
-                           tempplate.columns()[n][0:replicates],
-                           touch_tip=False, blow_out=True,
-                           new_tip='never')
-        elif x < 2:
-            protocol.comment('You are trying to pipette too small a volume! Please note results from this may not be accurate')
-            p20.distribute(x, reservoir.columns()[0],
-                           tempplate.columns()[n][0:replicates],
-                           touch_tip=False, blow_out=True,
-                           new_tip='never')
-    # Drop tip
-    if min(buffer_in) > 20:
-        p300.drop_tip()
-    elif max(buffer_in) <= 20:
-        p20.drop_tip()
-    else:
-        p300.drop_tip()
-        p20.drop_tip()
-
-
-    # Step 2.2 - Salt stock
-
-    # It only picks up the tips necessary to cover the volumes it's going
-    # to pipette
-    if min(salt_in) > 20:
-        p300.pick_up_tip()
-    elif max(salt_in) <= 20:
-        p20.pick_up_tip()
-    else:
-        p300.pick_up_tip()
-        p20.pick_up_tip()
-
-    # Transferring salt buffer across the plate
-    for n, x in enumerate(salt_in):
-        if x > 20:
-            p300.distribute(x, reservoir.columns()[1],
-                            tempplate.columns()[n][0:replicates],
-                            touch_tip=False, blow_out=True,
-                            new_tip='never')
-
-        elif x <= 20:
-            p20.distribute(x, reservoir.columns()[1],
-                           tempplate.columns()[n][0:replicates],
-                           touch_tip=False, blow_out=True,
-                           new_tip='never')
-        elif x < 2:
-            protocol.comment('You are trying to pipette too small a volume! Please note results from this may not be accurate')
-            p20.distribute(x, reservoir.columns()[1],
-                           tempplate.columns()[n][0:replicates],
-                           touch_tip=False, blow_out=True,
-                           new_tip='never')
-    # Drop tip
-    if min(salt_in) > 20:
-        p300.drop_tip()
-    elif max(salt_in) <= 20:
-        p20.drop_tip()
-    else:
-        p300.drop_tip()
-        p20.drop_tip()
-
+    # Step 2 - Prepare 96-well plate with the gradient of one plate
+
+    def condition_wells(plate, n):
+        # Wells of condition n of a plate: its replicates down a column, and on
+        # into the next column if there are more than 8
+        return [plate.columns()[n*columns_per_condition + r//8][r%8] for r in range(replicates)]
+
+    # OT-2 timings, the same as TIMING in Protocol_Run_Time_Estimator.py (copied
+    # here so that the protocol runs on its own on the robot)
+    timing = {'gantry_speed': 400, 'move_overhead': 1.5, 'aspirate_overhead': 0.5, 'pick_up_tip': 4.0,
+              'drop_tip': 3.0, 'blow_out': 1.0, 'tempdeck_heat_rate': 0.3, 'tempdeck_cool_rate': 0.15}
+
+    # Estimated time of a pipetting step (s): a move (about one deck slot) to every
+    # aspirate, dispense and tip, volume (uL taken up and dispensed in all) at the
+    # flow rate, a blow out after every aspirate, and mixes (repetitions, volume)
+    # after the last dispense. The steps of a plate are generators that yield the
+    # estimate of their next step before doing it, so that the next plate can be
+    # fitted into the annealing of the current one.
+    def step_seconds(pipette, volume, aspirations, dispenses, tips=0, mixes=(0, 0)):
+        repetitions, mix_volume = mixes
+        moves = aspirations + dispenses + 2*tips
+        return (moves*(timing['move_overhead'] + 132.5/timing['gantry_speed'])
+                + (aspirations + dispenses + 2*repetitions)*timing['aspirate_overhead']
+                + 2*(volume + repetitions*mix_volume)/pipette.flow_rate.aspirate
+                + aspirations*timing['blow_out']
+                + tips*(timing['pick_up_tip'] + timing['drop_tip']))
+
+    def plan_step_seconds(step):
+        # Estimated time of a step of a plan
+        action, *arguments = step
+        if action in STEP_ACTIONS:
+            return 0
+        pipette = pipettes[arguments[0]]
+        tips = int(arguments[1])
+        if action == 'transfer':
+            volume, mix = arguments[4:6]
+            strokes = math.ceil(volume/pipette.max_volume)
+            return step_seconds(pipette, volume, strokes, strokes, tips, mix or (0, 0))
+        if action == 'distribute':
+            return step_seconds(pipette, sum(arguments[4]), 1, len(arguments[4]), tips)
+        return step_seconds(pipette, 0, 0, 1, tips, arguments[3:5])
+
+    def run_plan(plan):
+        # Does the steps of a plan, yielding the estimate of each before doing it
+        for step in plan:
+            yield plan_step_seconds(step)
+            execute_step(protocol, labware, pipettes, step)
+        drop_tips(pipettes)
+
+    def run_steps(steps):
+        # Does all the remaining steps; returns their estimated time (s)
+        return sum(steps)
+
+    def gradient_plan(plate_number, plate):
+        # Buffer and salts of a plate (plate is its name in labware). Every reagent
+        # goes into empty wells, so it keeps one tip per pipette and is
+        # multi-dispensed; the pipette is chosen by volume. With the 8-channel P20,
+        # every reagent goes to the A well of each column and fills all its rows.
+        first = plate_number*conditions_per_plate
+        here = range(first, first + len(plates[plate_number]))
+        reagents = [('buffer', buffer_in, 'A1'), ('salt', salt_in, 'A2')]
+        if test_gradient_2:
+            reagents.append(('salt 2', salt2_in, 'A3'))
+
+        operations = []
+        for reagent, volumes_in, source in reagents:
+            for n, c in enumerate(here):
+                if volumes_in[c] <= 0:
+                    continue
+                wells = [labware[plate].columns()[n][0]] if multichannel else condition_wells(labware[plate], n)
+                operations += [Transfer(('reservoir', source), (plate, well.well_name), volumes_in[c], tip=reagent)
+                               for well in wells]
+        return plan_for(operations, 'p20') if multichannel else plan_for(operations, 'p300', 'p20')
+
+    def prepare_gradient(plate_number, plate):
+        yield from run_plan(gradient_plan(plate_number, plate))
+
+    # Buffer and salt in the first plate
+    if len(plates) > 1:
+        protocol.comment('Plate 1 of ' + str(len(plates)))
+    run_steps(prepare_gradient(0, 'tempplate'))
 
 
     # Step 3 - Mix oligos and dilute
@@ -258,41 +672,25 @@ def run(protocol: protocol_api.ProtocolContext):
     # Number of spare oligos in the Type II tube
     final_mix = n_oligos%no_mixtogether
 
+    # Every oligo and mix gets a fresh tip; the buffer of each tube gets one tip
+    dilutions = []
+
     # Prepare Type I tube(s) - if any
     for i in range(mixes):
-        p300.transfer(pipette_step,
-                      tuberack.wells()[i*10:(i*10+10)],
-                      tuberack2.wells()[i],
-                      touch_tip=False,
-                      blow_out=True,
-                      blowout_location='destination well',
-                      new_tip='always')
+        dilutions += [Transfer(at('tuberack', k), at('tuberack2', i), pipette_step) for k in range(i*10, i*10 + 10)]
         # Mix Type I tube only once, after having added all oligos, to save time
-        p300.pick_up_tip()
-        p300.mix(4, mix_volume_rounded/4, tuberack2.wells()[i])
-        p300.drop_tip()
+        dilutions.append(Mix(at('tuberack2', i), 4, mix_volume_rounded/4))
 
     # Prepare Type II tube
-    p300.transfer(pipette_step,
-                  tuberack.wells()[mixes*10:(mixes*10+final_mix)],
-                  tuberack2.wells()[mixes],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
+    dilutions += [Transfer(at('tuberack', k), at('tuberack2', mixes), pipette_step)
+                  for k in range(mixes*10, mixes*10 + final_mix)]
 
     # Add buffer to Type II tube to adjust volume
-    p300.transfer((mix_volume_rounded-pipette_step*final_mix),
-                  reservoir.columns()[0], tuberack2.wells()[mixes],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='once')
+    dilutions.append(Transfer(('reservoir', 'A1'), at('tuberack2', mixes), mix_volume_rounded - pipette_step*final_mix,
+                              tip=('buffer', 'tuberack2', mixes)))
 
     # Mix Type II tube only once, after all oligos and buffer have been added
-    p300.pick_up_tip()
-    p300.mix(4, mix_volume_rounded/4, tuberack2.wells()[mixes])
-    p300.drop_tip()
+    dilutions.append(Mix(at('tuberack2', mixes), 4, mix_volume_rounded/4))
 
 
 
@@ -309,38 +707,19 @@ def run(protocol: protocol_api.ProtocolContext):
 
     # Prepare Type I tube(s) - if any
     for i in range(mixes_second):
-        p300.transfer(pipette_step, tuberack2.wells()[i*10:(i*10+10)],
-                      tuberack3.wells()[i],
-                      touch_tip=False,
-                      blow_out=True,
-                      blowout_location='destination well',
-                      new_tip='always')
-
-        p300.pick_up_tip()
-        p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[i])
-        p300.drop_tip()
+        dilutions += [Transfer(at('tuberack2', k), at('tuberack3', i), pipette_step) for k in range(i*10, i*10 + 10)]
+        dilutions.append(Mix(at('tuberack3', i), 4, mix_volume_rounded/4))
 
     # Prepare Type II tube
-    p300.transfer(pipette_step,
-                  tuberack2.wells()[mixes_second*10:(mixes_second*10+final_mix_second)],
-                  tuberack3.wells()[mixes_second],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
+    dilutions += [Transfer(at('tuberack2', k), at('tuberack3', mixes_second), pipette_step)
+                  for k in range(mixes_second*10, mixes_second*10 + final_mix_second)]
 
     # Add buffer to Type II tube to adjust volume
-    p300.transfer((mix_volume_rounded-pipette_step*final_mix_second),
-                  reservoir.columns()[0], tuberack3.wells()[mixes_second],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='once')
+    dilutions.append(Transfer(('reservoir', 'A1'), at('tuberack3', mixes_second),
+                              mix_volume_rounded - pipette_step*final_mix_second, tip=('buffer', 'tuberack3', mixes_second)))
 
     # Mix Type II tube only once, after all oligos and buffer have been added
-    p300.pick_up_tip()
-    p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[mixes_second])
-    p300.drop_tip()
+    dilutions.append(Mix(at('tuberack3', mixes_second), 4, mix_volume_rounded/4))
 
 
     # Third dilution - (1:5 -> 200 nM each oligo)
@@ -352,77 +731,163 @@ def run(protocol: protocol_api.ProtocolContext):
     # Pipette volume (1/5 of total tube volume)
     pipette_step3 = mix_volume_rounded/5
 
-    # Transfer oligo mixture from previous step to last tube in tuberack 3
-    p300.transfer(pipette_step3, tuberack3.wells()[0], tuberack3.wells()[-1],
-              touch_tip=False,
-              blow_out=True,
-              blowout_location='destination well',
-              new_tip='always')
-
-    # Add scaffold (if there is any)
-    if scaffold == True:
-        p300.transfer((scaffold_in_mix),
-                      tuberack3.wells()[3], tuberack3.wells()[-1],
-                      touch_tip=False,
-                      blow_out=True,
-                      blowout_location='destination well',
-                      new_tip='always')
-
-        # Add buffer
-        p300.transfer((mix_volume_rounded-pipette_step3*final_mix_third-scaffold_in_mix),
-                      reservoir.columns()[0], tuberack3.wells()[-1],
-                      touch_tip=False,
-                      blow_out=True,
-                      blowout_location='destination well',
-                      new_tip='always')
-
-    # If there is no scaffold, add buffer
-    else:
-        p300.transfer((mix_volume_rounded-pipette_step3*final_mix_third),
-                      reservoir.columns()[0], tuberack3.wells()[-1],
-                      touch_tip=False,
-                      blow_out=True,
-                      blowout_location='destination well',
-                      new_tip='always')
-
-    # Mix final oligo mix
-    p300.pick_up_tip()
-    p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[-1])
-    p300.drop_tip()
+    # One final tube per plate group (tuberack 3, from the last tube backwards)
+    for t in range(n_final_tubes):
+        final_tube = at('tuberack3', -1 - t)
 
-    # Add DNA to heatdeck PCR tray.
-    # Concentration 50 nM for oligos and 10 nM for scaffold.
-    for row in range(replicates):
-        for col in range(len(test_gradient)):
-            p20.transfer(total_rxn_vol/4,
-                         tuberack3.wells()[-1],
-                         tempplate.columns()[col][row],
-                         mix_after=(3, total_rxn_vol/4),
-                         touch_tip=False, blow_out=True,
-                         blowout_location='destination well',
-                         new_tip='always')
+        # Transfer oligo mixture from previous step to the final tube
+        dilutions.append(Transfer(at('tuberack3', 0), final_tube, pipette_step3))
 
+        # Add scaffold (if there is any), then buffer
+        if scaffold == True:
+            dilutions.append(Transfer(at('tuberack3', 3), final_tube, scaffold_in_mix))
+            dilutions.append(Transfer(('reservoir', 'A1'), final_tube,
+                                      mix_volume_rounded - pipette_step3*final_mix_third - scaffold_in_mix))
 
+        # If there is no scaffold, add buffer
+        else:
+            dilutions.append(Transfer(('reservoir', 'A1'), final_tube, mix_volume_rounded - pipette_step3*final_mix_third))
 
-    #Step 4 - Heating and Cooling Plate
-      #Heat quickly and cool slowly according to Sigma-Aldrich 'Annealing Oligos Protocol'
+        # Mix final oligo mix
+        dilutions.append(Mix(final_tube, 4, mix_volume_rounded/4))
 
-    #Heating step
-    tempdeck.set_temperature(90)
-    protocol.comment('Incubating at 90˚C')
-    protocol.delay(minutes = 5)
+    # All the dilutions, in this order
+    execute(protocol, labware, pipettes, plan_for(dilutions, 'p300'))
 
-    #Cooling
-    tempdeck.set_temperature(70)
-    protocol.comment('Beginning cooldown')
-    protocol.delay(minutes = 15)
+    # Add DNA to heatdeck PCR tray.
+    # Concentration 50 nM for oligos and 10 nM for scaffold.
+    def dna_plan(plate_number, plate):
+        # Oligo mix of a plate (plate is its name in labware), a fresh tip and a
+        # mix for every well
+        final_tube = at('tuberack3', -1 - final_tube_of_plate[plate_number])
+        n_conditions = len(plates[plate_number])
+        if multichannel:
+            # Lay the oligo mix out in a column of the mix plate (one well per
+            # row) with one tip, taking no more than that from the final tube, then
+            # add it to the plate a whole column of replicates at a time
+            column = plate_number % 12
+            layout = [Transfer(final_tube, at('mixplate', column*8 + row), mix_vol_single*n_conditions + mixplate_dead_volume,
+                               tip='oligo mix', options={'disposal_volume': 0, 'blow_out': False}) for row in range(8)]
+            dna = [Transfer(at('mixplate', column*8), (plate, labware[plate].columns()[col][0].well_name), mix_vol_single,
+                            mix=(3, mix_vol_single)) for col in range(n_conditions)]
+            return plan_for(layout, 'p300') + plan_for(dna, 'p20')
+        dna = [Transfer(final_tube, (plate, condition_wells(labware[plate], col)[row].well_name), mix_vol_single,
+                        mix=(3, mix_vol_single)) for row in range(replicates) for col in range(n_conditions)]
+        return plan_for(dna, 'p20')
+
+    def add_dna(plate_number, plate):
+        yield from run_plan(dna_plan(plate_number, plate))
 
-    tempdeck.set_temperature(50)
-    protocol.delay(minutes = 15)
 
-    tempdeck.set_temperature(30)
-    protocol.delay(minutes = 15)
 
-    tempdeck.set_temperature(4)
-    protocol.comment('Cooling to 4˚C for storage')
-    protocol.delay(minutes = 5)
+    #Step 4 - Heating and Cooling Plate
+      #Heat quickly and cool slowly according to Sigma-Aldrich 'Annealing Oligos Protocol'
+    # (temperature, comment, hold in minutes)
+    annealing_steps = [(90, 'Incubating at 90˚C', 5),
+                       (70, 'Beginning cooldown', 15),
+                       (50, None, 15),
+                       (30, None, 15),
+                       (4, 'Cooling to 4˚C for storage', 5)]
+
+    # Temperature the temperature module starts at
+    deck_temperature = [25]
+
+    def pipette_during(seconds, staged):
+        # Does the next plate's steps while they fit in the given time; staged is
+        # [steps, estimated time of the next step]. Returns the time spent (s).
+        spent = 0
+        start = time.monotonic()
+        while staged[1] is not None and spent + staged[1] <= seconds:
+            estimate = staged[1]
+            staged[1] = next(staged[0], None)
+            if protocol.is_simulating():
+                spent += estimate
+            else:
+                spent = time.monotonic() - start
+        return spent
+
+    def plate_pickups(plate_number):
+        # Tip pick ups of the p300 and the p20 for the buffer, salt and DNA of a plate
+        pickups = count_tips(gradient_plan(plate_number, 'tempplate') + dna_plan(plate_number, 'tempplate'))
+        return pickups.get('p300', 0), pickups.get('p20', 0)
+
+    def pickups_left(pipette, full=False):
+        # Tip pick ups left in the racks of a pipette (or in full racks)
+        return sum(len([well for well in rack.wells() if full or well.has_tip]) for rack in pipette.tip_racks)//pipette.channels
+
+    def plate_steps(plate_number, plate):
+        yield from prepare_gradient(plate_number, plate)
+        yield from add_dna(plate_number, plate)
+
+    def anneal(staged=None):
+        # Returns the time spent pipetting the next plate meanwhile (s)
+        overlap = 0
+        for temperature, message, hold in annealing_steps:
+            if staged is None:
+                tempdeck.set_temperature(temperature)
+                deck_temperature[0] = temperature
+                if message:
+                    protocol.comment(message)
+                protocol.delay(minutes = hold)
+                continue
+
+            # Pipette while the module heats or cools, then for the hold
+            if temperature > deck_temperature[0]:
+                ramp = (temperature - deck_temperature[0])/timing['tempdeck_heat_rate']
+            else:
+                ramp = (deck_temperature[0] - temperature)/timing['tempdeck_cool_rate']
+            tempdeck.start_set_temperature(temperature)
+            during_ramp = pipette_during(ramp, staged)
+            overlap += during_ramp
+            tempdeck.await_temperature(temperature)
+            deck_temperature[0] = temperature
+            if message:
+                protocol.comment(message)
+            # Pipetting that ran past the end of the ramp is already part of the hold
+            held = max(0, during_ramp - ramp)
+            during_hold = pipette_during(hold*60 - held, staged)
+            overlap += during_hold
+            if hold*60 > held + during_hold:
+                protocol.delay(seconds = hold*60 - held - during_hold)
+        return overlap
+
+
+    # Plates one after another: DNA, annealing, then swap in the next plate. When
+    # pipelined, the next plate is prepared in slot 11 while the current one anneals.
+    run_steps(add_dna(0, 'tempplate'))
+    overlapped = 0
+    not_overlapped = 0
+    for plate_number in range(len(plates)):
+        if plate_number > 0 and not pipelined:
+            protocol.pause('Plate ' + str(plate_number + 1) + ' of ' + str(len(plates)) + ': replace the annealed plate on '
+                           'the temperature module with an empty one and refill the tip racks.')
+            p300.reset_tipracks()
+            p20.reset_tipracks()
+            run_steps(prepare_gradient(plate_number, 'tempplate'))
+            run_steps(add_dna(plate_number, 'tempplate'))
+
+        if pipelined and plate_number + 1 < len(plates):
+            # Refill the tips now if the next plate could run out of them: a pause
+            # during the annealing would stop the robot in a temperature hold
+            if any(pickups_left(pipette) < min(pickups, pickups_left(pipette, full=True))
+                   for pipette, pickups in zip((p300, p20), plate_pickups(plate_number + 1))):
+                protocol.pause('Refill the tip racks before plate ' + str(plate_number + 2) + ' is prepared while plate '
+                               + str(plate_number + 1) + ' anneals.')
+                p300.reset_tipracks()
+                p20.reset_tipracks()
+            protocol.comment('Preparing plate ' + str(plate_number + 2) + ' in slot 11 while plate ' + str(plate_number + 1) + ' anneals')
+            steps = plate_steps(plate_number + 1, 'stagingplate')
+            staged = [steps, next(steps, None)]
+            overlapped += anneal(staged)
+            if staged[1] is not None:
+                not_overlapped += staged[1] + run_steps(staged[0])
+            protocol.pause('Plate ' + str(plate_number + 2) + ' of ' + str(len(plates)) + ': replace the annealed plate on '
+                           'the temperature module with the plate in slot 11, put an empty plate in slot 11 and refill the tip racks.')
+            p300.reset_tipracks()
+            p20.reset_tipracks()
+        else:
+            anneal()
+
+    if pipelined:
+        protocol.comment('Note: pipelining, ' + str(round(overlapped/60)) + ' of ' + str(round((overlapped + not_overlapped)/60)) +
+                         ' min of pipetting for plates 2-' + str(len(plates)) + ' done while the previous plate annealed')
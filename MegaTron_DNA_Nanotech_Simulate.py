@@ -2,6 +2,14 @@ from opentrons import simulate
 metadata = {'apiLevel': '2.8'}
 protocol = simulate.get_protocol_api('2.8')
 
+# Commands are printed as they are issued; set command_log to a .jsonl file name to stream them there as
+# records (step, pipette, labware, well, volume) instead, e.g. for Protocol_Command_Log.py to query
+command_log = None
+from Protocol_Command_Log import CommandLog
+from Protocol_Run_Time_Estimator import TIMING
+from Protocol_Liquid_Handling_IR import Mix, STEP_ACTIONS, Transfer, count_tips, drop_tips, execute, execute_step, optimize
+command_sink = CommandLog(protocol, command_log)
+
 
 #------------------------------- PARAMTERS -------------------------------------
 #--------------------------- Edit for each run ---------------------------------
@@ -15,12 +23,19 @@ oligos_resusp_concentration = 100
 # Desired concentrations in the salt gradient (mM)
 test_gradient = [0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22]
 
-# Number of replicates per gradient step
+# Number of replicates per gradient step (more than 8 take more than one column)
 replicates = 8
 
 # Concentration of salt Stock (mM)
 salt_conc = 40
 
+# Desired concentrations of a second salt (mM), to screen a grid of both salts
+# (e.g. Mg2+ x Na+). Leave empty for a single gradient. Stock in reservoir column 3.
+test_gradient_2 = []
+
+# Concentration of the second salt stock (mM)
+salt_conc_2 = 1000
+
 # Total volume in each well of the final assembled plate (ul)
 total_rxn_vol = 40
 
@@ -30,6 +45,15 @@ scaffold = True
 # Concentration of scaffold strand in the stock (nM)
 scaffold_conc = 100
 
+# Fill the plate a whole column (8 replicates) at a time with an 8-channel P20?
+# Needs the P20 8-channel on the right mount, 8 replicates and an empty 96-well
+# PCR plate in slot 2 for the oligo mix.
+multichannel = False
+
+# With several plates, prepare the next plate while the current one anneals.
+# Needs an empty 96-well PCR plate in slot 11 and a third 20 ul tip rack in slot 8.
+pipeline_plates = True
+
 
 #-------------------------------------------------------------------------------
 #-------------------------------------------------------------------------------
@@ -38,6 +62,7 @@ scaffold_conc = 100
 from opentrons import protocol_api
 import math
 import sys
+import time
 
 
 
@@ -49,11 +74,43 @@ n_oligos = len(oligos_nmol)
 # Volume that the oligos need to be resuspended in to reach the desired concentration
 volume_added_to_oligos = [round(x / oligos_resusp_concentration * 1000) for x in oligos_nmol]
 
+# Salt conditions: every combination of the two gradients
+conditions = [(i, j) for i in test_gradient for j in (test_gradient_2 or [0])]
+
+# Plate layout: each condition takes a column (more than one for more than 8
+# replicates). Conditions that do not fit in one plate go on the next plates,
+# which are prepared and annealed one after another on the temperature module.
+columns_per_condition = math.ceil(replicates/8)
+conditions_per_plate = 12//columns_per_condition
+plates = [conditions[k:k+conditions_per_plate] for k in range(0, len(conditions), conditions_per_plate)]
+
+# The next plate is prepared in slot 11 while the current one anneals, then
+# moved onto the temperature module
+pipelined = pipeline_plates and len(plates) > 1
+
 # Volume of oligo mix that needs to be added to each well in the final plate
 mix_vol_single = total_rxn_vol/4
 
-# Total volume of oligo mix that needs to be prepared to cover all wells
-mix_volume = mix_vol_single * len(test_gradient) * replicates
+# Oligo mix left over in each mix plate well (multichannel mode), so the P20
+# multi does not draw air on the last columns
+mixplate_dead_volume = 10
+
+# The oligo mix is prepared once for all plates, in as many final tubes as
+# needed (up to 1400 ul each); each plate takes its mix from one of them
+final_tube_of_plate = []
+final_tube_volumes = [0]
+for plate in plates:
+    plate_mix = mix_vol_single * len(plate) * replicates
+    if multichannel:
+        plate_mix += mixplate_dead_volume * 8
+    if final_tube_volumes[-1] + plate_mix > 1400 and final_tube_volumes[-1] > 0:
+        final_tube_volumes.append(0)
+    final_tube_volumes[-1] += plate_mix
+    final_tube_of_plate.append(len(final_tube_volumes) - 1)
+n_final_tubes = len(final_tube_volumes)
+
+# Total volume of oligo mix that needs to be prepared in each final tube
+mix_volume = max(final_tube_volumes)
 mix_volume_rounded = math.ceil(mix_volume/100)*100
 
 # Volume of scaffold that needs to be added to final mix (uL)
@@ -61,14 +118,17 @@ scaffold_in_mix = mix_volume_rounded/(scaffold_conc/(40))
 
 # Calculate volumes of salt and buffer to create the gradient
 salt_in = []
+salt2_in = []
 buffer_in = []
 
-for i in test_gradient:
+for i, j in conditions:
     mg = ((i * total_rxn_vol) / salt_conc)
     salt_in.append(mg)
+    na = ((j * total_rxn_vol) / salt_conc_2)
+    salt2_in.append(na)
 
     # Add buffer to make up to total rxn volume (+ oligo mix)
-    buff = (total_rxn_vol - mg - mix_vol_single)
+    buff = (total_rxn_vol - mg - na - mix_vol_single)
     buffer_in.append(buff)
 
 
@@ -82,17 +142,24 @@ if salt_conc < max(test_gradient):
     # 'print' and 'sys.exit()' commands for simlation only.
     # Use 'protocol.pause()' for real runs instead.
 
-# Check if number of replicates and gradient size is within the limits
-if replicates > 8:
-    #protocol.pause('Too many repliactes! We cannot fit more than 8 replicates in a plate.')
-    print('Too many repliactes! We cannot fit more than 8 replicates in a plate.')
+if test_gradient_2 and salt_conc_2 < max(test_gradient_2):
+    #protocol.pause('The concentration of the second salt stock provided is too low to cover its gradient.')
+    print('The concentration of the second salt stock provided is too low to cover its gradient.')
+    sys.exit()
+    # 'print' and 'sys.exit()' commands for simlation only.
+    # Use 'protocol.pause()' for real runs instead.
+
+if multichannel and replicates != 8:
+    #protocol.pause('Multichannel mode fills whole columns: set replicates to 8.')
+    print('Multichannel mode fills whole columns: set replicates to 8.')
     sys.exit()
     # 'print' and 'sys.exit()' commands for simlation only.
     # Use 'protocol.pause()' for real runs instead.
 
-if len(test_gradient) > 12:
-    #protocol.pause('Too many salt conditions! We cannot fit a salt gradient with more than 12 steps in a single plate.')
-    print('Too many salt conditions! We cannot fit a salt gradient with more than 12 steps in a single plate.')
+# Check the number of plates
+if n_final_tubes > 4:
+    #protocol.pause('Too many plates! The oligo mix cannot be prepared for more than 4 final tubes at once.')
+    print('Too many plates! The oligo mix cannot be prepared for more than 4 final tubes at once.')
     sys.exit()
     # 'print' and 'sys.exit()' commands for simlation only.
     # Use 'protocol.pause()' for real runs instead.
@@ -144,109 +211,150 @@ tuberack3 = protocol.load_labware('opentrons_24_tuberack_eppendorf_1.5ml_safeloc
 tempdeck = protocol.load_module('tempdeck', 10)
 tempplate = tempdeck.load_labware('opentrons_96_aluminumblock_biorad_wellplate_200ul', label='Temperature-Controlled Tubes')
 
+p20_tipracks = [tiprack_2, tiprack_3]
+if pipelined:
+    # The next plate is pipetted before the tip racks are refilled
+    p20_tipracks.append(protocol.load_labware('opentrons_96_tiprack_20ul', 8))
+    stagingplate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 11)
+
 # Pipettes
 p300 = protocol.load_instrument('p300_single_gen2',  'left', tip_racks=[tiprack_1])
-p20 = protocol.load_instrument('p20_single_gen2', 'right', tip_racks = [tiprack_2, tiprack_3])
+if multichannel:
+    p20 = protocol.load_instrument('p20_multi_gen2', 'right', tip_racks = p20_tipracks)
+    # Oligo mix laid out in column 1, one well per plate row
+    mixplate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 2)
+else:
+    p20 = protocol.load_instrument('p20_single_gen2', 'right', tip_racks = p20_tipracks)
+
+# When a pipette runs out of tips, pause for fresh racks just before it picks
+# up the next one (it never holds a tip then) instead of stopping the run
+def pause_when_empty(pipette):
+    def checked(method, takes_tips):
+        def call(*args, **kwargs):
+            if takes_tips(args, kwargs) and all(rack.next_tip(pipette.channels) is None for rack in pipette.tip_racks):
+                protocol.pause('Replace the empty tip racks of the ' + pipette.name + ' (slot(s) '
+                               + ', '.join(str(rack.parent) for rack in pipette.tip_racks) + ') with full ones.')
+                pipette.reset_tipracks()
+            return method(*args, **kwargs)
+        return call
+    # transfer() and co. look for a free tip before picking any up
+    pipette.pick_up_tip = checked(pipette.pick_up_tip, lambda args, kwargs: not args and not kwargs)
+    for name in ('transfer', 'distribute', 'consolidate'):
+        setattr(pipette, name, checked(getattr(pipette, name), lambda args, kwargs: kwargs.get('new_tip') != 'never'))
+
+pause_when_empty(p300)
+pause_when_empty(p20)
+
+# The liquid handling is planned with Protocol_Liquid_Handling_IR.py: each step
+# lists its transfers, which are optimised (multi-dispensed where they share a
+# tip) and run from the names below
+labware = {'reservoir': reservoir, 'tuberack': tuberack, 'tuberack2': tuberack2, 'tuberack3': tuberack3,
+           'tempplate': tempplate}
+if pipelined:
+    labware['stagingplate'] = stagingplate
+if multichannel:
+    labware['mixplate'] = mixplate
+pipettes = {'p300': p300, 'p20': p20}
+
+def at(name, index):
+    # Location of a well of a labware (index as in .wells(), down the columns)
+    return (name, labware[name].wells()[index].well_name)
+
+def plan_for(operations, *names):
+    # Optimised plan of the operations with the named pipettes only
+    return optimize(operations, {name: (pipettes[name].min_volume, pipettes[name].max_volume) for name in names})
 
 
 #Step 1 - Resuspend oligos in standard buffer
 # to a uniform concentration to 100 uM
 
-p300.transfer(volume_added_to_oligos,
-              reservoir.columns()[0],
-              tuberack.wells()[0:n_oligos],
-              mix_after=(10, 100),
-              touch_tip=True,
-              blow_out= True,
-              blowout_location= 'destination well',
-              new_tip= 'always')
+# A fresh tip for every tube; the tip touches the side of the tube after mixing
+resuspension = [Transfer(('reservoir', 'A1'), at('tuberack', n), volume, mix=(10, 100), options={'touch_tip': True})
+                for n, volume in enumerate(volume_added_to_oligos)]
+execute(protocol, labware, pipettes, plan_for(resuspension, 'p300'))
 
 # Let the oligos dissolve while preparing the gradient in the plate
 
 
-# Step 2 - Prepare 96-well plate with single gradient
-
-# Step 2.1 - Buffer
-
-# It only picks up the tips necessary to cover the volumes it's going
-# to pipette
-if min(buffer_in) > 20:
-    p300.pick_up_tip()
-elif max(buffer_in) <= 20:
-    p20.pick_up_tip()
-else:
-    p300.pick_up_tip()
-    p20.pick_up_tip()
-
-# Transferring Tris accross 96-well plate
-for n, x in enumerate(buffer_in):
-    if x > 20:
-        p300.distribute(x, reservoir.columns()[0],
-                        tempplate.columns()[n][0:replicates],
-                        touch_tip=False, blow_out=True,
-                        new_tip='never')
-
-    elif x <= 20:
-        p20.distribute(x, reservoir.columns()[0],
-                       tempplate.columns()[n][0:replicates],
-                       touch_tip=False, blow_out=True,
-                       new_tip='never')
-    elif x < 2:
-        protocol.comment('You are trying to pipette too small a volume! Please note results from this may not be accurate')
-        p20.distribute(x, reservoir.columns()[0],
-                       tempplate.columns()[n][0:replicates],
-                       touch_tip=False, blow_out=True,
-                       new_tip='never')
-# Drop tip
-if min(buffer_in) > 20:
-    p300.drop_tip()
-elif max(buffer_in) <= 20:
-    p20.drop_tip()
-else:
-    p300.drop_tip()
-    p20.drop_tip()
-
-
-# Step 2.2 - Salt stock
-
-# It only picks up the tips necessary to cover the volumes it's going
-# to pipette
-if min(salt_in) > 20:
-    p300.pick_up_tip()
-elif max(salt_in) <= 20:
-    p20.pick_up_tip()
-else:
-    p300.pick_up_tip()
-    p20.pick_up_tip()
-
-# Transferring salt buffer across the plate
-for n, x in enumerate(salt_in):
-    if x > 20:
-        p300.distribute(x, reservoir.columns()[1],
-                        tempplate.columns()[n][0:replicates],
-                        touch_tip=False, blow_out=True,
-                        new_tip='never')
-
-    elif x <= 20:
-        p20.distribute(x, reservoir.columns()[1],
-                       tempplate.columns()[n][0:replicates],
-                       touch_tip=False, blow_out=True,
-                       new_tip='never')
-    elif x < 2:
-        protocol.comment('You are trying to pipette too small a volume! Please note results from this may not be accurate')
-        p20.distribute(x, reservoir.columns()[1],
-                       tempplate.columns()[n][0:replicates],
-                       touch_tip=False, blow_out=True,
-                       new_tip='never')
-# Drop tip
-if min(salt_in) > 20:
-    p300.drop_tip()
-elif max(salt_in) <= 20:
-    p20.drop_tip()
-else:
-    p300.drop_tip()
-    p20.drop_tip()
-
+# Step 2 - Prepare 96-well plate with the gradient of one plate
+
+def condition_wells(plate, n):
+    # Wells of condition n of a plate: its replicates down a column, and on
+    # into the next column if there are more than 8
+    return [plate.columns()[n*columns_per_condition + r//8][r%8] for r in range(replicates)]
+
+# OT-2 timings of Protocol_Run_Time_Estimator.py
+timing = TIMING
+
+# Estimated time of a pipetting step (s): a move (about one deck slot) to every
+# aspirate, dispense and tip, volume (uL taken up and dispensed in all) at the
+# flow rate, a blow out after every aspirate, and mixes (repetitions, volume)
+# after the last dispense. The steps of a plate are generators that yield the
+# estimate of their next step before doing it, so that the next plate can be
+# fitted into the annealing of the current one.
+def step_seconds(pipette, volume, aspirations, dispenses, tips=0, mixes=(0, 0)):
+    repetitions, mix_volume = mixes
+    moves = aspirations + dispenses + 2*tips
+    return (moves*(timing['move_overhead'] + 132.5/timing['gantry_speed'])
+            + (aspirations + dispenses + 2*repetitions)*timing['aspirate_overhead']
+            + 2*(volume + repetitions*mix_volume)/pipette.flow_rate.aspirate
+            + aspirations*timing['blow_out']
+            + tips*(timing['pick_up_tip'] + timing['drop_tip']))
+
+def plan_step_seconds(step):
+    # Estimated time of a step of a plan
+    action, *arguments = step
+    if action in STEP_ACTIONS:
+        return 0
+    pipette = pipettes[arguments[0]]
+    tips = int(arguments[1])
+    if action == 'transfer':
+        volume, mix = arguments[4:6]
+        strokes = math.ceil(volume/pipette.max_volume)
+        return step_seconds(pipette, volume, strokes, strokes, tips, mix or (0, 0))
+    if action == 'distribute':
+        return step_seconds(pipette, sum(arguments[4]), 1, len(arguments[4]), tips)
+    return step_seconds(pipette, 0, 0, 1, tips, arguments[3:5])
+
+def run_plan(plan):
+    # Does the steps of a plan, yielding the estimate of each before doing it
+    for step in plan:
+        yield plan_step_seconds(step)
+        execute_step(protocol, labware, pipettes, step)
+    drop_tips(pipettes)
+
+def run_steps(steps):
+    # Does all the remaining steps; returns their estimated time (s)
+    return sum(steps)
+
+def gradient_plan(plate_number, plate):
+    # Buffer and salts of a plate (plate is its name in labware). Every reagent
+    # goes into empty wells, so it keeps one tip per pipette and is
+    # multi-dispensed; the pipette is chosen by volume. With the 8-channel P20,
+    # every reagent goes to the A well of each column and fills all its rows.
+    first = plate_number*conditions_per_plate
+    here = range(first, first + len(plates[plate_number]))
+    reagents = [('buffer', buffer_in, 'A1'), ('salt', salt_in, 'A2')]
+    if test_gradient_2:
+        reagents.append(('salt 2', salt2_in, 'A3'))
+
+    operations = []
+    for reagent, volumes_in, source in reagents:
+        for n, c in enumerate(here):
+            if volumes_in[c] <= 0:
+                continue
+            wells = [labware[plate].columns()[n][0]] if multichannel else condition_wells(labware[plate], n)
+            operations += [Transfer(('reservoir', source), (plate, well.well_name), volumes_in[c], tip=reagent)
+                           for well in wells]
+    return plan_for(operations, 'p20') if multichannel else plan_for(operations, 'p300', 'p20')
+
+def prepare_gradient(plate_number, plate):
+    yield from run_plan(gradient_plan(plate_number, plate))
+
+# Buffer and salt in the first plate
+if len(plates) > 1:
+    protocol.comment('Plate 1 of ' + str(len(plates)))
+run_steps(prepare_gradient(0, 'tempplate'))
 
 
 # Step 3 - Mix oligos and dilute
@@ -275,41 +383,25 @@ total_mixes = mixes + 1
 # Number of spare oligos in the Type II tube
 final_mix = n_oligos%no_mixtogether
 
+# Every oligo and mix gets a fresh tip; the buffer of each tube gets one tip
+dilutions = []
+
 # Prepare Type I tube(s) - if any
 for i in range(mixes):
-    p300.transfer(pipette_step,
-                  tuberack.wells()[i*10:(i*10+10)],
-                  tuberack2.wells()[i],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
+    dilutions += [Transfer(at('tuberack', k), at('tuberack2', i), pipette_step) for k in range(i*10, i*10 + 10)]
     # Mix Type I tube only once, after having added all oligos, to save time
-    p300.pick_up_tip()
-    p300.mix(4, mix_volume_rounded/4, tuberack2.wells()[i])
-    p300.drop_tip()
+    dilutions.append(Mix(at('tuberack2', i), 4, mix_volume_rounded/4))
 
 # Prepare Type II tube
-p300.transfer(pipette_step,
-              tuberack.wells()[mixes*10:(mixes*10+final_mix)],
-              tuberack2.wells()[mixes],
-              touch_tip=False,
-              blow_out=True,
-              blowout_location='destination well',
-              new_tip='always')
+dilutions += [Transfer(at('tuberack', k), at('tuberack2', mixes), pipette_step)
+              for k in range(mixes*10, mixes*10 + final_mix)]
 
 # Add buffer to Type II tube to adjust volume
-p300.transfer((mix_volume_rounded-pipette_step*final_mix),
-              reservoir.columns()[0], tuberack2.wells()[mixes],
-              touch_tip=False,
-              blow_out=True,
-              blowout_location='destination well',
-              new_tip='once')
+dilutions.append(Transfer(('reservoir', 'A1'), at('tuberack2', mixes), mix_volume_rounded - pipette_step*final_mix,
+                          tip=('buffer', 'tuberack2', mixes)))
 
 # Mix Type II tube only once, after all oligos and buffer have been added
-p300.pick_up_tip()
-p300.mix(4, mix_volume_rounded/4, tuberack2.wells()[mixes])
-p300.drop_tip()
+dilutions.append(Mix(at('tuberack2', mixes), 4, mix_volume_rounded/4))
 
 
 
@@ -326,38 +418,19 @@ final_mix_second = total_mixes%no_mixtogether
 
 # Prepare Type I tube(s) - if any
 for i in range(mixes_second):
-    p300.transfer(pipette_step, tuberack2.wells()[i*10:(i*10+10)],
-                  tuberack3.wells()[i],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
-
-    p300.pick_up_tip()
-    p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[i])
-    p300.drop_tip()
+    dilutions += [Transfer(at('tuberack2', k), at('tuberack3', i), pipette_step) for k in range(i*10, i*10 + 10)]
+    dilutions.append(Mix(at('tuberack3', i), 4, mix_volume_rounded/4))
 
 # Prepare Type II tube
-p300.transfer(pipette_step,
-              tuberack2.wells()[mixes_second*10:(mixes_second*10+final_mix_second)],
-              tuberack3.wells()[mixes_second],
-              touch_tip=False,
-              blow_out=True,
-              blowout_location='destination well',
-              new_tip='always')
+dilutions += [Transfer(at('tuberack2', k), at('tuberack3', mixes_second), pipette_step)
+              for k in range(mixes_second*10, mixes_second*10 + final_mix_second)]
 
 # Add buffer to Type II tube to adjust volume
-p300.transfer((mix_volume_rounded-pipette_step*final_mix_second),
-              reservoir.columns()[0], tuberack3.wells()[mixes_second],
-              touch_tip=False,
-              blow_out=True,
-              blowout_location='destination well',
-              new_tip='once')
+dilutions.append(Transfer(('reservoir', 'A1'), at('tuberack3', mixes_second),
+                          mix_volume_rounded - pipette_step*final_mix_second, tip=('buffer', 'tuberack3', mixes_second)))
 
 # Mix Type II tube only once, after all oligos and buffer have been added
-p300.pick_up_tip()
-p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[mixes_second])
-p300.drop_tip()
+dilutions.append(Mix(at('tuberack3', mixes_second), 4, mix_volume_rounded/4))
 
 
 # Third dilution - (1:5 -> 200 nM each oligo)
@@ -369,81 +442,166 @@ final_mix_third = total_mixes_second%no_mixtogether
 # Pipette volume (1/5 of total tube volume)
 pipette_step3 = mix_volume_rounded/5
 
-# Transfer oligo mixture from previous step to last tube in tuberack 3
-p300.transfer(pipette_step3, tuberack3.wells()[0], tuberack3.wells()[-1],
-          touch_tip=False,
-          blow_out=True,
-          blowout_location='destination well',
-          new_tip='always')
-
-# Add scaffold (if there is any)
-if scaffold == True:
-    p300.transfer((scaffold_in_mix),
-                  tuberack3.wells()[3], tuberack3.wells()[-1],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
-
-    # Add buffer
-    p300.transfer((mix_volume_rounded-pipette_step3*final_mix_third-scaffold_in_mix),
-                  reservoir.columns()[0], tuberack3.wells()[-1],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
-
-# If there is no scaffold, add buffer
-else:
-    p300.transfer((mix_volume_rounded-pipette_step3*final_mix_third),
-                  reservoir.columns()[0], tuberack3.wells()[-1],
-                  touch_tip=False,
-                  blow_out=True,
-                  blowout_location='destination well',
-                  new_tip='always')
-
-# Mix final oligo mix
-p300.pick_up_tip()
-p300.mix(4, mix_volume_rounded/4, tuberack3.wells()[-1])
-p300.drop_tip()
+# One final tube per plate group (tuberack 3, from the last tube backwards)
+for t in range(n_final_tubes):
+    final_tube = at('tuberack3', -1 - t)
 
-# Add DNA to heatdeck PCR tray.
-# Concentration 50 nM for oligos and 10 nM for scaffold.
-for row in range(replicates):
-    for col in range(len(test_gradient)):
-        p20.transfer(total_rxn_vol/4,
-                     tuberack3.wells()[-1],
-                     tempplate.columns()[col][row],
-                     mix_after=(3, total_rxn_vol/4),
-                     touch_tip=False, blow_out=True,
-                     blowout_location='destination well',
-                     new_tip='always')
+    # Transfer oligo mixture from previous step to the final tube
+    dilutions.append(Transfer(at('tuberack3', 0), final_tube, pipette_step3))
 
+    # Add scaffold (if there is any), then buffer
+    if scaffold == True:
+        dilutions.append(Transfer(at('tuberack3', 3), final_tube, scaffold_in_mix))
+        dilutions.append(Transfer(('reservoir', 'A1'), final_tube,
+                                  mix_volume_rounded - pipette_step3*final_mix_third - scaffold_in_mix))
 
+    # If there is no scaffold, add buffer
+    else:
+        dilutions.append(Transfer(('reservoir', 'A1'), final_tube, mix_volume_rounded - pipette_step3*final_mix_third))
 
-#Step 4 - Heating and Cooling Plate
-  #Heat quickly and cool slowly according to Sigma-Aldrich 'Annealing Oligos Protocol'
+    # Mix final oligo mix
+    dilutions.append(Mix(final_tube, 4, mix_volume_rounded/4))
 
-#Heating step
-tempdeck.set_temperature(90)
-protocol.comment('Incubating at 90˚C')
-protocol.delay(minutes = 5)
+# All the dilutions, in this order
+execute(protocol, labware, pipettes, plan_for(dilutions, 'p300'))
 
-#Cooling
-tempdeck.set_temperature(70)
-protocol.comment('Beginning cooldown')
-protocol.delay(minutes = 15)
+# Add DNA to heatdeck PCR tray.
+# Concentration 50 nM for oligos and 10 nM for scaffold.
+def dna_plan(plate_number, plate):
+    # Oligo mix of a plate (plate is its name in labware), a fresh tip and a
+    # mix for every well
+    final_tube = at('tuberack3', -1 - final_tube_of_plate[plate_number])
+    n_conditions = len(plates[plate_number])
+    if multichannel:
+        # Lay the oligo mix out in a column of the mix plate (one well per
+        # row) with one tip, taking no more than that from the final tube, then
+        # add it to the plate a whole column of replicates at a time
+        column = plate_number % 12
+        layout = [Transfer(final_tube, at('mixplate', column*8 + row), mix_vol_single*n_conditions + mixplate_dead_volume,
+                           tip='oligo mix', options={'disposal_volume': 0, 'blow_out': False}) for row in range(8)]
+        dna = [Transfer(at('mixplate', column*8), (plate, labware[plate].columns()[col][0].well_name), mix_vol_single,
+                        mix=(3, mix_vol_single)) for col in range(n_conditions)]
+        return plan_for(layout, 'p300') + plan_for(dna, 'p20')
+    dna = [Transfer(final_tube, (plate, condition_wells(labware[plate], col)[row].well_name), mix_vol_single,
+                    mix=(3, mix_vol_single)) for row in range(replicates) for col in range(n_conditions)]
+    return plan_for(dna, 'p20')
+
+def add_dna(plate_number, plate):
+    yield from run_plan(dna_plan(plate_number, plate))
 
-tempdeck.set_temperature(50)
-protocol.delay(minutes = 15)
 
-tempdeck.set_temperature(30)
-protocol.delay(minutes = 15)
 
-tempdeck.set_temperature(4)
-protocol.comment('Cooling to 4˚C for storage')
-protocol.delay(minutes = 5)
+#Step 4 - Heating and Cooling Plate
+  #Heat quickly and cool slowly according to Sigma-Aldrich 'Annealing Oligos Protocol'
+# (temperature, comment, hold in minutes)
+annealing_steps = [(90, 'Incubating at 90˚C', 5),
+                   (70, 'Beginning cooldown', 15),
+                   (50, None, 15),
+                   (30, None, 15),
+                   (4, 'Cooling to 4˚C for storage', 5)]
+
+# Temperature the temperature module starts at
+deck_temperature = [25]
+
+def pipette_during(seconds, staged):
+    # Does the next plate's steps while they fit in the given time; staged is
+    # [steps, estimated time of the next step]. Returns the time spent (s).
+    spent = 0
+    start = time.monotonic()
+    while staged[1] is not None and spent + staged[1] <= seconds:
+        estimate = staged[1]
+        staged[1] = next(staged[0], None)
+        if protocol.is_simulating():
+            spent += estimate
+        else:
+            spent = time.monotonic() - start
+    return spent
+
+def plate_pickups(plate_number):
+    # Tip pick ups of the p300 and the p20 for the buffer, salt and DNA of a plate
+    pickups = count_tips(gradient_plan(plate_number, 'tempplate') + dna_plan(plate_number, 'tempplate'))
+    return pickups.get('p300', 0), pickups.get('p20', 0)
+
+def pickups_left(pipette, full=False):
+    # Tip pick ups left in the racks of a pipette (or in full racks)
+    return sum(len([well for well in rack.wells() if full or well.has_tip]) for rack in pipette.tip_racks)//pipette.channels
+
+def plate_steps(plate_number, plate):
+    yield from prepare_gradient(plate_number, plate)
+    yield from add_dna(plate_number, plate)
+
+def anneal(staged=None):
+    # Returns the time spent pipetting the next plate meanwhile (s)
+    overlap = 0
+    for temperature, message, hold in annealing_steps:
+        if staged is None:
+            tempdeck.set_temperature(temperature)
+            deck_temperature[0] = temperature
+            if message:
+                protocol.comment(message)
+            protocol.delay(minutes = hold)
+            continue
+
+        # Pipette while the module heats or cools, then for the hold
+        if temperature > deck_temperature[0]:
+            ramp = (temperature - deck_temperature[0])/timing['tempdeck_heat_rate']
+        else:
+            ramp = (deck_temperature[0] - temperature)/timing['tempdeck_cool_rate']
+        tempdeck.start_set_temperature(temperature)
+        during_ramp = pipette_during(ramp, staged)
+        overlap += during_ramp
+        tempdeck.await_temperature(temperature)
+        deck_temperature[0] = temperature
+        if message:
+            protocol.comment(message)
+        # Pipetting that ran past the end of the ramp is already part of the hold
+        held = max(0, during_ramp - ramp)
+        during_hold = pipette_during(hold*60 - held, staged)
+        overlap += during_hold
+        if hold*60 > held + during_hold:
+            protocol.delay(seconds = hold*60 - held - during_hold)
+    return overlap
+
+
+# Plates one after another: DNA, annealing, then swap in the next plate. When
+# pipelined, the next plate is prepared in slot 11 while the current one anneals.
+run_steps(add_dna(0, 'tempplate'))
+overlapped = 0
+not_overlapped = 0
+for plate_number in range(len(plates)):
+    if plate_number > 0 and not pipelined:
+        protocol.pause('Plate ' + str(plate_number + 1) + ' of ' + str(len(plates)) + ': replace the annealed plate on '
+                       'the temperature module with an empty one and refill the tip racks.')
+        p300.reset_tipracks()
+        p20.reset_tipracks()
+        run_steps(prepare_gradient(plate_number, 'tempplate'))
+        run_steps(add_dna(plate_number, 'tempplate'))
+
+    if pipelined and plate_number + 1 < len(plates):
+        # Refill the tips now if the next plate could run out of them: a pause
+        # during the annealing would stop the robot in a temperature hold
+        if any(pickups_left(pipette) < min(pickups, pickups_left(pipette, full=True))
+               for pipette, pickups in zip((p300, p20), plate_pickups(plate_number + 1))):
+            protocol.pause('Refill the tip racks before plate ' + str(plate_number + 2) + ' is prepared while plate '
+                           + str(plate_number + 1) + ' anneals.')
+            p300.reset_tipracks()
+            p20.reset_tipracks()
+        protocol.comment('Preparing plate ' + str(plate_number + 2) + ' in slot 11 while plate ' + str(plate_number + 1) + ' anneals')
+        steps = plate_steps(plate_number + 1, 'stagingplate')
+        staged = [steps, next(steps, None)]
+        overlapped += anneal(staged)
+        if staged[1] is not None:
+            not_overlapped += staged[1] + run_steps(staged[0])
+        protocol.pause('Plate ' + str(plate_number + 2) + ' of ' + str(len(plates)) + ': replace the annealed plate on '
+                       'the temperature module with the plate in slot 11, put an empty plate in slot 11 and refill the tip racks.')
+        p300.reset_tipracks()
+        p20.reset_tipracks()
+    else:
+        anneal()
+
+if pipelined:
+    protocol.comment('Note: pipelining, ' + str(round(overlapped/60)) + ' of ' + str(round((overlapped + not_overlapped)/60)) +
+                     ' min of pipetting for plates 2-' + str(len(plates)) + ' done while the previous plate annealed')
 
 # Print output
-for line in protocol.commands():
-    print(line)
+command_sink.close()
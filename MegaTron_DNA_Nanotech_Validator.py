@@ -0,0 +1,352 @@
+import argparse
+import ast
+import csv
+import math
+import os
+import sys
+import time
+from collections import OrderedDict
+
+#Checks a MegaTron DNA Nanotech parameter block without running the simulator: follows every transfer of the protocol
+#in closed form, keeps track of the volume in each tube, reservoir column and plate column, and reports every problem
+#at once (negative buffer volumes, overflowing or emptied tubes, volumes the pipettes cannot handle, too many tubes...).
+#It also writes the plate-by-plate layout of a screen that needs several plates (--manifest).
+#Example: python MegaTron_DNA_Nanotech_Validator.py MegaTron_DNA_Nanotech_RobotReady.py --volumes --manifest layout.csv
+#The checks follow the steps of MegaTron_DNA_Nanotech_Simulate.py / _RobotReady.py; keep them in sync when the protocol changes.
+
+
+SCRIPTS = ('MegaTron_DNA_Nanotech_Simulate.py', 'MegaTron_DNA_Nanotech_RobotReady.py')
+PARAMETERS = ('oligos_nmol', 'oligos_resusp_concentration', 'test_gradient', 'replicates',
+              'salt_conc', 'total_rxn_vol', 'scaffold', 'scaffold_conc')
+#Parameters older scripts do not have, and the value that keeps their behaviour
+OPTIONAL = {'multichannel': False, 'test_gradient_2': [], 'salt_conc_2': 1000}
+
+CAPACITY = {
+    'tube': 1500,                 #uL, 1.5 ml Eppendorf tubes in tuberack, tuberack2 and tuberack3
+    'plate well': 200,            #uL, PCR plate on the temperature module
+    'reservoir column': 21000,    #uL, 4ti0131 12-column reservoir
+}
+#uL a pipette cannot take from the bottom of a tube or well: whatever is drawn from must keep at least this much
+DEAD_VOLUME = {
+    'tube': 10,
+    'plate well': 5,
+}
+PIPETTES = {'p300': (20, 300), 'p20': (1, 20)} #(minimum, maximum) volume in uL
+MIX_VOLUME_RANGE = (200, 1400) #uL of oligo mix the protocol can prepare in each final tube
+MAX_FINAL_TUBES = 4            #final tubes one round of dilutions can fill
+TUBES_PER_RACK = 24
+PLATE_ROWS = 'ABCDEFGH'
+PLATE_COLUMNS = 12
+
+#Fixed by the protocol
+NO_MIXTOGETHER = 10    #oligos (or tubes) pooled per dilution tube
+RESUSPENSION_MIX = 100 #uL, mix_after volume when resuspending the oligos
+SCAFFOLD_TUBE = 3      #tuberack3.wells()[3] holds the scaffold stock
+FINAL_TUBE = 23        #tuberack3.wells()[-1] holds the (first) final oligo mix, the others go backwards from it
+MIXPLATE_DEAD_VOLUME = 10 #uL of oligo mix left over in each mix plate well in multichannel mode
+
+#What a parameter may be written with besides plain values, e.g. test_gradient = list(range(0, 24, 2)) or
+#total_rxn_vol = 4 * 25; earlier parameters can be used by name
+SAFE_CALLS = {'range': range, 'list': list, 'tuple': tuple, 'round': round, 'len': len, 'min': min, 'max': max,
+              'sum': sum, 'abs': abs, 'int': int, 'float': float}
+SAFE_NODES = (ast.Expression, ast.Constant, ast.Tuple, ast.List, ast.BinOp, ast.UnaryOp, ast.operator, ast.unaryop,
+              ast.Call, ast.Name, ast.Load)
+
+
+def parameter_value(node, params): #Value of the right-hand side of a parameter; ValueError if it is not a simple expression.
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        pass
+    expression = ast.Expression(node)
+    for child in ast.walk(expression):
+        if not isinstance(child, SAFE_NODES) or (isinstance(child, ast.Call) and not isinstance(child.func, ast.Name)):
+            raise ValueError('only values, arithmetic and ' + ', '.join(SAFE_CALLS) + ' can be used')
+        if isinstance(child, ast.Name) and child.id not in SAFE_CALLS and child.id not in params:
+            raise ValueError(f'{child.id} is not a parameter set above it')
+    try:
+        return eval(compile(expression, '<parameters>', 'eval'), {'__builtins__': {}}, dict(SAFE_CALLS, **params))
+    except (ArithmeticError, TypeError, ValueError) as error:
+        raise ValueError(str(error)) from None
+
+
+def read_parameters(path):
+    """Values assigned in the '#--- PARAMTERS ---' block of a MegaTron script, read without running it.
+    Raises ValueError listing every parameter that cannot be read, with its line in the script."""
+    with open(path, encoding='utf-8') as rf:
+        lines = rf.read().splitlines()
+    start = next((i for i, line in enumerate(lines) if 'PARAMTERS' in line), None)
+    if start is None:
+        raise ValueError(f'{path} has no PARAMTERS block')
+    end = next((i for i in range(start + 1, len(lines)) if lines[i].strip() and set(lines[i].strip()) <= {'#', '-'}), len(lines))
+    try:
+        block = ast.parse('\n'.join(line.strip() for line in lines[start:end]))
+    except SyntaxError as error:
+        raise ValueError(f'line {start + error.lineno}: {error.msg}') from None
+    params, problems, unreadable = {}, [], set()
+    for node in block.body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            try:
+                params[name] = parameter_value(node.value, params)
+            except ValueError as error:
+                unreadable.add(name)
+                problems.append(f'line {start + node.lineno}: {name} = {ast.unparse(node.value)}: {error}')
+    missing = [name for name in PARAMETERS if name not in params and name not in unreadable]
+    if missing:
+        problems.append(f"does not set {', '.join(missing)}")
+    if problems:
+        raise ValueError('\n'.join(problems))
+    for name, default in OPTIONAL.items():
+        params.setdefault(name, default)
+    return params
+
+
+def tube(rack, index): #Name of tube index of a 4x6 tube rack, in the column-major order of .wells()
+    return f"{rack} {'ABCD'[index % 4]}{index // 4 + 1}"
+
+
+def plate_layout(params):
+    """Same layout as the protocol: the salt conditions, how they are split over plates, and which final tube of oligo mix
+    each plate takes its DNA from. Returns (conditions, plates, columns_per_condition, final_tube_of_plate, final_tube_volumes)."""
+    conditions = [(i, j) for i in params['test_gradient'] for j in (params['test_gradient_2'] or [0])]
+    columns_per_condition = math.ceil(params['replicates'] / len(PLATE_ROWS))
+    per_plate = max(PLATE_COLUMNS // columns_per_condition, 1)
+    plates = [conditions[k:k + per_plate] for k in range(0, len(conditions), per_plate)]
+    final_tube_of_plate, final_tube_volumes = [], [0]
+    for plate in plates:
+        plate_mix = params['total_rxn_vol'] / 4 * len(plate) * params['replicates']
+        if params['multichannel']:
+            plate_mix += MIXPLATE_DEAD_VOLUME * len(PLATE_ROWS)
+        if final_tube_volumes[-1] + plate_mix > MIX_VOLUME_RANGE[1] and final_tube_volumes[-1] > 0:
+            final_tube_volumes.append(0)
+        final_tube_volumes[-1] += plate_mix
+        final_tube_of_plate.append(len(final_tube_volumes) - 1)
+    return conditions, plates, columns_per_condition, final_tube_of_plate, final_tube_volumes
+
+
+def condition_wells(n, replicates, columns_per_condition): #Wells of condition n of a plate: down a column, then on into the next
+    return [f'{PLATE_ROWS[r % 8]}{n * columns_per_condition + r // 8 + 1}' for r in range(replicates)]
+
+
+def plate_wells(plate, n, replicates, columns_per_condition): #Name of the wells of condition n of a plate in the volume ledger
+    wells = condition_wells(n, replicates, columns_per_condition)
+    return f'plate {plate + 1} {wells[0]}-{wells[-1]}'
+
+
+def validate(params):
+    """Follows the protocol for the given parameters.
+    Returns (volumes, violations): volumes maps every tube, reservoir column and group of plate wells (the replicates of a
+    condition) to [most it holds, what is left] (uL, per well for plate wells; reservoir columns and the scaffold stock count
+    what is taken from them), violations lists every problem found.
+    """
+    violations = []
+    volumes = OrderedDict()
+    drawn = set() #Tubes and wells the pipettes take from, which must keep their dead volume
+
+    oligos_nmol = params['oligos_nmol']
+    test_gradient = params['test_gradient']
+    replicates = params['replicates']
+    total_rxn_vol = params['total_rxn_vol']
+    n_oligos = len(oligos_nmol)
+    multichannel = params['multichannel']
+    conditions, plates, columns_per_condition, final_tube_of_plate, final_tube_volumes = plate_layout(params)
+
+    #Same calculations as the protocol
+    volume_added_to_oligos = [round(x / params['oligos_resusp_concentration'] * 1000) for x in oligos_nmol]
+    mix_vol_single = total_rxn_vol / 4
+    mix_volume_rounded = math.ceil(max(final_tube_volumes) / 100) * 100
+    scaffold_in_mix = mix_volume_rounded / (params['scaffold_conc'] / 40)
+    salt_in = [(i * total_rxn_vol) / params['salt_conc'] for i, _ in conditions]
+    salt2_in = [(j * total_rxn_vol) / params['salt_conc_2'] for _, j in conditions]
+    buffer_in = [total_rxn_vol - mg - na - mix_vol_single for mg, na in zip(salt_in, salt2_in)]
+
+    def add(well, volume):
+        peak_left = volumes.setdefault(well, [0.0, 0.0])
+        peak_left[1] += volume
+        peak_left[0] = max(peak_left)
+
+    def take(well, volume):
+        if well.startswith('reservoir') or well.endswith('(scaffold stock)'):
+            add(well, volume) #Stocks loaded by hand count the volume taken from them.
+        else:
+            volumes.setdefault(well, [0.0, 0.0])[1] -= volume
+            drawn.add(well)
+
+    def pipette(name, volume, where):
+        low, high = PIPETTES[name]
+        if 0 < volume < low:
+            violations.append(f'{where}: {volume:g} uL is below the {name} minimum of {low} uL')
+
+    def mix(name, volume, where):
+        if volume > PIPETTES[name][1]:
+            violations.append(f'{where}: mixing {volume:g} uL is more than the {name} can hold ({PIPETTES[name][1]} uL)')
+
+    def transfer(name, volume, source, destination, where):
+        pipette(name, volume, where)
+        take(source, volume)
+        add(destination, volume)
+
+    #Checks the protocol already makes
+    if params['salt_conc'] < max(test_gradient):
+        violations.append(f"salt stock: {params['salt_conc']} mM is too low to cover the gradient (up to {max(test_gradient)} mM)")
+    if params['test_gradient_2'] and params['salt_conc_2'] < max(params['test_gradient_2']):
+        violations.append(f"second salt stock: {params['salt_conc_2']} mM is too low to cover its gradient (up to {max(params['test_gradient_2'])} mM)")
+    if multichannel and replicates != len(PLATE_ROWS):
+        violations.append(f'plates: multichannel mode fills whole columns, {replicates} replicates instead of {len(PLATE_ROWS)}')
+    if columns_per_condition > PLATE_COLUMNS:
+        violations.append(f'plates: {replicates} replicates do not fit in one plate')
+    if len(final_tube_volumes) > MAX_FINAL_TUBES:
+        violations.append(f'oligo mix: {len(plates)} plates need {len(final_tube_volumes)} final tubes, more than the {MAX_FINAL_TUBES} one round of dilutions can fill')
+    if not MIX_VOLUME_RANGE[0] <= mix_volume_rounded <= MIX_VOLUME_RANGE[1]:
+        violations.append(f'oligo mix: {mix_volume_rounded} uL is outside the {MIX_VOLUME_RANGE[0]}-{MIX_VOLUME_RANGE[1]} uL that can be handled')
+    if n_oligos > TUBES_PER_RACK:
+        violations.append(f'tuberack: {n_oligos} oligos do not fit in its {TUBES_PER_RACK} tubes')
+
+    #Step 1 - Resuspend oligos
+    for i, volume in enumerate(volume_added_to_oligos):
+        transfer('p300', volume, 'reservoir column 1', tube('tuberack', i), f"{tube('tuberack', i)} resuspension")
+        if volume < RESUSPENSION_MIX:
+            violations.append(f"{tube('tuberack', i)}: mixing {RESUSPENSION_MIX} uL in {volume} uL of resuspended oligo")
+
+    #Step 2 - Buffer and salt across each plate (the volumes are the same in every well of a condition, whether they are
+    #dispensed one well at a time or a whole column at once with the 8-channel P20)
+    reagents = [('buffer', buffer_in, 'reservoir column 1'), ('salt', salt_in, 'reservoir column 2')]
+    if params['test_gradient_2']:
+        reagents.append(('second salt', salt2_in, 'reservoir column 3'))
+    condition = 0
+    for plate, plate_conditions in enumerate(plates):
+        for n, (i, j) in enumerate(plate_conditions):
+            wells = plate_wells(plate, n, replicates, columns_per_condition)
+            for reagent, volumes_in, source in reagents:
+                volume = volumes_in[condition]
+                if volume < 0:
+                    violations.append(f'{wells}: {reagent} volume is negative ({volume:g} uL) for {i}/{j} mM')
+                    continue
+                pipette('p300' if volume > 20 else 'p20', volume, f'{wells} {reagent}')
+                add(wells, volume)
+                take(source, volume * replicates)
+            condition += 1
+
+    #Step 3 - Mix oligos and dilute, three times
+    pipette_step = mix_volume_rounded / NO_MIXTOGETHER
+    sources = [tube('tuberack', i) for i in range(n_oligos)]
+    for rack in ('tuberack2', 'tuberack3'):
+        mixes, final_mix = divmod(len(sources), NO_MIXTOGETHER)
+        if mixes + 1 > TUBES_PER_RACK:
+            violations.append(f'{rack}: {mixes + 1} dilution tubes do not fit in the rack')
+        for i in range(mixes + 1):
+            pooled = sources[i * NO_MIXTOGETHER:(i + 1) * NO_MIXTOGETHER]
+            for source in pooled:
+                transfer('p300', pipette_step, source, tube(rack, i), f'{tube(rack, i)} pooling')
+            if i == mixes: #Type II tube, topped up with buffer
+                transfer('p300', mix_volume_rounded - pipette_step * final_mix, 'reservoir column 1', tube(rack, i), f'{tube(rack, i)} buffer')
+        if rack == 'tuberack3' and params['scaffold'] and mixes >= SCAFFOLD_TUBE:
+            violations.append(f'tuberack3: dilution tubes reach {tube(rack, SCAFFOLD_TUBE)}, which holds the scaffold stock')
+        sources = [tube(rack, i) for i in range(mixes + 1)]
+    mix('p300', mix_volume_rounded / 4, 'dilution tubes')
+
+    #Third dilution, into each final tube: only the first tuberack3 tube goes into the final mix, the buffer is
+    #calculated for all of them
+    final_mix_third = len(sources) % NO_MIXTOGETHER
+    pipette_step3 = mix_volume_rounded / 5
+    finals = [tube('tuberack3', FINAL_TUBE - t) for t in range(len(final_tube_volumes))]
+    if set(finals) & set(sources + [tube('tuberack3', SCAFFOLD_TUBE)] * params['scaffold']):
+        violations.append('tuberack3: the final tubes reach the dilution or scaffold tubes')
+    for final in finals:
+        transfer('p300', pipette_step3, sources[0], final, f'{final} oligo mix')
+        buffer = mix_volume_rounded - pipette_step3 * final_mix_third
+        if params['scaffold']:
+            transfer('p300', scaffold_in_mix, tube('tuberack3', SCAFFOLD_TUBE) + ' (scaffold stock)', final, f'{final} scaffold')
+            buffer -= scaffold_in_mix
+        if buffer < 0:
+            violations.append(f'{final}: buffer volume is negative ({buffer:g} uL); the scaffold stock ({params["scaffold_conc"]} nM) is too dilute')
+        else:
+            transfer('p300', buffer, 'reservoir column 1', final, f'{final} buffer')
+
+    #Add DNA to every well of each plate; in multichannel mode through a column of the mix plate, one well per row
+    pipette('p20', mix_vol_single, 'plate DNA')
+    mix('p20', mix_vol_single, 'plate DNA')
+    for plate, plate_conditions in enumerate(plates):
+        final = finals[final_tube_of_plate[plate]]
+        source = final
+        if multichannel:
+            column = plate % PLATE_COLUMNS + 1
+            source = f'mixplate column {column} (A{column}-H{column})'
+            layout = mix_vol_single * len(plate_conditions) + MIXPLATE_DEAD_VOLUME
+            transfer('p300', layout, final, source, f'{source} oligo mix')
+            take(final, layout * (len(PLATE_ROWS) - 1)) #The other 7 wells of the column
+        for n in range(len(plate_conditions)):
+            add(plate_wells(plate, n, replicates, columns_per_condition), mix_vol_single)
+            take(source, mix_vol_single * (1 if multichannel else replicates))
+
+    #Tubes, plate wells and reservoir columns must neither overflow nor run dry
+    for well, (peak, left) in volumes.items():
+        kind = 'reservoir column' if well.startswith('reservoir') else 'plate well' if well.startswith(('plate', 'mixplate')) else 'tube'
+        if peak > CAPACITY[kind]:
+            violations.append(f'{well}: {peak:g} uL overflows the {kind} ({CAPACITY[kind]} uL)')
+        if left < 0:
+            violations.append(f'{well}: runs dry, {-left:g} uL short')
+        elif well in drawn and left < DEAD_VOLUME[kind]:
+            violations.append(f'{well}: only {left:g} uL left, below the {DEAD_VOLUME[kind]} uL dead volume of a {kind}')
+    return volumes, violations
+
+
+def write_manifest(path, params): #What goes into every well of every plate, and which final tube its oligo mix comes from.
+    conditions, plates, columns_per_condition, final_tube_of_plate, _ = plate_layout(params)
+    total_rxn_vol = params['total_rxn_vol']
+    with open(path, 'w', newline='') as wf:
+        writer = csv.writer(wf, lineterminator='\n')
+        writer.writerow(['Plate', 'Well', 'Replicate', 'Salt (mM)', 'Second salt (mM)', 'Buffer (uL)', 'Salt (uL)',
+                         'Second salt (uL)', 'Oligo mix (uL)', 'Oligo mix tube'])
+        for plate, plate_conditions in enumerate(plates):
+            final = tube('tuberack3', FINAL_TUBE - final_tube_of_plate[plate])
+            for n, (i, j) in enumerate(plate_conditions):
+                salt = i * total_rxn_vol / params['salt_conc']
+                salt2 = j * total_rxn_vol / params['salt_conc_2']
+                buffer = total_rxn_vol - salt - salt2 - total_rxn_vol / 4
+                for replicate, well in enumerate(condition_wells(n, params['replicates'], columns_per_condition), 1):
+                    writer.writerow([plate + 1, well, replicate, i, j, round(buffer, 2), round(salt, 2), round(salt2, 2),
+                                     total_rxn_vol / 4, final])
+
+
+def main(argv=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Check MegaTron DNA Nanotech parameters without simulating the protocol.')
+    parser.add_argument('scripts', nargs='*', default=[os.path.join(app_dir, script) for script in SCRIPTS],
+                        help='MegaTron scripts whose parameter block to check (default: both MegaTron scripts)')
+    parser.add_argument('--volumes', action='store_true', help='also print the volume in every tube, reservoir column and plate column')
+    parser.add_argument('--manifest', help='write the plate-by-plate layout to this .csv file (one script only)')
+    args = parser.parse_args(argv)
+    if args.manifest and len(args.scripts) != 1:
+        parser.error('--manifest needs exactly one script')
+
+    failed = 0
+    for path in args.scripts:
+        start = time.perf_counter()
+        try:
+            params = read_parameters(path)
+        except ValueError as error: #Parameters the validator cannot read are problems of the script like any other.
+            failed += 1
+            problems = str(error).splitlines()
+            print(f'{os.path.basename(path)}: {len(problems)} problem(s) found in its parameters')
+            for problem in problems:
+                print(f'  - {problem}')
+            continue
+        volumes, violations = validate(params)
+        elapsed = time.perf_counter() - start
+        failed += bool(violations)
+        print(f'{os.path.basename(path)}: {len(violations) or "no"} problem(s) found in {elapsed * 1e6:.0f} us')
+        for violation in violations:
+            print(f'  - {violation}')
+        if args.volumes:
+            print(f"  {'':<40}{'max uL':>9}{'left uL':>9}")
+            for well, (peak, left) in volumes.items():
+                print(f'  {well:<40}{peak:>9.1f}{left:>9.1f}')
+        if args.manifest:
+            write_manifest(args.manifest, params)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
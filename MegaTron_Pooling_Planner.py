@@ -0,0 +1,240 @@
+import argparse
+import csv
+import math
+import sys
+from collections import namedtuple
+
+from Protocol_Liquid_Handling_IR import Mix, Transfer, count_tips as plan_tips, optimize, protocol_source, travel
+from Protocol_Run_Time_Estimator import deck_position
+
+#Plans how to pool a full set of oligos (e.g. the 150-250 staple strands of a DNA origami) into one mix where every
+#oligo is at the target concentration, with the fewest transfers and tips, and writes the OT-2 protocol that does it.
+#Step 3 of the MegaTron scripts dilutes in three fixed rounds of 10 oligos per tube; here the number of pooling levels
+#and the number of oligos per pool follow from the concentrations and volumes. In most cases every oligo goes straight
+#into the final tube; intermediate pools (in a 96 deep-well plate) are only used when the volume of each oligo would be
+#too small to pipette. The oligos are read from 96 deep-well plates, in column order (A1, B1, ..., H1, A2, ...).
+#Example: python MegaTron_Pooling_Planner.py 250 --target-conc 0.2 --protocol pooling.py --csv pooling.csv
+#The mix is left in A1 of the tube rack in slot 6; use it as the final oligo mix of the MegaTron protocol.
+
+
+#Deck of the pooling run
+LABWARE = {
+    'oligos1': ('nest_96_wellplate_2ml_deep', 1),   #resuspended oligos 1-96
+    'oligos2': ('nest_96_wellplate_2ml_deep', 2),   #oligos 97-192
+    'oligos3': ('nest_96_wellplate_2ml_deep', 3),   #oligos 193-288
+    'pools': ('nest_96_wellplate_2ml_deep', 4),     #intermediate pools
+    'reservoir': ('usascientific_12_reservoir_22ml', 5), #buffer in A1; should be '4ti0131_12_reservoir_21000ul' on the robot
+    'final': ('opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', 6), #final mix in A1
+}
+TIPS = {'p20': ('opentrons_96_tiprack_20ul', (8, 9, 11)), 'p300': ('opentrons_96_tiprack_300ul', (7, 10))}
+PIPETTES = {'p20': (1, 20), 'p300': (20, 300)} #(minimum, maximum) volume in uL
+CAPACITY = {'pool': 1800, 'final': 1500} #uL usable in a deep well and in a 1.5 ml tube
+OLIGO_PLATES = sum(name.startswith('oligos') for name in LABWARE)
+
+#One pooling level: `count` vessels (pools, or the final tube at the last level), each receiving up to `fan_in` items
+#of the level below, `transfer` uL of each, made up to `volume` uL with buffer.
+Level = namedtuple('Level', ['count', 'fan_in', 'transfer', 'volume'])
+Plan = namedtuple('Plan', ['levels', 'steps', 'transfers', 'tips'])
+
+
+def well_name(index): #Column-major well name in a 96-well plate, like .wells()
+    return 'ABCDEFGH'[index % 8] + str(index // 8 + 1)
+
+
+def locate(location): #(x, y) on the deck of a (labware, well) location.
+    return deck_position(LABWARE[location[0]][1], location[1])
+
+
+def pipette_for(volume):
+    return 'p20' if volume <= PIPETTES['p20'][1] else 'p300'
+
+
+def tree_shapes(n_items, levels): #Every way to pool n_items in the given number of levels, as (counts, fan_ins).
+    if levels == 1:
+        yield [n_items, 1], [n_items]
+        return
+    for fan_in in sorted({math.ceil(n_items / pools) for pools in range(1, max(n_items, 2))}):
+        for counts, fan_ins in tree_shapes(math.ceil(n_items / fan_in), levels - 1):
+            yield [n_items] + counts, [fan_in] + fan_ins
+
+
+def level_volumes(counts, fan_ins, dilution, final_volume, min_volume, dead_volume):
+    """Transfer and vessel volumes of every level of a tree, or None if the tree cannot reach the dilution.
+    counts[l] items are pooled fan_ins[l] at a time into counts[l + 1] vessels; the last level is the final tube."""
+    #A level dilutes each item by (vessel volume / transfer), at least fan_in times (the items must fit) and at most
+    #(vessel capacity / min_volume) times (the transfer must be pipettable).
+    ranges = [(fan_in, (final_volume if l == len(fan_ins) - 1 else CAPACITY['pool']) / min_volume)
+              for l, fan_in in enumerate(fan_ins)]
+    if math.prod(low for low, _ in ranges) > dilution or math.prod(high for _, high in ranges) < dilution:
+        return None
+    #Spread the dilution evenly over the levels, so no transfer is much smaller or larger than it needs to be.
+    factors = [low for low, _ in ranges]
+    free = list(range(len(ranges)))
+    while free:
+        share = (dilution / math.prod(factors)) ** (1 / len(free))
+        capped = [l for l in free if factors[l] * share > ranges[l][1]]
+        for l in capped:
+            factors[l] = ranges[l][1]
+        if not capped:
+            for l in free:
+                factors[l] *= share
+        free = [l for l in free if l not in capped] if capped else []
+
+    volumes, transfers = [final_volume], [final_volume / factors[-1]]
+    for factor in reversed(factors[:-1]): #Each pool must hold its transfer plus what stays in the well.
+        volume = max(transfers[0] + dead_volume, min_volume * factor)
+        if volume > CAPACITY['pool']:
+            return None
+        volumes.insert(0, volume)
+        transfers.insert(0, volume / factor)
+    return [Level(counts[l + 1], fan_ins[l], transfers[l], volumes[l]) for l in range(len(fan_ins))]
+
+
+def transfer_steps(n_oligos, levels):
+    """The steps of a pooling tree in the order the robot does them, as (action, source, destination, volume) tuples.
+    Sources and destinations are (labware, well) with the labware names of LABWARE. Buffer goes first, into the empty
+    vessels; every pool is mixed just before it is moved on."""
+    items = [(f'oligos{i // 96 + 1}', well_name(i % 96)) for i in range(n_oligos)]
+    moves, vessel_volumes, next_pool = [], {}, 0
+    for depth, level in enumerate(levels):
+        if depth == len(levels) - 1:
+            vessels = [('final', 'A1')]
+        else:
+            vessels = [('pools', well_name(next_pool + v)) for v in range(level.count)]
+            next_pool += level.count
+        for i, item in enumerate(items):
+            if depth:
+                moves.append(('mix', item, item, min(PIPETTES['p300'][1], round(levels[depth - 1].volume / 2, 2))))
+            moves.append(('pool' if depth else 'oligo', item, vessels[i // level.fan_in], round(level.transfer, 2)))
+        vessel_volumes.update((vessel, level.volume) for vessel in vessels)
+        items = vessels
+    moves.append(('mix', items[0], items[0], min(PIPETTES['p300'][1], round(levels[-1].volume / 2, 2))))
+
+    #Vessels with fewer items than fan_in get more buffer, so every pool has the same concentration of each item.
+    received = dict.fromkeys(vessel_volumes, 0)
+    for action, _, destination, volume in moves:
+        if action != 'mix':
+            received[destination] += volume
+    buffer = [('buffer', ('reservoir', 'A1'), vessel, round(volume - received[vessel], 2))
+              for vessel, volume in vessel_volumes.items() if volume - received[vessel] >= 0.01]
+    return buffer + moves
+
+
+def operations(steps):
+    """The steps as operations of Protocol_Liquid_Handling_IR.py. All the buffer goes into empty vessels, so it shares a
+    tip (and is distributed); each pool is moved on with the tip that mixed it; every oligo gets a fresh tip."""
+    result = []
+    for action, source, destination, volume in steps:
+        if action == 'mix':
+            result.append(Mix(source, 5, volume, tip=source))
+        else:
+            result.append(Transfer(source, destination, volume, tip={'buffer': 'buffer', 'pool': source}.get(action)))
+    return result
+
+
+def plan_pooling(n_oligos, stock_conc=100, target_conc=0.2, final_volume=1000, min_volume=2, dead_volume=10, max_levels=3):
+    """Pooling tree with the fewest transfers (then tips) that takes n_oligos oligos at stock_conc (uM) to target_conc (uM)
+    each in final_volume uL. No transfer is smaller than min_volume uL and dead_volume uL is left in every pool.
+    Raises ValueError if no tree of at most max_levels levels fits the deck."""
+    dilution = stock_conc / target_conc
+    if n_oligos > dilution:
+        raise ValueError(f'{n_oligos} oligos at {target_conc} uM each cannot be made from {stock_conc} uM stocks; '
+                         f'at most {int(dilution)} oligos fit')
+    if n_oligos > 96 * OLIGO_PLATES:
+        raise ValueError(f'{n_oligos} oligos do not fit in {OLIGO_PLATES} plates')
+    if final_volume > CAPACITY['final']:
+        raise ValueError(f"the final mix ({final_volume} uL) does not fit in a {CAPACITY['final']} uL tube")
+    for n_levels in range(1, max_levels + 1):
+        best = None
+        for counts, fan_ins in tree_shapes(n_oligos, n_levels):
+            levels = level_volumes(counts, fan_ins, dilution, final_volume, min_volume, dead_volume)
+            if levels is None or sum(level.count for level in levels[:-1]) > 96: #One plate of pools
+                continue
+            steps = transfer_steps(n_oligos, levels)
+            tips = sum(plan_tips(optimize(operations(steps), PIPETTES)).values())
+            plan = Plan(levels, steps, sum(action != 'mix' for action, _, _, _ in steps), tips)
+            if best is None or (plan.transfers, plan.tips) < (best.transfers, best.tips):
+                best = plan
+        if best is not None: #Every extra level moves every pool once more, so fewer levels are always better.
+            return best
+    raise ValueError(f'no pooling tree of up to {max_levels} levels; allow smaller transfers or a larger final volume')
+
+
+def check_tips(plan): #The tips needed must fit in the tip racks on the deck.
+    tips = plan_tips(optimize(operations(plan.steps), PIPETTES))
+    for pipette, (_, slots) in TIPS.items():
+        needed = tips.get(pipette, 0)
+        if needed > 96 * len(slots):
+            raise ValueError(f'{needed} {pipette} tips needed, but there are only {96 * len(slots)} on the deck')
+
+
+#Runs on the robot; the lowered plan and the executor of Protocol_Liquid_Handling_IR.py are written above it.
+PROTOCOL_BODY = '''
+def run(protocol: protocol_api.ProtocolContext):
+    loaded = {name: protocol.load_labware(load_name, slot) for name, (load_name, slot) in labware.items()}
+    pipettes = {
+        'p20': protocol.load_instrument('p20_single_gen2', 'right',
+                                        tip_racks=[protocol.load_labware(tips['p20'][0], slot) for slot in tips['p20'][1]]),
+        'p300': protocol.load_instrument('p300_single_gen2', 'left',
+                                         tip_racks=[protocol.load_labware(tips['p300'][0], slot) for slot in tips['p300'][1]]),
+    }
+    execute(protocol, loaded, pipettes, plan)
+'''
+
+
+def write_protocol(path, n_oligos, plan, params):
+    with open(path, 'w', encoding='utf-8') as wf:
+        wf.write('from opentrons import protocol_api\n\n')
+        wf.write("metadata = {\n    'protocolName': 'Oligo pooling',\n    'author': 'MegaTron',\n")
+        wf.write(f"    'description': {params!r},\n    'apiLevel': '2.8'\n}}\n\n")
+        wf.write(f'# Generated by MegaTron_Pooling_Planner.py for {n_oligos} oligos in {len(plan.levels)} level(s)\n')
+        wf.write(f'labware = {LABWARE!r}\ntips = {TIPS!r}\n\n')
+        wf.write(protocol_source(optimize(operations(plan.steps), PIPETTES, locate)) + '\n' + PROTOCOL_BODY)
+
+
+def write_csv(path, plan):
+    with open(path, 'w', newline='') as wf:
+        writer = csv.writer(wf, lineterminator='\n')
+        writer.writerow(['Step', 'Action', 'Source', 'Destination', 'Volume (uL)', 'Pipette'])
+        for number, (action, source, destination, volume) in enumerate(plan.steps, 1):
+            writer.writerow([number, action, ' '.join(source), ' '.join(destination), volume, pipette_for(volume)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan the pooling of a set of oligos with the fewest transfers and tips.')
+    parser.add_argument('n_oligos', type=int, help='number of oligos to pool')
+    parser.add_argument('--stock-conc', type=float, default=100, help='concentration of the resuspended oligos (uM, default: 100)')
+    parser.add_argument('--target-conc', type=float, default=0.2, help='concentration of each oligo in the final mix (uM, default: 0.2)')
+    parser.add_argument('--final-volume', type=float, default=1000, help='volume of the final mix (uL, default: 1000)')
+    parser.add_argument('--min-volume', type=float, default=2, help='smallest volume to pipette (uL, default: 2)')
+    parser.add_argument('--dead-volume', type=float, default=10, help='volume left in every pool (uL, default: 10)')
+    parser.add_argument('--protocol', help='write the OT-2 protocol for the plan to this .py file')
+    parser.add_argument('--csv', help='write the list of transfers to this .csv file')
+    args = parser.parse_args(argv)
+
+    try:
+        plan = plan_pooling(args.n_oligos, args.stock_conc, args.target_conc, args.final_volume, args.min_volume, args.dead_volume)
+        check_tips(plan)
+    except ValueError as error:
+        print(f'Cannot pool: {error}', file=sys.stderr)
+        return 1
+
+    print(f'{args.n_oligos} oligos, {args.stock_conc:g} uM -> {args.target_conc:g} uM each in {args.final_volume:g} uL: '
+          f'{len(plan.levels)} level(s), {plan.transfers} transfers, {plan.tips} tips')
+    for depth, level in enumerate(plan.levels):
+        into = 'the final tube' if depth == len(plan.levels) - 1 else f'{level.count} pool(s) of {level.volume:.1f} uL'
+        print(f'  level {depth + 1}: {level.transfer:.2f} uL of each {"oligo" if depth == 0 else "pool"} '
+              f'into {into}, up to {level.fan_in} per vessel')
+    before = travel(optimize(operations(plan.steps), PIPETTES), locate)
+    after = travel(optimize(operations(plan.steps), PIPETTES, locate), locate)
+    print(f'  gantry travel between wells: {before / 1000:.2f} m in step order, {after / 1000:.2f} m reordered')
+    if args.protocol:
+        params = f'{args.n_oligos} oligos at {args.target_conc:g} uM each in {args.final_volume:g} uL'
+        write_protocol(args.protocol, args.n_oligos, plan, params)
+    if args.csv:
+        write_csv(args.csv, plan)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
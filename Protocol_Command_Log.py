@@ -0,0 +1,157 @@
+import argparse
+import json
+import sys
+from collections import OrderedDict
+
+from Protocol_Run_Time_Estimator import NOTE
+
+#Streams the commands of a simulated protocol as they are issued, instead of collecting them all in protocol.commands()
+#and printing them at the end, so memory stays flat however long the run is. The simulation scripts create a CommandLog
+#right after the protocol: by default it prints every command as before (the output is unchanged), and with
+#command_log = 'run.jsonl' in the script it writes every command as one JSON record (JSON Lines) with the fields of
+#FIELDS, e.g.
+#  {"index": 12, "parent": 10, "depth": 1, "command": "aspirate", "section": "Adding buffer", "pipette": "p20_single_gen2 (right)",
+#   "labware": "corning_96_wellplate_360ul_flat", "slot": "1", "well": "A1", "volume": 5.0, "text": "Aspirating 5.0 uL from A1 of ..."}
+#The log can then be queried without parsing the command texts, e.g.
+#  python Protocol_Command_Log.py run.jsonl --command aspirate --pipette p20 --totals
+#  python Protocol_Command_Log.py run.jsonl --labware corning --well A1
+
+
+#index: order in which the command was issued; parent: index of the command it is part of (e.g. the transfer of an
+#aspirate), None at the top level; depth: number of commands it is nested in; section: text of the last protocol.comment()
+#that is not a note (see NOTE in Protocol_Run_Time_Estimator.py).
+FIELDS = ('index', 'parent', 'depth', 'command', 'section', 'pipette', 'labware', 'slot', 'well', 'volume', 'text')
+
+
+def slot_of(labware): #Deck slot of a labware, also when it sits on a module.
+    parent = labware.parent
+    while parent is not None and not isinstance(parent, str):
+        parent = getattr(parent, 'parent', None)
+    return parent
+
+
+def place(location): #(labware, well) of a command location (a Well or a Location), or (None, None).
+    if location is None:
+        return None, None
+    if hasattr(location, 'well_name'):
+        return location.parent, location.well_name
+    labware, well = location.labware.get_parent_labware_and_well()
+    return labware, well.well_name if well is not None else None
+
+
+def record(index, parent, depth, section, name, payload):
+    instrument = payload.get('instrument')
+    location = payload.get('location')
+    if location is None and 'source' in payload: #transfer(), distribute() and consolidate() start at their first source.
+        location = payload['source'][0] if isinstance(payload['source'], list) else payload['source']
+    labware, well = place(location)
+    pipette = f'{instrument.name} ({instrument.mount})' if instrument is not None else None
+    slot = slot_of(labware) if hasattr(labware, 'load_name') else None
+    volume = payload.get('volume')
+    volume = float(volume) if isinstance(volume, (int, float)) else None #Lists of volumes (transfer() with one per well) are left out.
+    return OrderedDict(zip(FIELDS, (index, parent, depth, name.split('.', 1)[-1].lower(), section, pipette,
+                                    getattr(labware, 'load_name', None), slot, well, volume, payload['text'])))
+
+
+class CommandLog:
+    """Sink for the commands of a protocol: prints their texts, or writes them to path as JSON records, as they are issued.
+    protocol.commands() stays empty while it is open."""
+
+    def __init__(self, protocol, path=None, file=None):
+        from opentrons.commands import types as command_types
+
+        self.file = open(path, 'w', encoding='utf-8') if path else None
+        self.out = self.file or file or sys.stdout
+        self.index = 0
+        self.running = [] #(message id, index) of the commands under way, outermost first.
+        self.section = None
+        #The protocol keeps every command text in memory for commands(); the log takes over from it.
+        if protocol._unsubscribe_commands:
+            protocol._unsubscribe_commands()
+            protocol._unsubscribe_commands = None
+        self.unsubscribe = protocol.broker.subscribe(command_types.COMMAND, self.on_command)
+
+    def on_command(self, message):
+        payload = message.get('payload')
+        if payload is None or payload.get('text') is None:
+            return
+        if message['$'] == 'after':
+            if self.running and self.running[-1][0] == message.get('id'):
+                self.running.pop()
+            return
+        if message['name'] == 'command.COMMENT' and not payload['text'].startswith(NOTE):
+            self.section = payload['text']
+        if self.file is None:
+            print(payload['text'], file=self.out)
+        else:
+            parent = self.running[-1][1] if self.running else None
+            entry = record(self.index, parent, len(self.running), self.section, message['name'], payload)
+            self.out.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.running.append((message.get('id'), self.index))
+        self.index += 1
+
+    def close(self):
+        self.unsubscribe()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_log(path):
+    """The records of a JSON Lines command log, one at a time."""
+    with open(path, encoding='utf-8') as rf:
+        for line in rf:
+            if line.strip():
+                yield json.loads(line)
+
+
+def matches(entry, args):
+    for field in ('command', 'slot', 'well'):
+        wanted = getattr(args, field)
+        if wanted is not None and str(entry[field]).lower() != wanted.lower():
+            return False
+    for field in ('pipette', 'labware', 'section'): #Parts of the name are enough, e.g. --pipette p20.
+        wanted = getattr(args, field)
+        if wanted is not None and wanted.lower() not in str(entry[field]).lower():
+            return False
+    return args.depth is None or entry['depth'] <= args.depth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query a JSON Lines command log written by a simulation script.')
+    parser.add_argument('log', help='.jsonl command log')
+    parser.add_argument('--command', help='command name, e.g. aspirate, dispense, pick_up_tip, transfer, comment')
+    parser.add_argument('--pipette', help='pipette name or mount, e.g. p20 or left')
+    parser.add_argument('--labware', help='labware load name or part of it')
+    parser.add_argument('--slot', help='deck slot')
+    parser.add_argument('--well', help='well name, e.g. A1')
+    parser.add_argument('--section', help='section (text of the last comment) or part of it')
+    parser.add_argument('--depth', type=int, help='only commands nested at most this deep (0: top level)')
+    parser.add_argument('--totals', action='store_true', help='print the count and volume per pipette and command instead')
+    parser.add_argument('--json', action='store_true', help='print the matching records as JSON Lines')
+    args = parser.parse_args(argv)
+
+    totals = OrderedDict() #(pipette, command): [count, volume]
+    for entry in read_log(args.log):
+        if not matches(entry, args):
+            continue
+        if args.totals:
+            total = totals.setdefault((entry['pipette'] or '-', entry['command']), [0, 0.0])
+            total[0] += 1
+            total[1] += entry['volume'] or 0
+        elif args.json:
+            print(json.dumps(entry, ensure_ascii=False))
+        else:
+            print(f"{entry['index']:>7}  {'  ' * entry['depth']}{entry['text']}")
+    for (pipette, command), (count, volume) in totals.items():
+        print(f'{pipette:<28}{command:<20}{count:>7}{volume:>12.1f} uL')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
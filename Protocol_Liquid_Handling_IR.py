@@ -0,0 +1,410 @@
+import argparse
+import inspect
+import sys
+
+#A small intermediate representation for liquid handling, shared by the protocols and the tools that generate them.
+#Instead of calling transfer() and distribute() one at a time, a protocol lists what has to be moved:
+#    Transfer(source, destination, volume, tip, mix, options) - move volume uL, optionally mixing (repetitions, uL) after
+#    Mix(well, repetitions, volume, tip)                      - mix a well
+#    Step(action, argument)                                   - 'comment', 'pause' or 'delay' (minutes); nothing moves across it
+#Locations are (labware name, well name) tuples. A destination can also be (labware name, well name, height): it is
+#dispensed into height mm above the well bottom, clear of the liquid already there, or from the top of the well for
+#'top'. tip says which operations may share a tip: None means a fresh tip that touches nothing else (a transfer that
+#needs several aspirations takes a fresh tip for each); operations with the same tip key (e.g. 'buffer' for buffer going
+#into empty wells) may share one. options are keyword arguments of transfer() and distribute() for what the defaults of
+#the executor do not cover, e.g. {'touch_tip': True} after dispensing above the liquid, {'air_gap': 2}, or
+#{'disposal_volume': 0, 'blow_out': False} for multi-dispenses that must not take more than they dispense.
+#optimize() then runs the passes below and lowers the plan for the executor:
+#    reorder             - groups independent operations by tip and source, keeping the order wherever it matters
+#    merge_same_source   - turns runs of transfers from one source with one tip into a distribute
+#    order_by_travel     - visits the destinations of every distribute in the order with the least gantry travel
+#    pack_multi_dispense - splits every distribute (and fresh-tip transfer) into single aspirations that fit the pipette
+#    assign_tips         - picks up a new tip only where the tip key changes
+#The lowered plan is a list of plain tuples, so a generated protocol can carry it as data next to the source of
+#execute() (see protocol_source) and stay a single self-contained file for the robot. Protocols that plan on the robot
+#(the robot-ready MegaTron and Greta Tronberg files) carry a copy of the code between the markers below instead, kept up
+#to date with: python Protocol_Liquid_Handling_IR.py --embed (--check only reports copies that are out of date).
+#Example:
+#    plan = [Transfer(('reservoir', 'A1'), ('plate', well), 50, tip='buffer') for well in wells]
+#    execute(protocol, {'reservoir': reservoir, 'plate': plate}, {'p300': p300}, optimize(plan, {'p300': (20, 300)}))
+
+
+EMBEDDED = ('MegaTron_DNA_Nanotech_RobotReady.py', 'Greta_Tronberg_Robot_Ready.py')
+BEGIN = '#--- Protocol_Liquid_Handling_IR.py'
+END = '#--- end of Protocol_Liquid_Handling_IR.py ---'
+
+#--- Protocol_Liquid_Handling_IR.py (copied into robot-ready protocols by python Protocol_Liquid_Handling_IR.py --embed) ---
+import heapq
+import math
+from collections import namedtuple
+
+Transfer = namedtuple('Transfer', ['source', 'destination', 'volume', 'tip', 'mix', 'options'], defaults=(None, None, None))
+Mix = namedtuple('Mix', ['well', 'repetitions', 'volume', 'tip'], defaults=(None,))
+Step = namedtuple('Step', ['action', 'argument'])
+Distribute = namedtuple('Distribute', ['source', 'destinations', 'volumes', 'tip', 'options'])
+
+STEP_ACTIONS = ('comment', 'pause', 'delay')
+
+
+def pipette_for(volume, pipettes):
+    """Smallest pipette (name) that can take the volume; pipettes maps names to (minimum, maximum) uL.
+    Volumes above the largest pipette go to it; the executor splits them over several aspirations."""
+    fitting = [(maximum, name) for name, (minimum, maximum) in pipettes.items() if minimum <= volume <= maximum]
+    if fitting:
+        return min(fitting)[1]
+    return max((maximum, name) for name, (_, maximum) in pipettes.items())[1]
+
+
+def wells_used(operation): #(well, kind) pairs: 'r' reads, 'w' adds to, 'm' mixes. Adding commutes, and so does reading.
+    if isinstance(operation, Transfer):
+        destination = operation.destination[:2] #The same well, whatever the height it is dispensed from.
+        used = [(operation.source[:2], 'r'), (destination, 'w')]
+        return used + [(destination, 'm')] if operation.mix else used
+    return [(operation.well[:2], 'm')]
+
+
+def dependencies(operations): #For each operation, the earlier operations it has to stay after.
+    #Per well, the history is a series of groups: several reads, several additions, or one mix. An operation joins the
+    #last group if it commutes with it, and otherwise depends on every operation of that group.
+    groups = {} #well: (kind, members, members of the group before)
+    depends = []
+    for index, operation in enumerate(operations):
+        after = set()
+        for well, kind in wells_used(operation):
+            last_kind, members, before = groups.get(well, (None, [], []))
+            if kind == last_kind and kind != 'm':
+                after.update(before)
+                members.append(index)
+            else:
+                after.update(members)
+                groups[well] = (kind, [index], members)
+        after.discard(index)
+        depends.append(after)
+    return depends
+
+
+def reorder(operations, pipettes):
+    """Reorders the operations between steps so that those sharing a pipette, tip and source follow each other.
+    An operation never moves before one it depends on, so the result is the same liquid in every well."""
+    result, segment = [], []
+    for operation in list(operations) + [None]:
+        if operation is not None and not isinstance(operation, Step):
+            segment.append(operation)
+            continue
+        depends = dependencies(segment)
+        waiting = [len(after) for after in depends]
+        followers = [[] for _ in segment]
+        for index, after in enumerate(depends):
+            for earlier in after:
+                followers[earlier].append(index)
+        ready = [index for index, count in enumerate(waiting) if count == 0]
+        heapq.heapify(ready)
+        last = None
+        while ready:
+            #Keep on with the same pipette, tip and source if possible, else take the earliest operation.
+            choice = None
+            if last is not None and last.tip is not None:
+                choice = min((index for index in ready if same_run(last, segment[index], pipettes)), default=None)
+            if choice is None:
+                choice = heapq.heappop(ready)
+            else:
+                ready.remove(choice)
+                heapq.heapify(ready)
+            last = segment[choice]
+            result.append(last)
+            for follower in followers[choice]:
+                waiting[follower] -= 1
+                if waiting[follower] == 0:
+                    heapq.heappush(ready, follower)
+        segment = []
+        if operation is not None:
+            result.append(operation)
+    return result
+
+
+def same_run(first, second, pipettes): #Can the two operations share a tip and an aspiration run?
+    return (isinstance(first, Transfer) and isinstance(second, Transfer) and first.tip is not None
+            and first.tip == second.tip and first.source == second.source and not first.mix and not second.mix
+            and first.options == second.options and pipette_for(first.volume, pipettes) == pipette_for(second.volume, pipettes))
+
+
+def merge_same_source(operations, pipettes): #Runs of transfers that share a source and a tip become one Distribute.
+    result = []
+    for operation in operations:
+        previous = result[-1] if result else None
+        if isinstance(previous, Distribute) and same_run(Transfer(previous.source, None, previous.volumes[0], previous.tip,
+                                                                  options=previous.options), operation, pipettes):
+            previous.destinations.append(operation.destination)
+            previous.volumes.append(operation.volume)
+        elif isinstance(operation, Transfer) and operation.tip is not None and not operation.mix:
+            result.append(Distribute(operation.source, [operation.destination], [operation.volume], operation.tip,
+                                     operation.options))
+        else:
+            result.append(operation)
+    return result
+
+
+def travel_order(points):
+    """Order (a list of indexes) in which to visit (x, y) points with the least travel, starting at the first one:
+    nearest neighbour, then 2-opt (reversing any stretch of the route that makes it shorter) until nothing improves."""
+    if len(points) < 3:
+        return list(range(len(points)))
+    def distance(a, b):
+        return math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+    route, left = [0], list(range(1, len(points)))
+    while left:
+        nearest = min(left, key=lambda point: distance(route[-1], point)) #Ties go to the earlier point.
+        left.remove(nearest)
+        route.append(nearest)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route) - 1):
+            for k in range(i + 1, len(route)):
+                after = route[k + 1] if k + 1 < len(route) else None
+                change = distance(route[i - 1], route[k]) - distance(route[i - 1], route[i])
+                if after is not None:
+                    change += distance(route[i], after) - distance(route[k], after)
+                if change < -1e-9:
+                    route[i:k + 1] = reversed(route[i:k + 1])
+                    improved = True
+    return route
+
+
+def order_by_travel(operations, locate):
+    """Reorders the destinations of every Distribute for the least travel from the source. They all get the same liquid
+    from the same tip, so any order gives the same result. locate maps a location to its (x, y) on the deck in mm."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Distribute) and len(operation.destinations) > 2:
+            route = travel_order([locate(operation.source)] + [locate(destination) for destination in operation.destinations])
+            order = [index - 1 for index in route[1:]]
+            operation = operation._replace(destinations=[operation.destinations[i] for i in order],
+                                           volumes=[operation.volumes[i] for i in order])
+        result.append(operation)
+    return result
+
+
+def pack_multi_dispense(operations, pipettes):
+    """Splits every Distribute into chunks that fit in one aspiration (with the pipette's minimum volume as disposal
+    volume, unless its options set disposal_volume). A chunk with a single destination is a plain Transfer again.
+    A fresh-tip Transfer too big for one aspiration is split into even ones, each with its own tip, as
+    new_tip='always' does, so a tip that has been in the destination never goes back to the source."""
+    result = []
+    for operation in operations:
+        if isinstance(operation, Transfer) and operation.tip is None:
+            maximum = pipettes[pipette_for(operation.volume, pipettes)][1]
+            strokes = math.ceil(operation.volume / maximum)
+            result += [operation._replace(volume=operation.volume / strokes)] * strokes if strokes > 1 else [operation]
+            continue
+        if not isinstance(operation, Distribute):
+            result.append(operation)
+            continue
+        minimum, maximum = pipettes[pipette_for(operation.volumes[0], pipettes)]
+        minimum = (operation.options or {}).get('disposal_volume', minimum)
+        chunk, total = [], minimum
+        for destination, volume in zip(operation.destinations, operation.volumes):
+            if chunk and total + volume > maximum:
+                result.append(chunk_operation(operation, chunk))
+                chunk, total = [], minimum
+            chunk.append((destination, volume))
+            total += volume
+        result.append(chunk_operation(operation, chunk))
+    return result
+
+
+def chunk_operation(operation, chunk):
+    if len(chunk) == 1:
+        return Transfer(operation.source, chunk[0][0], chunk[0][1], operation.tip, options=operation.options)
+    return Distribute(operation.source, [destination for destination, _ in chunk], [volume for _, volume in chunk],
+                      operation.tip, operation.options)
+
+
+def assign_tips(operations, pipettes):
+    """Lowers the operations to the executor's tuples, with a new tip only where the tip key of a pipette changes:
+        ('transfer', pipette, new_tip, source, destination, volume, mix, options)
+        ('distribute', pipette, new_tip, source, destinations, volumes, options)
+        ('mix', pipette, new_tip, well, repetitions, volume)
+        (action, argument) for steps"""
+    lowered, held = [], {}
+    for operation in operations:
+        if isinstance(operation, Step):
+            lowered.append((operation.action, operation.argument))
+            continue
+        volume = operation.volumes[0] if isinstance(operation, Distribute) else operation.volume
+        pipette = pipette_for(volume, pipettes)
+        new_tip = operation.tip is None or held.get(pipette) != operation.tip
+        held[pipette] = operation.tip
+        if isinstance(operation, Transfer):
+            lowered.append(('transfer', pipette, new_tip, operation.source, operation.destination, operation.volume,
+                            operation.mix, operation.options))
+        elif isinstance(operation, Distribute):
+            lowered.append(('distribute', pipette, new_tip, operation.source, operation.destinations, operation.volumes,
+                            operation.options))
+        else:
+            lowered.append(('mix', pipette, new_tip, operation.well, operation.repetitions, operation.volume))
+    return lowered
+
+
+def optimize(operations, pipettes, locate=None):
+    """Runs all the passes (order_by_travel only if locate is given); returns the lowered plan for execute()."""
+    operations = reorder(operations, pipettes)
+    operations = merge_same_source(operations, pipettes)
+    if locate is not None:
+        operations = order_by_travel(operations, locate)
+    operations = pack_multi_dispense(operations, pipettes)
+    return assign_tips(operations, pipettes)
+
+
+def count_tips(lowered): #Tips picked up by each pipette to run a lowered plan.
+    tips = {}
+    for action, *arguments in lowered:
+        if action not in STEP_ACTIONS:
+            tips[arguments[0]] = tips.get(arguments[0], 0) + arguments[1]
+    return tips
+
+
+def travel(lowered, locate):
+    """Gantry travel (mm) between the wells a lowered plan visits, using locate as in order_by_travel. Tip pick-ups and
+    drops are left out: they take the same travel whatever the order of the wells."""
+    total, last = 0.0, None
+    for action, *arguments in lowered:
+        if action in STEP_ACTIONS:
+            continue
+        if arguments[1]:
+            last = None
+        if action == 'mix':
+            path = [arguments[2]]
+        elif action == 'transfer':
+            path = arguments[2:4]
+        else:
+            source, destinations = arguments[2:4]
+            #A packed distribute is one aspiration: the source, then every destination in turn.
+            path = [source] + list(destinations)
+        for location in path:
+            point = locate(location)
+            if last is not None:
+                total += math.hypot(point[0] - last[0], point[1] - last[1])
+            last = point
+    return total
+
+
+def execute_step(protocol, labware, pipettes, step):
+    """Runs one step of a lowered plan; labware and pipettes map the names in the plan to the loaded objects.
+    Generated protocols carry the executor as it is (see protocol_source), so it only uses the protocol API."""
+    def well(location):
+        if len(location) < 3:
+            return labware[location[0]][location[1]]
+        if location[2] == 'top':
+            return labware[location[0]][location[1]].top()
+        return labware[location[0]][location[1]].bottom(location[2]) #Dispensed into from above the liquid.
+
+    action, *arguments = step
+    if action == 'comment':
+        protocol.comment(arguments[0])
+        return
+    if action == 'pause':
+        protocol.pause(arguments[0])
+        return
+    if action == 'delay':
+        protocol.delay(minutes=arguments[0])
+        return
+    pipette = pipettes[arguments[0]]
+    if arguments[1]:
+        if pipette.has_tip:
+            pipette.drop_tip()
+        pipette.pick_up_tip()
+    if action == 'transfer':
+        source, destination, volume, mix, options = arguments[2:]
+        settings = dict(mix_after=mix, blow_out=True, blowout_location='destination well')
+        settings.update(options or {})
+        pipette.transfer(volume, well(source), well(destination), new_tip='never', **settings)
+    elif action == 'distribute':
+        #The disposal volume is blown out into the trash: the source is a stock the tip must not bring anything back to.
+        source, destinations, volumes, options = arguments[2:]
+        settings = dict(disposal_volume=pipette.min_volume, blow_out=True, blowout_location='trash')
+        settings.update(options or {})
+        pipette.distribute(volumes, well(source), [well(destination) for destination in destinations], new_tip='never',
+                           **settings)
+    else:
+        location, repetitions, volume = arguments[2:]
+        pipette.mix(repetitions, volume, well(location))
+
+
+def drop_tips(pipettes): #At the end of a plan, the pipettes still hold the tips of its last steps.
+    for pipette in pipettes.values():
+        if pipette.has_tip:
+            pipette.drop_tip()
+
+
+def execute(protocol, labware, pipettes, plan): #Runs a whole lowered plan (see execute_step).
+    for step in plan:
+        execute_step(protocol, labware, pipettes, step)
+    drop_tips(pipettes)
+#--- end of Protocol_Liquid_Handling_IR.py ---
+
+
+def plan_source(lowered, name='plan'): #A lowered plan as Python source.
+    return '\n'.join([f'{name} = ['] + [f'    {step!r},' for step in lowered] + [']'])
+
+
+def protocol_source(lowered, name='plan'): #The plan and the executor, to write into a generated protocol.
+    executor = '\n\n'.join(inspect.getsource(function) for function in (execute_step, drop_tips, execute))
+    return '# Liquid-handling plan (see Protocol_Liquid_Handling_IR.py)\n' + plan_source(lowered, name) + '\n\n' + executor
+
+
+def marked_block(lines, path): #(first, last) line indexes of the IR code between the markers.
+    first = next((i for i, line in enumerate(lines) if line.startswith(BEGIN)), None)
+    last = next((i for i, line in enumerate(lines) if line.rstrip() == END), None)
+    if first is None or last is None or last < first:
+        raise ValueError(f'{path} has no {BEGIN} ... {END} block')
+    return first, last
+
+
+def library_source(): #The IR code between the markers, with them, as copied into robot-ready protocols.
+    with open(__file__, encoding='utf-8') as rf:
+        lines = rf.read().splitlines(keepends=True)
+    first, last = marked_block(lines, __file__)
+    return ''.join(lines[first:last + 1])
+
+
+def embed(path, check=False):
+    """Replaces the IR block of a protocol with the current code (or with check, only compares them).
+    Returns True if the copy was out of date."""
+    with open(path, encoding='utf-8') as rf:
+        lines = rf.read().splitlines(keepends=True)
+    first, last = marked_block(lines, path)
+    library = library_source()
+    if ''.join(lines[first:last + 1]) == library:
+        return False
+    if not check:
+        with open(path, 'w', encoding='utf-8') as wf:
+            wf.write(''.join(lines[:first]) + library + ''.join(lines[last + 1:]))
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy the IR code into the robot-ready protocols that plan on the robot.')
+    parser.add_argument('protocols', nargs='*', default=list(EMBEDDED), help=f"default: {' '.join(EMBEDDED)}")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--embed', action='store_true', help='update the copies')
+    mode.add_argument('--check', action='store_true', help='only report the copies that are out of date (exit status 1)')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for path in args.protocols:
+        try:
+            changed = embed(path, check=args.check)
+        except (OSError, ValueError) as error:
+            print(f'{path}: {error}', file=sys.stderr)
+            failed = True
+            continue
+        if changed:
+            print(f'{path}: out of date' if args.check else f'{path}: updated')
+            failed = failed or args.check
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
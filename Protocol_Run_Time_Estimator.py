@@ -0,0 +1,207 @@
+import argparse
+import ast
+import math
+import re
+import sys
+from collections import OrderedDict
+
+#Estimates how long a protocol will take on the OT-2 from its simulated command stream, i.e. the lines the simulation
+#scripts print as they run (or the .jsonl command logs they write, see Protocol_Command_Log.py). Gives the total and a
+#breakdown per phase (liquid handling, gantry travel, tips, module holds, temperature changes, pauses) and per protocol
+#section (sections start at every protocol.comment(), except the notes that start with 'Note: ').
+#The temperature module keeps ramping while the robot pipettes: a ramp started with start_set_temperature() only costs
+#what is left of it when await_temperature() is reached ('Waiting for Temperature Module...'), so the pipetting the
+#pipelined MegaTron plates do during the annealing ramps is not counted twice. set_temperature() prints the same line as
+#start_set_temperature(), so a ramp that is never waited for is taken to have blocked the robot and is counted in full.
+#Example: python MegaTron_DNA_Nanotech_Simulate.py | python Protocol_Run_Time_Estimator.py
+#The timings below are typical OT-2 values; adjust them to match your robot. The MegaTron scripts plan their pipelined
+#plates with them (MegaTron_DNA_Nanotech_RobotReady.py has its own copy, to run on the robot on its own).
+
+
+TIMING = {
+    'gantry_speed': 400,           #mm/s, x/y travel between wells
+    'move_overhead': 1.5,          #s per move between wells: lift, lower and acceleration
+    'aspirate_overhead': 0.5,      #s per aspirate/dispense on top of volume / flow rate
+    'pick_up_tip': 4.0,            #s to press the tips on
+    'drop_tip': 3.0,               #s to eject the tips
+    'blow_out': 1.0,               #s
+    'touch_tip': 2.5,              #s
+    'air_gap': 1.5,                #s
+    'tempdeck_heat_rate': 0.3,     #deg C/s, temperature module heating
+    'tempdeck_cool_rate': 0.15,    #deg C/s, temperature module cooling
+    'block_heat_rate': 3.0,        #deg C/s, thermocycler block heating
+    'block_cool_rate': 2.0,        #deg C/s, thermocycler block cooling
+    'lid_heat_rate': 0.5,          #deg C/s, thermocycler lid
+    'lid_move': 20.0,              #s to open or close the thermocycler lid
+    'pause': 120.0,                #s the operator is assumed to need at each protocol.pause()
+    'room_temperature': 25.0,      #deg C modules start at
+}
+
+#Comments starting with NOTE only inform the operator (tip budgets, gantry travel...) and do not start a section.
+NOTE = 'Note: '
+
+PHASES = ('liquid handling', 'gantry travel', 'tips', 'module holds', 'temperature changes', 'pauses')
+
+#Deck slot positions (mm, front left corner) and the pitch used to place wells inside a slot.
+SLOT_SIZE = (132.5, 90.5)
+WELL_PITCH = 9.0
+
+VOLUME_RE = re.compile(r'^(Aspirating|Dispensing) ([\d.]+) uL .* at ([\d.]+) uL/sec$')
+LOCATION_RE = re.compile(r'(?:from|into|at) ([A-P])(\d+) of .* on (\d+)(?: at [\d.]+ uL/sec)?$')
+TEMPERATURE_RE = re.compile(r'(-?[\d.]+) °C')
+DELAY_RE = re.compile(r'^Delaying for (\d+) minutes and ([\d.]+) seconds')
+PROFILE_RE = re.compile(r'^Thermocycler starting (\d+) repetitions of cycle composed of the following steps: (\[.*\])')
+#Parent commands (transfer, distribute, ...) only group the commands below them and take no time themselves.
+GROUPING = ('Transferring', 'Distributing', 'Consolidating', 'Mixing')
+
+
+def deck_position(slot, well): #(x, y) in mm of a well (e.g. 'B3') of the labware in a deck slot.
+    row, column = well[0], int(well[1:])
+    slot_x = (slot - 1) % 3 * SLOT_SIZE[0]
+    slot_y = (slot - 1) // 3 * SLOT_SIZE[1]
+    return slot_x + (column - 1) * WELL_PITCH, slot_y + SLOT_SIZE[1] - (ord(row) - ord('A')) * WELL_PITCH
+
+
+def position(line): #(x, y) of the well a command goes to, or None if the line has no location.
+    match = LOCATION_RE.search(line)
+    if not match:
+        return None
+    return deck_position(int(match.group(3)), match.group(1) + match.group(2))
+
+
+def ramp(current, target, heat_rate, cool_rate): #Seconds to go from current to target temperature.
+    if target >= current:
+        return (target - current) / heat_rate
+    return (current - target) / cool_rate
+
+
+def profile_time(steps, repetitions, block_temperature, timing): #Hold times plus the ramps between steps of a thermocycler profile.
+    seconds = ramping = 0.0
+    for _ in range(repetitions):
+        for step in steps:
+            ramping += ramp(block_temperature, step['temperature'], timing['block_heat_rate'], timing['block_cool_rate'])
+            block_temperature = step['temperature']
+            seconds += step.get('hold_time_seconds', 0) + 60 * step.get('hold_time_minutes', 0)
+    return seconds, ramping, block_temperature
+
+
+def estimate(commands, timing=TIMING):
+    """Estimates the run time of a simulated command stream (any iterable of command strings).
+    Returns (phases, sections): phases maps every phase in PHASES to [seconds, number of commands];
+    sections maps each protocol section (started by a comment) to its seconds, in protocol order.
+    """
+    phases = OrderedDict((phase, [0.0, 0]) for phase in PHASES)
+    sections = OrderedDict([('(start)', 0.0)])
+    section = '(start)'
+    head = None #Where the pipettes are.
+    temperatures = {'tempdeck': timing['room_temperature'], 'block': timing['room_temperature'], 'lid': timing['room_temperature']}
+
+    clock = 0.0 #Seconds of the run so far.
+    ramping = None #(seconds, clock at its start, section) of the last temperature module ramp, until it is waited for.
+
+    def add(phase, seconds, where=None):
+        nonlocal clock
+        phases[phase][0] += seconds
+        phases[phase][1] += 1
+        sections[where or section] += seconds
+        clock += seconds
+
+    for line in commands:
+        line = line.strip()
+        if not line or line.startswith(GROUPING):
+            continue
+        here = position(line)
+        if here is not None and here != head:
+            distance = 0.0 if head is None else math.dist(head, here)
+            add('gantry travel', timing['move_overhead'] + distance / timing['gantry_speed'])
+            head = here
+
+        volume = VOLUME_RE.match(line)
+        if volume:
+            add('liquid handling', timing['aspirate_overhead'] + float(volume.group(2)) / float(volume.group(3)))
+        elif line.startswith('Blowing out'):
+            add('liquid handling', timing['blow_out'])
+        elif line.startswith('Touching tip'):
+            add('liquid handling', timing['touch_tip'])
+        elif line.startswith('Air gap'):
+            add('liquid handling', timing['air_gap'])
+        elif line.startswith('Picking up tip'):
+            add('tips', timing['pick_up_tip'])
+        elif line.startswith('Dropping tip'):
+            add('tips', timing['drop_tip'])
+        elif line.startswith('Delaying for'):
+            minutes, seconds = DELAY_RE.match(line).groups()
+            add('module holds', 60 * int(minutes) + float(seconds))
+        elif line.startswith('Pausing robot operation'):
+            add('pauses', timing['pause'])
+        elif line.startswith('Thermocycler starting'):
+            repetitions, steps = PROFILE_RE.match(line).groups()
+            hold, block_ramp, temperatures['block'] = profile_time(ast.literal_eval(steps), int(repetitions), temperatures['block'], timing)
+            add('module holds', hold)
+            add('temperature changes', block_ramp)
+        elif line.startswith('Setting Temperature Module temperature'):
+            if ramping is not None: #Never waited for: set_temperature(), which holds the robot for the whole ramp.
+                add('temperature changes', ramping[0], ramping[2])
+            target = float(TEMPERATURE_RE.search(line).group(1))
+            ramping = (ramp(temperatures['tempdeck'], target, timing['tempdeck_heat_rate'], timing['tempdeck_cool_rate']), clock, section)
+            temperatures['tempdeck'] = target
+        elif line.startswith('Waiting for Temperature Module'):
+            if ramping is not None: #Only what is left of the ramp after the commands run since it started.
+                add('temperature changes', max(0.0, ramping[0] - (clock - ramping[1])), ramping[2])
+                ramping = None
+        elif line.startswith('Setting Thermocycler well block temperature'):
+            target = float(TEMPERATURE_RE.search(line).group(1))
+            add('temperature changes', ramp(temperatures['block'], target, timing['block_heat_rate'], timing['block_cool_rate']))
+            temperatures['block'] = target
+        elif line.startswith('Setting Thermocycler lid temperature'):
+            target = float(TEMPERATURE_RE.search(line).group(1))
+            add('temperature changes', ramp(temperatures['lid'], target, timing['lid_heat_rate'], timing['lid_heat_rate']))
+            temperatures['lid'] = target
+        elif line.startswith(('Opening Thermocycler lid', 'Closing Thermocycler lid')):
+            add('module holds', timing['lid_move'])
+        elif here is None and not line.startswith(('Deactivating', 'Homing', 'Moving', 'Engaging', 'Disengaging', NOTE)):
+            section = line #Anything else is a protocol.comment(), which starts a new section.
+            sections.setdefault(section, 0.0)
+    if ramping is not None:
+        add('temperature changes', ramping[0], ramping[2])
+    return phases, sections
+
+
+def hms(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def report(phases, sections, file=sys.stdout):
+    total = sum(seconds for seconds, _ in phases.values())
+    print(f'Estimated run time: {hms(total)} ({total / 3600:.2f} robot-hours)', file=file)
+    print('\nBy phase:', file=file)
+    for phase, (seconds, count) in phases.items():
+        share = 100 * seconds / total if total else 0
+        print(f'  {phase:<22}{hms(seconds):>10}{share:7.1f} %{count:8d} commands', file=file)
+    print('\nBy section:', file=file)
+    for section, seconds in sections.items():
+        if seconds:
+            print(f'  {hms(seconds):>10}  {section}', file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate OT-2 run time from a simulated protocol command stream.')
+    parser.add_argument('files', nargs='*', help='files with the printed commands or .jsonl command logs (default: read standard input)')
+    args = parser.parse_args(argv)
+    if not args.files:
+        report(*estimate(sys.stdin))
+    for path in args.files:
+        print(f'== {path}')
+        if path.endswith('.jsonl'): #A command log streamed by a simulation script (see Protocol_Command_Log.py).
+            from Protocol_Command_Log import read_log
+            report(*estimate(entry['text'] for entry in read_log(path)))
+            continue
+        with open(path, encoding='utf-8') as rf:
+            report(*estimate(rf))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
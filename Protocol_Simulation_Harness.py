@@ -0,0 +1,143 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import re
+import runpy
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Protocol_Run_Time_Estimator import estimate
+
+#Simulates every protocol in the repository in parallel worker processes and collects command counts, tip usage,
+#simulation time and the estimated run time into one report:
+#- the simulation scripts (*_Simulate.py, *_Simulation.py, Simulation_*.py), run as they are with their output captured;
+#- Template_Protocol_Isaac_Newtron.py, generated with the prom_utr (and layout) given by --prom-utr;
+#- the protocols inside Tron_Weiss_New_Protocol.zip.
+#Example: python Protocol_Simulation_Harness.py --prom-utr 3,5 --prom-utr 8,12,multichannel --labware-dir labware/
+#Protocols using custom labware (e.g. the 4titude plates of the Isaac Newtron template) need their definitions in --labware-dir.
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATTERNS = ('*_Simulate.py', '*_Simulation.py', 'Simulation_*.py')
+TEMPLATE = 'Template_Protocol_Isaac_Newtron.py'
+ZIPPED_PROTOCOLS = (('Tron_Weiss_New_Protocol.zip', 'New Protocol/Final - Cycle_0_Protocol.py'),)
+
+
+def discover(prom_utrs): #Returns the jobs to run as (name, kind, source, arguments).
+    jobs = []
+    for pattern in SCRIPT_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(REPO_DIR, pattern))):
+            jobs.append((os.path.basename(path), 'script', path, None))
+    for prom_utr in prom_utrs:
+        _, params = protocol_job(TEMPLATE, prom_utr)
+        jobs.append((f"{TEMPLATE} {params['prom_utr']} {params['layout']}", 'template', os.path.join(REPO_DIR, TEMPLATE), params))
+    for archive, member in ZIPPED_PROTOCOLS:
+        if os.path.exists(os.path.join(REPO_DIR, archive)):
+            jobs.append((f'{archive}: {os.path.basename(member)}', 'zipped', os.path.join(REPO_DIR, archive), member))
+    return jobs
+
+
+def flatten(runlog): #Command texts of an opentrons.simulate run log, parent commands before their children.
+    for entry in runlog:
+        yield entry['payload']['text']
+        yield from flatten(entry.get('subcommands', []))
+
+
+def protocol_job(path, prom_utr=None): #(kind, arguments) to simulate a protocol file with; prom_utr is for the template.
+    if os.path.basename(path) == TEMPLATE:
+        n_promoters, n_utr, *layout = (prom_utr or '3,5').split(',')
+        return 'template', {'prom_utr': (int(n_promoters), int(n_utr)), 'layout': layout[0] if layout else 'single'}
+    with open(path, encoding='utf-8') as rf: #Simulation scripts can mention run() in comments, protocols define it.
+        return ('protocol' if re.search(r'^def run\(', rf.read(), re.MULTILINE) else 'script'), None
+
+
+def protocol_text(kind, source, arguments): #(file name, code) of a protocol simulated with opentrons.simulate.simulate().
+    if kind == 'template':
+        from GUI_Isaac_Newtron import compile_template, protocol_globals
+        template = compile_template(source)
+        return os.path.basename(source), template.head + protocol_globals(arguments) + '\n' + template.body
+    if kind == 'zipped':
+        with zipfile.ZipFile(source) as archive:
+            return os.path.basename(arguments), archive.read(arguments).decode('utf-8')
+    with open(source, encoding='utf-8') as rf: #A protocol file with run(), as loaded into the OT-2 app.
+        return os.path.basename(source), rf.read()
+
+
+def simulate_protocol(kind, source, arguments, labware_dir): #Runs in a worker process; returns the list of command texts.
+    if kind == 'script':
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output): #The scripts print every command as it is issued (see Protocol_Command_Log.py).
+            try:
+                runpy.run_path(source, run_name='__main__')
+            except SystemExit as error: #The parameter checks of the simulation scripts stop with sys.exit().
+                raise RuntimeError(f'script exited early ({error.code})') from None
+        return output.getvalue().splitlines()
+
+    from opentrons import simulate
+    file_name, code = protocol_text(kind, source, arguments)
+    custom_labware = [labware_dir] if labware_dir else None
+    runlog, _ = simulate.simulate(io.StringIO(code), file_name, custom_labware_paths=custom_labware)
+    return list(flatten(runlog))
+
+
+def run_job(name, kind, source, arguments, labware_dir): #Simulates one protocol and summarises its command stream.
+    start = time.perf_counter()
+    try:
+        commands = simulate_protocol(kind, source, arguments, labware_dir)
+    except Exception as error: #opentrons errors can carry tracebacks, which cannot be sent back from a worker process.
+        raise RuntimeError(f'{type(error).__name__}: {error}') from None
+    phases, _ = estimate(commands)
+    return {
+        'protocol': name,
+        'commands': len(commands),
+        'tips': sum(command.startswith('Picking up tip') for command in commands),
+        'aspirations': sum(command.startswith('Aspirating') for command in commands),
+        'simulation_seconds': round(time.perf_counter() - start, 3),
+        'estimated_run_hours': round(sum(seconds for seconds, _ in phases.values()) / 3600, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate all protocols of the repository in parallel and report on them.')
+    parser.add_argument('--prom-utr', action='append', default=None, metavar='N_PROMOTERS,N_UTR[,LAYOUT]',
+                        help='parameters to generate the Isaac Newtron template with; can be repeated (default: 3,5)')
+    parser.add_argument('--labware-dir', help='folder with custom labware definitions (.json)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--json', help='also save the report to this .json file')
+    args = parser.parse_args(argv)
+
+    jobs = discover(args.prom_utr or ['3,5'])
+    results, failed = [], 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_job, name, kind, source, arguments, args.labware_dir): name
+                   for name, kind, source, arguments in jobs}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                failed += 1
+                results.append({'protocol': futures[future], 'error': str(error).splitlines()[0]})
+
+    results.sort(key=lambda result: result['protocol'])
+    print(f"{'protocol':<60}{'commands':>9}{'tips':>6}{'aspirations':>12}{'sim s':>8}{'run h':>7}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['protocol']:<60}  FAILED: {result['error']}")
+        else:
+            print(f"{result['protocol']:<60}{result['commands']:>9}{result['tips']:>6}{result['aspirations']:>12}"
+                  f"{result['simulation_seconds']:>8.2f}{result['estimated_run_hours']:>7.2f}")
+    print(f'{len(jobs) - failed}/{len(jobs)} protocols simulated in {time.perf_counter() - start:.2f} s')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as wf:
+            json.dump(results, wf, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
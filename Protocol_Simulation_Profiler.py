@@ -0,0 +1,251 @@
+import argparse
+import contextlib
+import inspect
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+
+from Protocol_Simulation_Harness import protocol_job, protocol_text, simulate_protocol
+
+#Profiles the simulation of a protocol step by step, to find out what makes a simulation slow (labware loading, the
+#dilution transfers, the per-well DNA loop...) or what makes the plan big. Every call to the protocol, the pipettes and
+#the modules is timed and counted, and tagged with the step of the protocol it was made from. The step is read from the
+#protocol itself: the comment heading the block of code the call is in (e.g. '# Step 3 - Mix oligos and dilute' and
+#'# Prepare Type II tube' in MegaTron), and the functions of the protocol it went through.
+#Prints the time, calls and commands of every step, and with --folded writes the profile as folded stacks
+#(step;...;InstrumentContext.transfer;InstrumentContext.aspirate <microseconds>) for flamegraph.pl, speedscope or inferno.
+#Example: python Protocol_Simulation_Profiler.py MegaTron_DNA_Nanotech_Simulate.py --folded megatron.folded
+#         flamegraph.pl megatron.folded > megatron.svg
+#         python Protocol_Simulation_Profiler.py Template_Protocol_Isaac_Newtron.py --prom-utr 12,8 --labware-dir labware/ --weight commands --folded plan.folded
+#Profiling is opt-in: the protocols run unchanged, and nothing is wrapped outside of this tool. Times include the
+#overhead of the wrappers, so compare steps with each other rather than with an unprofiled run.
+
+
+WEIGHTS = ('time', 'calls', 'commands')
+STEP_RE = re.compile(r'^(Step\s*\d+.*|-{3,}\s*(?P<banner>.*?)\s*-{3,})$', re.IGNORECASE) #Headings of whole protocol parts.
+NOT_HEADING_RE = re.compile(r'^(In\[.*\]:?|-\*-.*-\*-|coding[:=].*|!.*)$') #Notebook cell markers, encoding lines and shebangs.
+
+
+def profiled_classes():
+    from opentrons import protocol_api
+    return [getattr(protocol_api, name) for name in ('ProtocolContext', 'InstrumentContext', 'TemperatureModuleContext',
+            'ThermocyclerContext', 'MagneticModuleContext', 'HeaterShakerContext') if hasattr(protocol_api, name)]
+
+
+def comment_text(line): #Text of a comment line, up to the end of its first sentence.
+    return re.split(r'[.:](?:\s|$)', line.strip().lstrip('#').strip())[0].replace(';', ',')
+
+
+def indentation(line):
+    return len(line) - len(line.lstrip())
+
+
+def headings(lines, code, line):
+    """The step headings of a line of a protocol: the comment block above it at the indentation of the body of its function
+    (or of the module) and, above that, the 'Step n' or '---- BANNER ----' heading of the part it is in."""
+    first = code.co_firstlineno if code.co_name != '<module>' else 0
+    body = next((indentation(text) for text in lines[first:line] if text.strip() and not text.lstrip().startswith('#')), 0)
+    block, part = None, None
+    number = line - 2 #Index of the line above.
+    while number >= first:
+        text = lines[number]
+        if not text.lstrip().startswith('#') or indentation(text) != body or NOT_HEADING_RE.match(comment_text(text)):
+            number -= 1
+            continue
+        top = number
+        while top - 1 >= first and lines[top - 1].lstrip().startswith('#') and indentation(lines[top - 1]) == body:
+            top -= 1
+        step = next((STEP_RE.match(comment_text(lines[i])) for i in range(top, number + 1) if STEP_RE.match(comment_text(lines[i]))), None)
+        if step is not None:
+            part = step.group('banner') or step.group(0)
+            break
+        if block is None and (code.co_name == '<module>' or top > first): #Not the description at the top of a function.
+            block = comment_text(lines[top])
+        number = top - 1
+    return [heading for heading in (part, block) if heading]
+
+
+class Profile:
+    """Time (self time, s), calls and commands of every stack of a simulated protocol. A stack is (step, calls): step is
+    the place in the protocol (headings and functions), calls the protocol, pipette and module calls in progress."""
+
+    def __init__(self, filename, lines):
+        self.filename, self.lines = filename, lines
+        self.stacks = OrderedDict() #(step, calls): [seconds, calls, commands]
+        self.running = [] #[stack, start, seconds spent in nested calls] of the calls in progress, outermost first.
+        self.places = {} #(code, line): headings, so the protocol is only read once per line.
+        self.step = ('(start)',) #Step of the last outermost call; the code run before the first call is the start.
+        self.mark = time.perf_counter() #End of the last outermost call.
+
+    def add(self, stack, seconds=0.0, calls=0, commands=0):
+        totals = self.stacks.setdefault(stack, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+        totals[2] += commands
+
+    def where(self, frame): #Step of a call made from frame: the headings and functions of the protocol it is in.
+        frames = []
+        while frame is not None:
+            if frame.f_code.co_filename == self.filename:
+                frames.append(frame)
+            frame = frame.f_back
+        step = []
+        for frame in reversed(frames):
+            key = (frame.f_code, frame.f_lineno)
+            if key not in self.places:
+                self.places[key] = headings(self.lines, frame.f_code, frame.f_lineno)
+            #Functions defined inside other functions are only named with steps of their own, so that wrappers such as
+            #the call() of pause_when_empty() do not split the steps.
+            if not frame.f_code.co_name.startswith('<') and (self.places[key] or not frame.f_code.co_freevars):
+                step.append(frame.f_code.co_name)
+            step += self.places[key]
+        return tuple(step) or ('(protocol)',)
+
+    def enter(self, name, frame):
+        now = time.perf_counter()
+        if self.running:
+            stack = (self.running[-1][0][0], self.running[-1][0][1] + (name,))
+        else: #The protocol's own code run since the last call counts as script time of the step of this one.
+            step = self.where(frame)
+            self.add((self.step if self.step == ('(start)',) else step, ('(script)',)), now - self.mark)
+            self.step = step
+            stack = (step, (name,))
+        self.running.append([stack, now, 0.0])
+
+    def leave(self):
+        stack, start, nested = self.running.pop()
+        now = time.perf_counter()
+        self.add(stack, now - start - nested, calls=1)
+        if self.running:
+            self.running[-1][2] += now - start
+        else:
+            self.mark = now
+
+    def command(self): #A command of the run log was issued.
+        self.add(self.running[-1][0] if self.running else (self.step, ('(script)',)), commands=1)
+
+    def finish(self):
+        self.add((('(end)',), ('(script)',)), time.perf_counter() - self.mark)
+
+    def steps(self): #{step: [seconds, script seconds, calls, commands]}, in the order the steps were first reached.
+        steps = OrderedDict()
+        for (step, calls), (seconds, count, commands) in self.stacks.items():
+            totals = steps.setdefault(step, [0.0, 0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += seconds if calls == ('(script)',) else 0
+            totals[2] += count
+            totals[3] += commands
+        return steps
+
+    def folded(self, root, weight='time'): #Lines of the profile as folded stacks, weighted by time (us), calls or commands.
+        for (step, calls), totals in self.stacks.items():
+            value = round(totals[0] * 1e6) if weight == 'time' else totals[WEIGHTS.index(weight)]
+            if value:
+                yield ';'.join((root,) + step + calls) + f' {value}'
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    """Wraps every public method of the protocol, pipette and module classes, and counts the commands of the run log,
+    while a protocol is simulated in this process."""
+    from opentrons.legacy_broker import LegacyBroker
+
+    originals = [] #(class, name, method or None if it was inherited)
+    publish = LegacyBroker.publish
+
+    def wrapped(name, method):
+        def call(self, *args, **kwargs):
+            profile.enter(name, sys._getframe(1))
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profile.leave()
+        return call
+
+    def counted_publish(self, topic, message):
+        if message.get('$') == 'before' and (message.get('payload') or {}).get('text') is not None:
+            profile.command()
+        return publish(self, topic, message)
+
+    for cls in profiled_classes():
+        for name in dir(cls):
+            method = inspect.getattr_static(cls, name)
+            if name.startswith('_') or not inspect.isfunction(method):
+                continue
+            originals.append((cls, name, method if name in cls.__dict__ else None))
+            setattr(cls, name, wrapped(f'{cls.__name__}.{name}', method))
+    LegacyBroker.publish = counted_publish
+    try:
+        yield profile
+    finally:
+        profile.finish()
+        LegacyBroker.publish = publish
+        for cls, name, method in originals:
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+
+
+def profile_protocol(path, prom_utr=None, labware_dir=None):
+    """Simulates a protocol and returns its Profile."""
+    kind, arguments = protocol_job(path, prom_utr)
+    if kind == 'script': #Run as it is, so its code objects carry the path it was run from.
+        filename = path
+        with open(path, encoding='utf-8') as rf:
+            code = rf.read()
+    else:
+        filename, code = protocol_text(kind, path, arguments)
+    with profiling(Profile(filename, code.splitlines())) as profile:
+        simulate_protocol(kind, path, arguments, labware_dir)
+    return profile
+
+
+def report(path, profile, top=10, file=sys.stdout):
+    steps = profile.steps()
+    total = sum(seconds for seconds, _, _, _ in steps.values())
+    calls = sum(count for _, _, count, _ in steps.values())
+    commands = sum(count for _, _, _, count in steps.values())
+    print(f'Simulation profile of {path}: {total:.2f} s, {calls} calls, {commands} commands', file=file)
+    print(f"{'seconds':>9}{'share':>8}{'script s':>10}{'calls':>8}{'commands':>10}  step", file=file)
+    for step, (seconds, script, count, command_count) in sorted(steps.items(), key=lambda item: -item[1][0]):
+        share = 100 * seconds / total if total else 0
+        print(f'{seconds:9.3f}{share:7.1f}%{script:10.3f}{count:8d}{command_count:10d}  {" > ".join(step)}', file=file)
+    by_call = OrderedDict() #Self time and calls of every method, wherever it was called from.
+    for (_, names), (seconds, count, _) in profile.stacks.items():
+        totals = by_call.setdefault(names[-1], [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+    print('Slowest calls (self time):', file=file)
+    for name, (seconds, count) in sorted(by_call.items(), key=lambda item: -item[1][0])[:top]:
+        print(f'{seconds:9.3f}{count:8d}  {name}', file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile the simulation of a protocol per step, with a flame graph of it.')
+    parser.add_argument('protocol', help='simulation script, protocol file or Template_Protocol_Isaac_Newtron.py')
+    parser.add_argument('--prom-utr', metavar='N_PROMOTERS,N_UTR[,LAYOUT]', help='parameters for the Isaac Newtron template (default: 3,5)')
+    parser.add_argument('--labware-dir', help='folder with custom labware definitions (.json)')
+    parser.add_argument('--folded', help='also save the profile as folded stacks to this file, for flame graph tools')
+    parser.add_argument('--weight', choices=WEIGHTS, default='time',
+                        help='what the folded stacks count: time (us, default), calls, or commands of the run log (plan size)')
+    parser.add_argument('--top', type=int, default=10, help='number of calls to list by self time (default: 10)')
+    args = parser.parse_args(argv)
+
+    try:
+        profile = profile_protocol(args.protocol, args.prom_utr, args.labware_dir)
+    except Exception as error:
+        print(f'{args.protocol}: simulation failed: {str(error).splitlines()[0]}', file=sys.stderr)
+        return 1
+    report(args.protocol, profile, args.top)
+    if args.folded:
+        with open(args.folded, 'w', encoding='utf-8') as wf:
+            for line in profile.folded(os.path.basename(args.protocol), args.weight):
+                wf.write(line + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import csv
+import sys
+from collections import OrderedDict
+
+from Protocol_Run_Time_Estimator import NOTE
+from Protocol_Simulation_Harness import protocol_job, simulate_protocol
+
+#Plans the tip racks of a protocol before the run: simulates it, counts the tips every pipette picks up and finds where
+#the racks have to be swapped, then prints a loading sheet for the operator (the racks to put on the deck, what to
+#replace at every swap and how many racks to have ready).
+#A swap is where the protocol pauses and resets the racks: the pauses of pause_when_empty() in the MegaTron and Isaac
+#Newtron protocols and check_tips() in the Greta Tronberg protocols come right before the pipette needs a tip it does not
+#have, which is the latest safe point and so gives the fewest swaps. A point where the racks run out with no pause is
+#reported as MISSING (the run would stop there); the simulation refills the racks and carries on to plan the rest.
+#Example: python Protocol_Tip_Planner.py MegaTron_DNA_Nanotech_Simulate.py
+#         python Protocol_Tip_Planner.py Template_Protocol_Isaac_Newtron.py --prom-utr 12,8 --labware-dir labware/ --csv tips.csv
+#Takes the simulation scripts, protocol files with run() and the Isaac Newtron template (with --prom-utr).
+
+
+TIPS_PER_RACK = 96
+
+
+def label(pipette):
+    return f'{pipette.name} ({pipette.mount})'
+
+
+class TipLog:
+    """Tip pick-ups and rack refills of a simulated run."""
+
+    def __init__(self):
+        self.racks = OrderedDict() #id: [rack, names of the pipettes using it], in the order they are first used
+        self.tips = OrderedDict() #pipette: tips picked up
+        self.swaps = [] #(pause message or None if there was none, section, pipette and its tips so far, [(slot, load name, tips used)])
+        self.section = 'the first section' #Text of the last protocol.comment() that is not a note
+        self.pause = None #Message of the last pause, until the next tip is picked up
+        self.swapping = False #A swap was recorded at this pause: the resets of the other pipettes join it
+
+    def see(self, pipette):
+        for rack in pipette.tip_racks:
+            self.racks.setdefault(id(rack), [rack, []])
+            if label(pipette) not in self.racks[id(rack)][1]:
+                self.racks[id(rack)][1].append(label(pipette))
+
+    def picked_up(self, pipette):
+        self.see(pipette)
+        self.tips[label(pipette)] = self.tips.get(label(pipette), 0) + pipette.channels
+        self.pause, self.swapping = None, False
+
+    def refill(self, pipette, paused):
+        self.see(pipette)
+        used = [(str(rack.parent), rack.load_name, used_tips(rack)) for rack in pipette.tip_racks]
+        used = [rack for rack in used if rack[2]]
+        if not used: #Racks shared by several pipettes are reset by each of them; only the first reset swaps anything.
+            return
+        if paused and self.swapping and self.pause is not None:
+            self.swaps[-1][3].extend(used)
+            return
+        self.swaps.append((self.pause if paused else None, self.section, (label(pipette), self.tips.get(label(pipette), 0)), used))
+        self.swapping = paused
+
+
+def used_tips(rack):
+    return sum(not well.has_tip for well in rack.wells())
+
+
+@contextlib.contextmanager
+def tracking(log):
+    """Records every tip pick-up and rack reset into log while a protocol is simulated in this process. When the racks
+    run out, they are refilled as the operator would and the swap is recorded as missing."""
+    from opentrons.protocol_api import InstrumentContext, ProtocolContext
+    from opentrons.protocol_api.labware import OutOfTipsError
+
+    names = ('pick_up_tip', 'reset_tipracks', 'transfer', 'distribute', 'consolidate')
+    originals = {name: getattr(InstrumentContext, name) for name in names}
+    comment, pause = ProtocolContext.comment, ProtocolContext.pause
+
+    def refilling(name): #transfer() and co. look for a free tip before picking any up, so they can run out too.
+        def call(self, *args, **kwargs):
+            try:
+                result = originals[name](self, *args, **kwargs)
+            except OutOfTipsError:
+                log.refill(self, paused=False)
+                originals['reset_tipracks'](self)
+                result = originals[name](self, *args, **kwargs)
+            if name == 'pick_up_tip':
+                log.picked_up(self)
+            return result
+        return call
+
+    def reset_tipracks(self):
+        log.refill(self, paused=True)
+        originals['reset_tipracks'](self)
+
+    def logged_comment(self, msg):
+        if not msg.startswith(NOTE):
+            log.section = msg
+        return comment(self, msg)
+
+    def logged_pause(self, msg=None):
+        log.pause = msg or '(no message)'
+        return pause(self, msg)
+
+    for name in names:
+        setattr(InstrumentContext, name, reset_tipracks if name == 'reset_tipracks' else refilling(name))
+    ProtocolContext.comment, ProtocolContext.pause = logged_comment, logged_pause
+    try:
+        yield log
+    finally:
+        for name, method in originals.items():
+            setattr(InstrumentContext, name, method)
+        ProtocolContext.comment, ProtocolContext.pause = comment, pause
+
+
+def plan_tips(path, prom_utr=None, labware_dir=None):
+    """Simulates a protocol and returns its TipLog."""
+    kind, arguments = protocol_job(path, prom_utr)
+    with tracking(TipLog()) as log:
+        simulate_protocol(kind, path, arguments, labware_dir)
+    return log
+
+
+def loading_sheet(log):
+    """Rows of the loading sheet: (point, slot, tip rack, pipettes, tips used)."""
+    rows = [('start', str(rack.parent), rack.load_name, ', '.join(pipettes), None) for rack, pipettes in log.racks.values()]
+    for number, (_, _, _, used) in enumerate(log.swaps, 1):
+        rows += [(f'swap {number}', slot, load_name, None, tips) for slot, load_name, tips in used]
+    rows += [('end', str(rack.parent), rack.load_name, ', '.join(pipettes), used_tips(rack)) for rack, pipettes in log.racks.values()]
+    return rows
+
+
+def report(path, log, file=sys.stdout):
+    print(f'Tip plan for {path}', file=file)
+    for pipette, tips in log.tips.items():
+        slots = [str(rack.parent) for rack, pipettes in log.racks.values() if pipette in pipettes]
+        print(f'  {pipette:<28}{tips:>6} tips from the racks in slot(s) {", ".join(slots)}', file=file)
+    print('Loading sheet:', file=file)
+    print('  Before the run, put full tip racks in:', file=file)
+    for rack, pipettes in log.racks.values():
+        print(f'    slot {str(rack.parent):<4}{rack.load_name:<32}for {", ".join(pipettes)}', file=file)
+    missing = 0
+    for number, (pause, section, (pipette, tips), used) in enumerate(log.swaps, 1):
+        racks = ', '.join(f'slot {slot} ({tips} of {TIPS_PER_RACK} tips used)' for slot, _, tips in used)
+        if pause is None:
+            missing += 1
+            print(f'  Swap {number}: MISSING - the {pipette} runs out after {tips} tips, in "{section}", with no pause, so '
+                  f'the run would stop here. Add a pause that resets the racks, then replace {racks}', file=file)
+        else:
+            print(f'  Swap {number}: at the pause "{pause}" replace {racks}', file=file)
+    needed = OrderedDict()
+    for rack, _ in log.racks.values():
+        needed[rack.load_name] = needed.get(rack.load_name, 0) + 1
+    for _, _, _, used in log.swaps:
+        for _, load_name, _ in used:
+            needed[load_name] = needed.get(load_name, 0) + 1
+    print('  Racks to have ready: ' + ', '.join(f'{count} x {load_name}' for load_name, count in needed.items()), file=file)
+    return missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Count the tips of a protocol and plan the tip racks and their swaps.')
+    parser.add_argument('protocol', help='simulation script, protocol file or Template_Protocol_Isaac_Newtron.py')
+    parser.add_argument('--prom-utr', metavar='N_PROMOTERS,N_UTR[,LAYOUT]', help='parameters for the Isaac Newtron template (default: 3,5)')
+    parser.add_argument('--labware-dir', help='folder with custom labware definitions (.json)')
+    parser.add_argument('--csv', help='also save the loading sheet to this .csv file')
+    args = parser.parse_args(argv)
+
+    try:
+        log = plan_tips(args.protocol, args.prom_utr, args.labware_dir)
+    except Exception as error:
+        print(f'{args.protocol}: simulation failed: {str(error).splitlines()[0]}', file=sys.stderr)
+        return 1
+    missing = report(args.protocol, log)
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as wf:
+            writer = csv.writer(wf)
+            writer.writerow(('Point', 'Slot', 'Tip rack', 'Pipettes', 'Tips used'))
+            writer.writerows(loading_sheet(log))
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+#Startup-time benchmark for GUI_Isaac_Newtron.py: measures, in fresh Python processes, the time from importing the app
+#to the first tick of the Tk mainloop (i.e. the window is up and responsive). Fails when the median exceeds the budget.
+#Example: python Startup_Benchmark_Isaac_Newtron.py --runs 10 --budget 0.5
+#Needs a display; on a headless machine run it under xvfb-run.
+
+
+#Runs in the child process. Prints "<import time> <first tick time>" in seconds.
+CHILD = '''
+import time
+start = time.perf_counter()
+import GUI_Isaac_Newtron
+imported = time.perf_counter()
+root = GUI_Isaac_Newtron.create_window()
+def first_tick():
+    print(imported - start, time.perf_counter() - start)
+    root.destroy()
+root.after(0, first_tick)
+root.mainloop()
+'''
+
+
+def measure_once(): #Returns (import time, time to first mainloop tick) of one fresh process.
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-c', CHILD], cwd=app_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'startup failed')
+    import_time, first_tick = map(float, result.stdout.split())
+    return import_time, first_tick
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure GUI_Isaac_Newtron.py startup time (import to first mainloop tick).')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes to measure (default: 5)')
+    parser.add_argument('--budget', type=float, default=1.0, help='maximum median startup time in seconds (default: 1.0)')
+    args = parser.parse_args(argv)
+    if args.runs < 1:
+        parser.error('--runs must be at least 1')
+
+    try:
+        runs = [measure_once() for _ in range(args.runs)]
+    except RuntimeError as error:
+        print(f'Could not start the app: {error}', file=sys.stderr)
+        return 2
+    import_median = statistics.median(run[0] for run in runs)
+    startup_median = statistics.median(run[1] for run in runs)
+    print(f'import:              median {import_median:.3f} s')
+    print(f'first mainloop tick: median {startup_median:.3f} s '
+          f'(min {min(run[1] for run in runs):.3f} s, max {max(run[1] for run in runs):.3f} s, {args.runs} runs)')
+    if startup_median > args.budget:
+        print(f'FAIL: startup is over the {args.budget:.3f} s budget', file=sys.stderr)
+        return 1
+    print(f'OK: within the {args.budget:.3f} s budget')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
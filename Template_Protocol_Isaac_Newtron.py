@@ -3,7 +3,25 @@
 from opentrons import protocol_api
 metadata = {'apiLevel': '2.8'}
 def run(protocol:protocol_api.ProtocolContext):
-  def IN_assembly_transformation(prom_utr):
+  #Defined inside run() so that run() stays the first function of the template: the app writes its variables above it.
+  def pause_when_empty(protocol, pipette):
+    """Pauses for fresh tip racks when the pipette runs out of tips, right before it needs the next one (so it never holds a
+    tip then), instead of stopping the run. transfer() and co. look for a free tip before picking any up, so they are
+    checked as well as pick_up_tip(). Racks shared by several pipettes are refilled for all of them.
+    """
+    def checked(method, takes_tips):
+      def call(*args, **kwargs):
+        if takes_tips(args, kwargs) and all(rack.next_tip(pipette.channels) is None for rack in pipette.tip_racks):
+          protocol.pause('Replace the empty tip racks in slot(s) ' + ', '.join(str(rack.parent) for rack in pipette.tip_racks)
+                         + ' with full ones.')
+          pipette.reset_tipracks()
+        return method(*args, **kwargs)
+      return call
+    pipette.pick_up_tip = checked(pipette.pick_up_tip, lambda args, kwargs: not args and not kwargs)
+    for name in ('transfer', 'distribute', 'consolidate'):
+      setattr(pipette, name, checked(getattr(pipette, name), lambda args, kwargs: kwargs.get('new_tip') != 'never'))
+
+  def IN_assembly_transformation(prom_utr, layout):
     #Extract lengths from tuple: 
     n_promoters = prom_utr[0]
     n_utr = prom_utr[1]
@@ -21,6 +39,8 @@ def run(protocol:protocol_api.ProtocolContext):
     #Pipettes.
     p20s = protocol.load_instrument('p20_single_gen2', 'right', tip_racks=[tiprack_20, tiprack_20_2, tiprack_20_3])
     p20 = protocol.load_instrument('p20_multi_gen2', 'left', tip_racks=[tiprack_20, tiprack_20_2, tiprack_20_3])
+    pause_when_empty(protocol, p20s) #Pauses for new tip racks whenever they run out, however many combinations there are.
+    pause_when_empty(protocol, p20)
     #Set up heat block for cells on ice in case it was not already set manually from the OpenTron software. 
     temperature_module.set_temperature(4)
 
@@ -32,10 +52,16 @@ def run(protocol:protocol_api.ProtocolContext):
     columns = list(range(1, 13)) #Define plate columns.
     p20.pick_up_tip()
     #Work out the minimum number of columns to pipette when using the multichannel to optimise tips usage. 
-    if n_promoters*n_utr%8 == 0: 
-      min_num_cols = n_promoters*n_utr/8
-    else: 
-      min_num_cols = (n_promoters*n_utr//8)+1
+    if layout == 'multichannel':
+      #Promoters run down the rows and every 3'UTR has its own column, so each block of 8 promoters takes n_utr columns.
+      n_blocks = -(-n_promoters//8) #Rounds up.
+      min_num_cols = n_blocks*n_utr
+      if min_num_cols > 12 or n_blocks + n_utr > 12:
+        raise ValueError('Too many parts for the multichannel layout: it needs (promoters / 8, rounded up) x 3\'UTRs <= 12 columns in the PCR plate and (promoters / 8, rounded up) + 3\'UTRs <= 12 columns in reservoir_var.')
+    else:
+      min_num_cols = -(-n_promoters*n_utr//8) #Rounds up.
+      if min_num_cols > 12 or n_promoters + n_utr > 96:
+        raise ValueError('Too many parts for the single layout: it needs promoters x 3\'UTRs <= 96 wells in the PCR plate and promoters + 3\'UTRs <= 96 wells in reservoir_var.')
       
     for i in range(min_num_cols):
       p20.transfer(14, reservoir_const['A1'], PCR_plate[f'A{columns[i]}'], new_tip='never') #A1 in reservoir_const = assembly mix + plasmid
@@ -46,18 +72,19 @@ def run(protocol:protocol_api.ProtocolContext):
     p20.drop_tip()
 
     #Code to transfer sample from an indexed source plate to the destination PCR plate with combination logic.
+    #The app (GUI_Isaac_Newtron.py) plans these transfers with Protocol_Liquid_Handling_IR.py and writes the plan and its
+    #executor above: each promoter and 3'UTR is multi-dispensed to all of its destinations with a single tip, in the order
+    #with the least gantry travel. Promoters go in first, touching the liquid; 3'UTRs are dispensed just above it, with a
+    #touch tip so the 2 uL drop leaves the tip. In the multichannel layout a whole column of parts is dispensed at a time.
+    pipette = p20 if layout == 'multichannel' else p20s
+    execute(protocol, {'reservoir_var': reservoir_var, 'PCR_plate': PCR_plate}, {'p20': pipette}, plan)
 
-    for i in range(n_promoters):
-      for e in range(n_utr):
-        dest_prom = n_promoters * e + i 
-        p20s.transfer(2, reservoir_var[f'{rows[i % 8]}{columns[i // 8]}'], PCR_plate[f'{rows[dest_prom % 8]}{columns[dest_prom // 8]}'],mix_after = (3,5), new_tip='once') #If 3 promoters and 3 UTRs, here it goes from A1 of source to A1, D1, G1 of destination. Then from A2 of source to B1, E1, H1 of destination. Then from A3 of source to C1, F1, A2 of destination. 
+    #Mix every column once all parts have been added, with fresh tips for each column.
+    for i in range(min_num_cols):
+      p20.pick_up_tip()
+      p20.mix(3, 5, PCR_plate[f'A{columns[i]}'])
+      p20.drop_tip()
 
-    d = 0
-    for i in range(n_utr): 
-      for e in range(n_promoters):
-        dest_utr = i + n_promoters 
-        p20s.transfer(2, reservoir_var[f'{rows[dest_utr % 8]}{columns[dest_utr // 8]}'], PCR_plate[f'{rows[d % 8]}{columns[d // 8]}'], mix_after= (3,5), new_tip = 'once') #If 3 promoters and 3 UTRs, here it goes from A4 of source to A1, B1, C1 of destination. Then from A5 of source to D1, E1, F1 of destination. Then from A6 of source to G1, H1, A2 of destination. 
-        d+=1
     #Incubation protocol.
     if tc_mod.lid_position != 'closed':
       tc_mod.close_lid()
@@ -76,10 +103,6 @@ def run(protocol:protocol_api.ProtocolContext):
       tc_mod.open_lid() #Open the lid of the thermocycler. 
 
     tc_mod.set_block_temperature(4) # 'on ice'
-    #Set a pause to reload the tip racks as the following steps require a substantial number of tips, depending on the number of combinations. 
-    protocol.pause("Switch out empty tip racks")
-    p20.reset_tipracks()
-    p20s.reset_tipracks()
     #Set up transformation with 3uL DNA, 20uL cells. 
     for i in range(min_num_cols):
       p20.transfer(17, PCR_plate[f'A{columns[i]}'], spare_plate[f'A{columns[i]}']) #Leave only 3uL in the thermocycler using multichannel pipette and store the rest in a different plate. 
@@ -94,4 +117,4 @@ def run(protocol:protocol_api.ProtocolContext):
       tc_mod.open_lid() #Open the lid of the thermocycler.
 
 
-  IN_assembly_transformation(prom_utr = prom_utr) #Define the global variable using the tuple generated by our app (GUI_Isaac_Newtron.py). 
\ No newline at end of file
+  IN_assembly_transformation(prom_utr = prom_utr, layout = layout) #Define the global variables using the tuple and layout generated by our app (GUI_Isaac_Newtron.py). 
\ No newline at end of file
@@ -0,0 +1,168 @@
+import argparse
+import sqlite3
+import sys
+
+from Tron_Weiss_Fluorescence_Processing import BLANK_COLUMN, extraction_dict, read_plates, top_wells, well_names
+
+#Keeps the history of Tron Weiss evolution campaigns in an SQLite file: the reader values of every plate of every
+#cycle, the wells selected to carry on, and which well of the previous cycle each well descends from. Filled by
+#Tron_Weiss_Evolution_Daemon.py (--history) or by hand with 'add'; old cycles can then be queried without going back
+#to the Excel exports.
+#Cycles are plate cycles: the plate of cycle 0 comes from the Cycle 0 protocol, and the wells selected from the plate of
+#cycle n seed the plate of cycle n + 1 (the well of rank j fills column j + 1, column 11 carries the controls over).
+#Examples: python Tron_Weiss_Cycle_History.py history.db add lineA 0 cycle_0.xlsx
+#          python Tron_Weiss_Cycle_History.py history.db lineage lineA 12 C4
+#          python Tron_Weiss_Cycle_History.py history.db top --n 20
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lineages (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS plates (
+    id INTEGER PRIMARY KEY,
+    lineage_id INTEGER NOT NULL REFERENCES lineages(id),
+    cycle INTEGER NOT NULL,
+    plate INTEGER NOT NULL,
+    export TEXT,
+    recorded TEXT DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (lineage_id, cycle, plate)
+);
+CREATE TABLE IF NOT EXISTS readings (
+    plate_id INTEGER NOT NULL REFERENCES plates(id),
+    well TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (plate_id, well)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS readings_by_value ON readings (value DESC);
+CREATE TABLE IF NOT EXISTS selections (
+    plate_id INTEGER NOT NULL REFERENCES plates(id),
+    rank INTEGER NOT NULL,
+    well TEXT NOT NULL,
+    PRIMARY KEY (plate_id, rank)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS descent (
+    lineage_id INTEGER NOT NULL REFERENCES lineages(id),
+    cycle INTEGER NOT NULL,
+    plate INTEGER NOT NULL,
+    well TEXT NOT NULL,
+    parent_well TEXT NOT NULL,
+    PRIMARY KEY (lineage_id, plate, well, cycle)
+) WITHOUT ROWID;
+"""
+
+CONTROL_COLUMN = 11
+
+
+def connect(path): #Opens (and creates if needed) a history file.
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def children(selected): #{child well: parent well} of the next cycle for the selected wells ({well: rank}).
+    rows = 'ABCDEFGH'
+    descent = {row + str(CONTROL_COLUMN): row + str(CONTROL_COLUMN) for row in rows}
+    for well, rank in selected.items():
+        for row in rows:
+            descent[row + str(rank + 1)] = well
+    return descent
+
+
+def record_plate(connection, lineage, cycle, plate, values, selected, export=None):
+    """Stores the readings (rows x columns array) and the selected wells ({well: rank}) of a plate, and the descent of
+    the wells of the next cycle. Recording the same plate again replaces it.
+    """
+    with connection:
+        connection.execute('INSERT OR IGNORE INTO lineages (name) VALUES (?)', (lineage,))
+        lineage_id = connection.execute('SELECT id FROM lineages WHERE name = ?', (lineage,)).fetchone()[0]
+        old = connection.execute('SELECT id FROM plates WHERE lineage_id = ? AND cycle = ? AND plate = ?',
+                                 (lineage_id, cycle, plate)).fetchone()
+        if old:
+            connection.execute('DELETE FROM readings WHERE plate_id = ?', old)
+            connection.execute('DELETE FROM selections WHERE plate_id = ?', old)
+            connection.execute('DELETE FROM plates WHERE id = ?', old)
+        plate_id = connection.execute('INSERT INTO plates (lineage_id, cycle, plate, export) VALUES (?, ?, ?, ?)',
+                                      (lineage_id, cycle, plate, export)).lastrowid
+        n_rows, n_columns = values.shape
+        readings = values.T.ravel()
+        connection.executemany('INSERT INTO readings VALUES (?, ?, ?)',
+                               [(plate_id, well, None if reading != reading else float(reading)) #NaN (blank) as NULL.
+                                for well, reading in zip(well_names(n_rows, n_columns), readings)])
+        connection.executemany('INSERT INTO selections VALUES (?, ?, ?)', [(plate_id, rank, well) for well, rank in selected.items()])
+        connection.execute('DELETE FROM descent WHERE lineage_id = ? AND cycle = ? AND plate = ?', (lineage_id, cycle + 1, plate))
+        connection.executemany('INSERT INTO descent VALUES (?, ?, ?, ?, ?)',
+                               [(lineage_id, cycle + 1, plate, well, parent) for well, parent in children(selected).items()])
+    return plate_id
+
+
+def lineage_of(connection, lineage, cycle, well, plate=1):
+    """Ancestry of a well, newest first: a list of (cycle, well, reading) back to the first recorded cycle."""
+    return connection.execute("""
+        WITH RECURSIVE ancestry (cycle, well) AS (
+            SELECT ?, ?
+            UNION ALL
+            SELECT ancestry.cycle - 1, descent.parent_well FROM ancestry
+            JOIN descent ON descent.lineage_id = (SELECT id FROM lineages WHERE name = ?)
+                AND descent.plate = ? AND descent.well = ancestry.well AND descent.cycle = ancestry.cycle
+        )
+        SELECT ancestry.cycle, ancestry.well, readings.value FROM ancestry
+        LEFT JOIN plates ON plates.lineage_id = (SELECT id FROM lineages WHERE name = ?)
+            AND plates.cycle = ancestry.cycle AND plates.plate = ?
+        LEFT JOIN readings ON readings.plate_id = plates.id AND readings.well = ancestry.well
+        ORDER BY ancestry.cycle DESC""", (cycle, well, lineage, plate, lineage, plate)).fetchall()
+
+
+def top_performers(connection, n=10, lineage=None):
+    """The n highest readings of all recorded plates (or of one lineage): a list of (lineage, cycle, plate, well, reading).
+    Only the wells selected to carry on are ranked, so blanks, controls and excluded columns never come up."""
+    query = """
+        SELECT lineages.name, plates.cycle, plates.plate, readings.well, readings.value FROM selections
+        JOIN readings ON readings.plate_id = selections.plate_id AND readings.well = selections.well
+        JOIN plates ON plates.id = readings.plate_id
+        JOIN lineages ON lineages.id = plates.lineage_id
+        WHERE readings.value IS NOT NULL {}
+        ORDER BY readings.value DESC LIMIT ?"""
+    if lineage is None:
+        return connection.execute(query.format(''), (n,)).fetchall()
+    return connection.execute(query.format('AND lineages.name = ?'), (lineage, n)).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record and query the history of Tron Weiss evolution campaigns.')
+    parser.add_argument('database', help='SQLite history file (created if missing)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='record the plates of a reader export')
+    add.add_argument('lineage')
+    add.add_argument('cycle', type=int, help='plate cycle of the export (0 for the plate of the Cycle 0 protocol)')
+    add.add_argument('export', help='Omega export (.xlsx)')
+    add.add_argument('--top', type=int, default=10, help='number of wells selected to carry on (default: 10)')
+    add.add_argument('--exclude-columns', type=int, nargs='*', default=[BLANK_COLUMN], metavar='COLUMN',
+                     help=f'plate columns that are never selected (default: {BLANK_COLUMN}, the blanks)')
+    lineage = commands.add_parser('lineage', help='ancestry of a well')
+    lineage.add_argument('lineage')
+    lineage.add_argument('cycle', type=int)
+    lineage.add_argument('well')
+    lineage.add_argument('--plate', type=int, default=1)
+    top = commands.add_parser('top', help='highest readings of the wells selected to carry on')
+    top.add_argument('--n', type=int, default=10)
+    top.add_argument('--lineage')
+    args = parser.parse_args(argv)
+
+    connection = connect(args.database)
+    if args.command == 'add':
+        for number, (name, values) in enumerate(read_plates(args.export)):
+            selected = extraction_dict(top_wells(values, args.top, args.exclude_columns))
+            record_plate(connection, args.lineage, args.cycle, number + 1, values, selected, args.export)
+            print(f'{args.lineage} cycle {args.cycle} plate {number + 1} [{name}]: selected {selected}')
+    elif args.command == 'lineage':
+        ancestry = lineage_of(connection, args.lineage, args.cycle, args.well.upper(), args.plate)
+        for cycle, well, value in ancestry:
+            print(f'cycle {cycle:>4}  {well:<4}{"" if value is None else value:>14}')
+    else:
+        for name, cycle, plate, well, value in top_performers(connection, args.n, args.lineage):
+            print(f'{name:<20}cycle {cycle:>4}  plate {plate}  {well:<4}{value:>14}')
+    connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from Protocol_Liquid_Handling_IR import Transfer, optimize, plan_source, protocol_source
+from Tron_Weiss_Cycle_History import connect, record_plate
+from Tron_Weiss_Fluorescence_Analysis import load_export, normalize
+from Tron_Weiss_Fluorescence_Processing import BLANK_COLUMN, PLATE_FORMATS, extraction_dict, top_wells
+
+#Closes the Tron Weiss directed-evolution loop: watches a drop folder for new Omega plate reader exports, selects the
+#wells with the highest fluorescence (Script (1)) and writes the protocol of the next cycle with them (Script (2)),
+#so nothing has to be copied by hand between cycles.
+#Every subfolder of the drop folder is a lineage, with its own queue of exports processed in order of arrival, so
+#several lineages can evolve at once; exports dropped straight into the drop folder belong to the 'default' lineage.
+#The protocols are written to OUT/<lineage>/cycle_<n>_protocol.py, and OUT/evolution_state.json records which exports
+#have been processed, so the daemon can be stopped and restarted.
+#Example: python Tron_Weiss_Evolution_Daemon.py reader_exports/ protocols/
+#Use --once to process the exports already there and stop (e.g. from a scheduled task), and --history to also record
+#every cycle in a Tron_Weiss_Cycle_History.py database. With --control-column the wells are ranked on fluorescence
+#relative to the controls (see Tron_Weiss_Fluorescence_Analysis.py) rather than raw fluorescence. As in
+#Tron_Weiss_Fluorescence_Processing.py, the blank column 12 is never picked unless --exclude-columns says otherwise.
+#The next cycle protocol is written for 96-well plates, so exports of other plates are refused. Exports that carry an
+#OD block after every fluorescence block need --od: the blocks are then paired (the OD divides the fluorescence with
+#--control-column) instead of every block being taken for a plate.
+
+
+STATE_FILE = 'evolution_state.json'
+DEFAULT_LINEAGE = 'default'
+MAX_WELLS = 10 #The next cycle grows the selected wells in columns 1-10; column 11 takes the controls.
+
+CYCLE_P20 = {'p20': (1, 20)} #(minimum, maximum) uL of the pipettes of the next cycle protocol
+CYCLE_P300 = {'p300': (20, 300)} #8-channel: a transfer to the A well of a column fills the whole column
+ROWS = 'ABCDEFGH'
+COLUMNS = range(1, 13)
+
+#Script (2) of the Tron Weiss notebook, with its liquid handling planned by Protocol_Liquid_Handling_IR.py (see
+#cycle_plans): the plans and their executor are written in place of PLANS_PLACEHOLDER.
+WELLS_PLACEHOLDER = '{{WELLS}}'
+PLANS_PLACEHOLDER = '{{PLANS}}'
+NEW_CYCLE_PROTOCOL = """from opentrons import protocol_api
+
+metadata = {'apiLevel': '2.8'}
+
+#Wells selected from the previous plate (well: rank): {{WELLS}}
+
+{{PLANS}}
+
+
+def run(protocol: protocol_api.ProtocolContext):
+    source = protocol.load_labware("corning_96_wellplate_360ul_flat", "1")
+    reservoir = protocol.load_labware("nest_12_reservoir_15ml", "7")
+    tiprack_1 = protocol.load_labware("opentrons_96_tiprack_300ul", "5")
+    tiprack_2 = protocol.load_labware("opentrons_96_tiprack_300ul", "8")
+    tiprack_3 = protocol.load_labware("opentrons_96_tiprack_300ul", "9")
+    tiprack_4 = protocol.load_labware("opentrons_96_tiprack_20ul", "6")
+    p300 = protocol.load_instrument("p300_multi_gen2", "left", tip_racks=[tiprack_1, tiprack_2, tiprack_3])
+    p20 = protocol.load_instrument("p20_single_gen2", "right", tip_racks=[tiprack_4])
+    temp_mod = protocol.load_module("temperature module", "4")
+    dest = temp_mod.load_labware("corning_96_wellplate_360ul_flat")
+    test = protocol.load_labware("corning_96_wellplate_360ul_flat", "3")
+    labware = {'source': source, 'reservoir': reservoir, 'dest': dest, 'test': test}
+    pipettes = {'p20': p20, 'p300': p300}
+    p20.starting_tip = tiprack_4.well("C1")
+
+#E.coli of the selected wells and the controls, growth components and "broth" into the new "dest" plate (see plan)
+    execute(protocol, labware, pipettes, plan)
+
+    temp_mod.set_temperature(35) #set temperature of the heating block to 35oC
+
+    protocol.delay(minutes=240) #once temperature is reached, the destination plate will incubate for 4 hours
+    temp_mod.set_temperature(24) #force cools the heating block back to room temperature before continuing
+
+#takes a 100 ul sample of each well and transfers it to the test plate to for fluorescence testing
+    execute(protocol, labware, pipettes, sampling_plan)
+"""
+
+
+def cycle_plans(wells):
+    """Lowered plans of the next cycle protocol for the selected wells ({well: rank}, best first): what is done before
+    the incubation, and the sampling after it."""
+    #transferring 5ul of E.coli from each of the highest fluorescing wells in the original "dest" plate (the new source
+    #plate) to a column of the new dest plate, one tip per well (the new wells are empty, so it is multi-dispensed)
+    seeds = [Transfer(('source', well), ('dest', f'{row}{column}'), 5, tip=('seed', well))
+             for column, well in enumerate(wells, 1) for row in ROWS]
+    #transferring controls from the original "dest" plate (the new source plate) to the new "dest" plate
+    seeds += [Transfer(('source', f'{row}11'), ('dest', f'{row}11'), 5) for row in ROWS]
+    #adding components to encourage growth to all wells of the destination plate, one tip per component
+    growth = [Transfer(('reservoir', f'A{i + 1}'), ('dest', f'A{column}'), 20, tip=('growth', i))
+              for i in range(4) for column in COLUMNS]
+    #adding "broth" to all wells and mixing - here tips are changed every time to ensure no contamination
+    growth += [Transfer(('reservoir', 'A5'), ('dest', f'A{column}'), 115, mix=(3, 100)) for column in COLUMNS]
+    #takes a 100 ul sample of each well for fluorescence testing, a fresh tip for each column
+    sampling = [Transfer(('dest', f'A{column}'), ('test', f'A{column}'), 100) for column in COLUMNS]
+    return optimize(seeds, CYCLE_P20) + optimize(growth, CYCLE_P300), optimize(sampling, CYCLE_P300)
+
+
+def render_protocol(wells): #The next cycle protocol for the selected wells ({well: rank}).
+    plan, sampling_plan = cycle_plans(wells)
+    plans = protocol_source(plan) + '\n\n' + plan_source(sampling_plan, 'sampling_plan')
+    return NEW_CYCLE_PROTOCOL.replace(WELLS_PLACEHOLDER, repr(wells)).replace(PLANS_PLACEHOLDER, plans)
+
+
+def load_state(out_dir): #{lineage: {'cycle': last cycle, 'processed': {export: cycle}}}
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as rf:
+        return json.load(rf)
+
+
+def save_state(out_dir, state): #Written to a temporary file first, so a crash never leaves half a state file.
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as wf:
+        json.dump(state, wf, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def find_exports(drop_dir): #(lineage, path) of every export in the drop folder, oldest first.
+    exports = []
+    for path in glob.glob(os.path.join(drop_dir, '*.xlsx')) + glob.glob(os.path.join(drop_dir, '*', '*.xlsx')):
+        if os.path.basename(path).startswith('~$'): #Lock files of exports open in Excel.
+            continue
+        folder = os.path.dirname(os.path.relpath(path, drop_dir))
+        exports.append((os.path.getmtime(path), folder or DEFAULT_LINEAGE, path))
+    return [(lineage, path) for _, lineage, path in sorted(exports)]
+
+
+class EvolutionDaemon:
+    """Keeps a queue of exports per lineage and turns each export into the protocol of the next cycle."""
+
+    def __init__(self, drop_dir, out_dir, top=MAX_WELLS, exclude_columns=(BLANK_COLUMN,), start_cell=None, history=None,
+                 control_column=None, blank_column=None, od=False):
+        self.drop_dir, self.out_dir = drop_dir, out_dir
+        self.top, self.exclude_columns = top, exclude_columns
+        self.start_cell = start_cell
+        self.control_column, self.blank_column = control_column, blank_column
+        self.od = od
+        os.makedirs(out_dir, exist_ok=True)
+        self.state = load_state(out_dir)
+        self.queues = {} #{lineage: deque of exports waiting for their cycle}
+        self.sizes = {} #Size of new exports at the last scan; an export is queued once it has stopped growing.
+        self.failed = set() #Exports that could not be processed; they are not retried until the daemon restarts.
+        self.history = connect(history) if history else None
+
+    def scan(self, wait_for_copy=True): #Queues the new exports of the drop folder.
+        for lineage, path in find_exports(self.drop_dir):
+            name = os.path.relpath(path, self.drop_dir)
+            queue = self.queues.setdefault(lineage, deque())
+            if name in self.state.get(lineage, {}).get('processed', {}) or path in queue or path in self.failed:
+                continue
+            size = os.path.getsize(path)
+            if wait_for_copy and self.sizes.get(path) != size:
+                self.sizes[path] = size
+                continue
+            self.sizes.pop(path, None)
+            queue.append(path)
+
+    def process(self, lineage, path): #Selects the top wells of an export and writes the next protocol(s).
+        lineage_state = self.state.setdefault(lineage, {'cycle': 0, 'processed': {}})
+        cycle = lineage_state['cycle'] + 1
+        plates = load_export(path, self.od, self.start_cell) #(name, fluorescence, OD or None) of every plate.
+        if not plates:
+            raise ValueError('no plate found')
+        selections = [] #All plates are ranked before anything is written, so a bad plate leaves no protocol behind.
+        for plate_name, values, od_values in plates:
+            if values.shape != PLATE_FORMATS[96]:
+                raise ValueError(f'{plate_name}: {values.size}-well plate, the next cycle protocol only takes 96-well plates')
+            if self.control_column:
+                scores = normalize(values[None], None if od_values is None else od_values[None], self.control_column,
+                                   self.blank_column)[0]
+                if np.isnan(scores).all():
+                    raise ValueError(f'{plate_name}: no usable readings in control column {self.control_column}')
+                exclude = [*self.exclude_columns, self.control_column] + ([self.blank_column] if self.blank_column else [])
+                selections.append(extraction_dict(top_wells(scores, self.top, exclude)))
+            else:
+                selections.append(extraction_dict(top_wells(values, self.top, self.exclude_columns)))
+        written = []
+        for number, ((plate_name, values, _), wells) in enumerate(zip(plates, selections)):
+            suffix = f'_plate_{number + 1}' if len(plates) > 1 else ''
+            protocol_path = os.path.join(self.out_dir, lineage, f'cycle_{cycle}{suffix}_protocol.py')
+            os.makedirs(os.path.dirname(protocol_path), exist_ok=True)
+            with open(protocol_path, 'w', encoding='utf-8') as wf:
+                wf.write(render_protocol(wells))
+            written.append((plate_name, wells, protocol_path))
+            if self.history:
+                #The export is the plate of the previous cycle; the wells selected from it seed this cycle.
+                record_plate(self.history, lineage, cycle - 1, number + 1, values, wells, os.path.relpath(path, self.drop_dir))
+        lineage_state['cycle'] = cycle
+        lineage_state['processed'][os.path.relpath(path, self.drop_dir)] = cycle
+        save_state(self.out_dir, self.state)
+        return cycle, written
+
+    def run_queues(self): #Processes every queued export, lineage by lineage; returns the number of failures.
+        failed = 0
+        for lineage, queue in self.queues.items():
+            while queue:
+                path = queue.popleft()
+                try:
+                    cycle, written = self.process(lineage, path)
+                except Exception as error: #A bad export must not stop the other lineages.
+                    failed += 1
+                    self.failed.add(path)
+                    print(f'[{lineage}] {path}: FAILED: {error}', flush=True)
+                    continue
+                for plate_name, wells, protocol_path in written:
+                    print(f'[{lineage}] cycle {cycle}: {path} [{plate_name}] -> {protocol_path} {wells}', flush=True)
+        return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch a folder for plate reader exports and write the next Tron Weiss cycle protocols.')
+    parser.add_argument('drop_dir', help='folder the exports are dropped into; each subfolder is a lineage')
+    parser.add_argument('out_dir', help='folder for the protocols and the state file')
+    parser.add_argument('--top', type=int, default=MAX_WELLS, help=f'number of wells to carry on (default and maximum: {MAX_WELLS})')
+    parser.add_argument('--exclude-columns', type=int, nargs='*', default=[BLANK_COLUMN], metavar='COLUMN',
+                        help=f'plate columns that are never picked, e.g. controls or blanks (default: {BLANK_COLUMN})')
+    parser.add_argument('--start-cell', help='cell of the first reading (A1 well) when the plate blocks are not labelled')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between scans of the drop folder (default: 10)')
+    parser.add_argument('--once', action='store_true', help='process the exports already in the drop folder and stop')
+    parser.add_argument('--control-column', type=int, help='rank on fluorescence relative to this control column (e.g. 11)')
+    parser.add_argument('--blank-column', type=int, help='with --control-column, column of medium-only blanks to subtract')
+    parser.add_argument('--od', action='store_true',
+                        help='every fluorescence block of an export is followed by an OD block (used with --control-column)')
+    parser.add_argument('--history', help='SQLite file to record every cycle in (see Tron_Weiss_Cycle_History.py)')
+    args = parser.parse_args(argv)
+    if not 1 <= args.top <= MAX_WELLS:
+        parser.error(f'--top must be between 1 and {MAX_WELLS}')
+
+    daemon = EvolutionDaemon(args.drop_dir, args.out_dir, args.top, args.exclude_columns, args.start_cell, args.history,
+                             args.control_column, args.blank_column, args.od)
+    if args.once:
+        daemon.scan(wait_for_copy=False)
+        return 1 if daemon.run_queues() else 0
+    print(f'Watching {args.drop_dir} every {args.interval:g} s (Ctrl+C to stop)', flush=True)
+    try:
+        while True:
+            daemon.scan()
+            daemon.run_queues()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
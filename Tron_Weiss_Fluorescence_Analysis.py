@@ -0,0 +1,122 @@
+import argparse
+import csv
+import sys
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Tron_Weiss_Fluorescence_Processing import BLANK_COLUMN, extraction_dict, read_plates, top_wells
+
+#Ranks the wells of many Tron Weiss plates on fluorescence relative to the control column instead of raw fluorescence,
+#so that plates read on different days, gains or cycles can be compared. For every plate:
+#  score = (fluorescence - blank) / mean(fluorescence - blank of the control column)
+#where blank is the mean of the blank column (--blank-column, optional); overflowing readings are left out of both means.
+#With --od, the exports hold an optical density block after every fluorescence block, and the fluorescence is divided by
+#the blank-corrected OD first. The control column, the blank column and column 12 (medium only, see --exclude-columns)
+#are never ranked.
+#The exports are read in a pool of worker processes; the plates are then normalised together as one NumPy array.
+#Example: python Tron_Weiss_Fluorescence_Analysis.py exports/*.xlsx --control-column 11 --blank-column 12 --csv ranks.csv
+
+
+CONTROL_COLUMN = 11 #Unmodified E. coli in the Cycle 0 protocol.
+
+
+def load_export(path, od=False, start_cell=None, plate_format=96):
+    """Reads an export in a worker process. Returns a list of (plate name, fluorescence, OD or None)."""
+    plates = read_plates(path, start_cell, plate_format)
+    if not od:
+        return [(name, values, None) for name, values in plates]
+    if len(plates) % 2:
+        raise ValueError(f'{path}: --od needs an OD block after every fluorescence block, found {len(plates)} blocks')
+    return [(name, values, od_values) for (name, values), (_, od_values) in zip(plates[::2], plates[1::2])]
+
+
+def column_mean(stack, column): #Mean of the finite readings of a plate column (numbered from 1) for every plate of a stack.
+    values = stack[:, :, column - 1]
+    with warnings.catch_warnings(): #A column with no readings gives NaN, which is what we want.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(np.where(np.isfinite(values), values, np.nan), axis=1)
+
+
+def normalize(fluorescence, od=None, control_column=CONTROL_COLUMN, blank_column=None):
+    """Normalises a (plates, rows, columns) stack of readings to the control column of each plate.
+    od is an optional stack of the same shape. Plates without usable controls come out as NaN.
+    """
+    fluorescence = np.asarray(fluorescence, dtype=float)
+    if blank_column:
+        fluorescence = fluorescence - column_mean(fluorescence, blank_column)[:, None, None]
+    if od is not None:
+        od = np.asarray(od, dtype=float)
+        if blank_column:
+            od = od - column_mean(od, blank_column)[:, None, None]
+        fluorescence = np.where(od > 0, fluorescence / np.where(od > 0, od, 1), np.nan)
+    control = column_mean(fluorescence, control_column)
+    control = np.where(control > 0, control, np.nan)
+    return fluorescence / control[:, None, None]
+
+
+def analyse(plates, top=10, control_column=CONTROL_COLUMN, blank_column=None, exclude_columns=(BLANK_COLUMN,)):
+    """Scores and ranks plates given as (source, plate name, fluorescence, OD or None).
+    Plates of the same format are normalised together. Returns (source, plate name, scores, {well: rank}) per plate.
+    The control and blank columns are never ranked, nor are exclude_columns.
+    """
+    groups = OrderedDict() #Plates of each shape (96 or 384 wells) and with or without OD stack into one array.
+    for index, (_, _, fluorescence, od) in enumerate(plates):
+        groups.setdefault((fluorescence.shape, od is None), []).append(index)
+    scores = [None] * len(plates)
+    for (_, without_od), indexes in groups.items():
+        fluorescence = np.stack([plates[i][2] for i in indexes])
+        od = None if without_od else np.stack([plates[i][3] for i in indexes])
+        for i, plate_scores in zip(indexes, normalize(fluorescence, od, control_column, blank_column)):
+            scores[i] = plate_scores
+    exclude = [column for column in (control_column, blank_column) if column] + list(exclude_columns)
+    return [(source, name, plate_scores, extraction_dict(top_wells(plate_scores, top, exclude)))
+            for (source, name, _, _), plate_scores in zip(plates, scores)]
+
+
+def load_all(paths, od=False, start_cell=None, plate_format=96, workers=None):
+    """Reads the exports in parallel; returns (source, plate name, fluorescence, OD or None) for every plate, in order."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        exports = pool.map(load_export, paths, [od] * len(paths), [start_cell] * len(paths), [plate_format] * len(paths))
+        return [(path, name, fluorescence, od_values) for path, plates in zip(paths, exports)
+                for name, fluorescence, od_values in plates]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rank Tron Weiss wells on fluorescence normalised to the control column.')
+    parser.add_argument('files', nargs='+', help='Omega exports (.xlsx)')
+    parser.add_argument('--top', type=int, default=10, help='number of wells to extract from each plate (default: 10)')
+    parser.add_argument('--control-column', type=int, default=CONTROL_COLUMN, help=f'control column (default: {CONTROL_COLUMN})')
+    parser.add_argument('--blank-column', type=int, help='column of medium-only blanks to subtract (e.g. 12)')
+    parser.add_argument('--exclude-columns', type=int, nargs='*', default=[BLANK_COLUMN], metavar='COLUMN',
+                        help=f'other plate columns that are never ranked, e.g. blanks (default: {BLANK_COLUMN})')
+    parser.add_argument('--od', action='store_true', help='every fluorescence block is followed by an OD block to divide by')
+    parser.add_argument('--start-cell', help='cell of the first reading (A1 well) when the plate blocks are not labelled')
+    parser.add_argument('--format', type=int, choices=(96, 384), default=96, help='plate format for --start-cell')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--csv', help='also save every selected well with its score to this .csv file')
+    args = parser.parse_args(argv)
+
+    plates = load_all(args.files, args.od, args.start_cell, args.format, args.workers)
+    results = analyse(plates, args.top, args.control_column, args.blank_column, args.exclude_columns)
+    rows = []
+    for source, name, scores, wells in results:
+        if np.isnan(scores).all():
+            print(f'{source} [{name}]: no usable readings in control column {args.control_column}', file=sys.stderr)
+            continue
+        print(f'{source} [{name}]: Dictionary Input for Well Extraction Protocol = {wells}')
+        for well, rank in wells.items():
+            score = scores['ABCDEFGHIJKLMNOP'.index(well[0]), int(well[1:]) - 1]
+            rows.append((source, name, rank + 1, well, round(float(score), 4)))
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as wf:
+            writer = csv.writer(wf)
+            writer.writerow(('Export', 'Plate', 'Rank', 'Well', 'Fold over control'))
+            writer.writerows(rows)
+    return 0 if rows else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
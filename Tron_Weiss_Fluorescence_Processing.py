@@ -0,0 +1,156 @@
+import argparse
+import json
+import math
+import sys
+
+import numpy as np
+from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+
+#Script (1) of the Tron Weiss notebook (Tron_Weiss_New_Protocol.zip) as a command line tool: reads the fluorescence
+#exports of the Omega plate reader and gives the wells with the highest fluorescence, as the dictionary to paste after
+#'wells =' in the new cycle protocol. Takes any number of exports at once, 96- and 384-well plates, and exports with
+#several plates (several blocks in a sheet, or several sheets).
+#Example: python Tron_Weiss_Fluorescence_Processing.py cycle_1.xlsx cycle_2.xlsx --top 10
+#The plate blocks are found by their header of column numbers and their row letters (A-H or A-P) followed by the
+#readings; use --start-cell (e.g. B15, the first reading of the block) with --format for exports laid out differently.
+#Column 12 holds the medium-only blanks of the Tron Weiss layout and is never picked, as in the original script (which
+#only read columns 1-11); give --exclude-columns with other columns, or with none, to change that.
+
+
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24)}
+ROW_LETTERS = 'ABCDEFGHIJKLMNOP'
+OVERFLOW = 'OVRFLW' #What the Omega writes for readings above its range.
+BLANK_COLUMN = 12 #Medium only.
+
+
+def reading(value): #Plate reader cell to a number; blanks and text are NaN, overflows are infinite.
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value.strip().upper() == OVERFLOW:
+        return math.inf
+    return math.nan
+
+
+def header_column(row): #Column of the row letters under a header row of plate column numbers (1, 2, 3...), or None.
+    for column in range(1, len(row) - 1):
+        if row[column] in (1, '1') and row[column + 1] in (2, '2'):
+            return column - 1
+    return None
+
+
+def find_blocks(rows): #Plate blocks of a sheet streamed as value tuples: a row letter, then the readings of that row.
+    blocks, block, label_column, header = [], [], None, None
+    for row in rows:
+        if 0 < len(block) < len(ROW_LETTERS) and label_column < len(row) and row[label_column] == ROW_LETTERS[len(block)]:
+            block.append(row[label_column + 1:])
+            continue
+        if len(block) in (8, 16):
+            blocks.append(block)
+        block = []
+        #The header above a block gives the column of its row letters, so the block is found even if A1 is blank.
+        if header_column(row) is not None:
+            header = header_column(row)
+            continue
+        if header is not None and header < len(row) and row[header] == 'A':
+            block, label_column, header = [row[header + 1:]], header, None
+            continue
+        for column, value in enumerate(row[:-1]): #Blocks without a header start at an A followed by a reading.
+            if value == 'A' and not math.isnan(reading(row[column + 1])):
+                block, label_column = [row[column + 1:]], column
+                break
+    if len(block) in (8, 16):
+        blocks.append(block)
+    return [to_array(block) for block in blocks]
+
+
+def to_array(block): #Readings of a block as a plate-sized array (12 columns for 8 rows, 24 for 16).
+    n_rows, n_columns = PLATE_FORMATS[96] if len(block) == 8 else PLATE_FORMATS[384]
+    values = np.full((n_rows, n_columns), np.nan)
+    for r, row in enumerate(block):
+        for c, value in enumerate(row[:n_columns]):
+            values[r, c] = reading(value)
+    return values
+
+
+def read_plates(path, start_cell=None, plate_format=96):
+    """Reads the plates of an Omega export (.xlsx), streaming it in read-only mode.
+    Returns a list of (name, readings) with one rows x columns array per plate.
+    """
+    workbook = load_workbook(filename=path, read_only=True, data_only=True)
+    plates = []
+    try:
+        if start_cell:
+            n_rows, n_columns = PLATE_FORMATS[plate_format]
+            column_letter, first_row = coordinate_from_string(start_cell)
+            first_column = column_index_from_string(column_letter)
+            rows = workbook.active.iter_rows(min_row=first_row, max_row=first_row + n_rows - 1, min_col=first_column,
+                                             max_col=first_column + n_columns - 1, values_only=True)
+            values = np.array([[reading(value) for value in row] for row in rows])
+            plates.append((workbook.active.title, values))
+        else:
+            for sheet in workbook.worksheets:
+                blocks = find_blocks(sheet.iter_rows(values_only=True))
+                for number, values in enumerate(blocks):
+                    plates.append((sheet.title if len(blocks) == 1 else f'{sheet.title} plate {number + 1}', values))
+    finally:
+        workbook.close()
+    return plates
+
+
+def well_names(n_rows, n_columns): #Names of the wells of a plate counted down the columns, as in the original script.
+    return np.array([ROW_LETTERS[r] + str(c + 1) for c in range(n_columns) for r in range(n_rows)])
+
+
+def top_wells(values, k, exclude_columns=()):
+    """Names of the k wells with the highest readings, from highest to lowest (ties: first well down the columns).
+    Blank wells and the columns in exclude_columns (numbered from 1) are never picked.
+    """
+    n_rows, n_columns = values.shape
+    readings = values.T.ravel().copy() #Down the columns, so that the index order is the well order.
+    for column in exclude_columns:
+        readings[(column - 1) * n_rows:column * n_rows] = np.nan
+    candidates = np.flatnonzero(~np.isnan(readings))
+    k = min(k, len(candidates))
+    if k == 0:
+        return []
+    #Partial sort: find the k-th highest reading in linear time, then sort only the wells at or above it.
+    threshold = np.partition(readings[candidates], len(candidates) - k)[len(candidates) - k]
+    chosen = candidates[readings[candidates] >= threshold]
+    chosen = chosen[np.lexsort((chosen, -readings[chosen]))][:k]
+    return list(well_names(n_rows, n_columns)[chosen])
+
+
+def extraction_dict(wells): #The dictionary to paste after 'wells =' in the new cycle protocol.
+    return {well: i for i, well in enumerate(wells)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find the wells with the highest fluorescence in Omega plate reader exports.')
+    parser.add_argument('files', nargs='+', help='Omega exports (.xlsx)')
+    parser.add_argument('--top', type=int, default=10, help='number of wells to extract from each plate (default: 10)')
+    parser.add_argument('--exclude-columns', type=int, nargs='*', default=[BLANK_COLUMN], metavar='COLUMN',
+                        help=f'plate columns that are never picked, e.g. controls or blanks (default: {BLANK_COLUMN})')
+    parser.add_argument('--start-cell', help='cell of the first reading (A1 well) when the plate blocks are not labelled')
+    parser.add_argument('--format', type=int, choices=sorted(PLATE_FORMATS), default=96, help='plate format for --start-cell')
+    parser.add_argument('--json', help='also save the dictionaries to this .json file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for path in args.files:
+        plates = read_plates(path, args.start_cell, args.format)
+        if not plates:
+            print(f'{path}: no plate found', file=sys.stderr)
+            return 1
+        for name, values in plates:
+            wells = extraction_dict(top_wells(values, args.top, args.exclude_columns))
+            results.setdefault(path, {})[name] = wells
+            print(f'{path} [{name}]: Dictionary Input for Well Extraction Protocol = {wells}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as wf:
+            json.dump(results, wf, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())